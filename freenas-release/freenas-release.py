@@ -8,6 +8,7 @@ import shutil
 
 sys.path.append("/usr/local/lib")
 
+import freenasOS.Checksum as Checksum
 import freenasOS.Manifest as Manifest
 import freenasOS.Package as Package
 import freenasOS.PackageFile as PackageFile
@@ -1328,7 +1329,7 @@ def usage():
     print("""Usage: %s [--config config_file] [--database|-D db] [--debug|-d] [--verbose|-v] [--archive|--destination|-a archive_directory] <cmd> [args]
     Command is:
 	add	Add the build-output directories (args) to the archive and database
-	check	Check the archive for self-consistency.
+	check	Check the archive for self-consistency (-j count to checksum count files at once).
     	rebuild	Rebuild the databse (--copy <new_dest> and --verify options)
 	dump	Print out the sequences in order (--train=<train> to limit to a specific train)
     	extract	Extract a particular release from the archive
@@ -2251,15 +2252,16 @@ def Check(archive, db, project = "FreeNAS", args = []):
     and orphaned files/directories.
     """
     def CheckUsage():
-        print("Usage: %s check [-Q|--quick]" % sys.argv[0], file=sys.stderr)
+        print("Usage: %s check [-Q|--quick] [-j|--jobs count]" % sys.argv[0], file=sys.stderr)
         usage()
 
     global verbose, debug
     quick = False
+    jobs = None
 
     try:
-        short_options = "Q"
-        long_options = ["quick"]
+        short_options = "Qj:"
+        long_options = ["quick", "jobs="]
         opts, arguments = getopt.getopt(args, short_options, long_options)
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
@@ -2268,6 +2270,11 @@ def Check(archive, db, project = "FreeNAS", args = []):
     for o, a in opts:
         if o in ("-Q", "--quick"):
             quick = True
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = max(1, int(a))
+            except ValueError:
+                CheckUsage()
         else:
             print("Unknown option %s" % o, file=sys.stderr)
             CheckUsage()
@@ -2378,10 +2385,9 @@ def Check(archive, db, project = "FreeNAS", args = []):
                 print("Expected manifest file %s does not exist" % mani_path, file=sys.stderr)
                 continue
                 
-            temp_mani = Manifest.Manifest()
-            temp_mani.LoadPath(mani_path)
-
-            for pkg in temp_mani.Packages():
+            # Only the packages are needed, so they're read one at a time
+            # rather than loading the whole manifest.
+            for pkg in Manifest.ManifestPackages(mani_path):
                 if pkg.FileName() in expected_packages:
                     if expected_packages[pkg.FileName()] != pkg.Checksum():
                         print("Package %s, version %s, already found with different checksum" \
@@ -2466,11 +2472,13 @@ def Check(archive, db, project = "FreeNAS", args = []):
         if not os.path.isfile(full_path):
             print("Entry in Packages directory, %s, is not a file" % pkgEntry, file=sys.stderr)
             continue
-        if quick:
-            cksum = "-"
-        else:
-            cksum = ChecksumFile(full_path)
-        found_packages[pkgEntry] = cksum
+        found_packages[pkgEntry] = "-"
+    if not quick:
+        # Checksum the package files jobs at a time
+        sums = Checksum.ChecksumFiles([os.path.join(p_dir, p) for p in found_packages],
+                                      workers = jobs)
+        for pkgEntry in list(found_packages.keys()):
+            found_packages[pkgEntry] = sums[os.path.join(p_dir, pkgEntry)]
 
     if (quick and list(expected_packages.keys()) != list(found_packages.keys())) or \
        (quick is False and expected_packages != found_packages):
@@ -8,6 +8,8 @@ import shutil
 
 sys.path.append("/usr/local/lib")
 
+import freenasOS.Checksum as Checksum
+import freenasOS.Timeline as Timeline
 import freenasOS.Configuration as Configuration
 import freenasOS.Update as Update
 import freenasOS.Exceptions as Exceptions
@@ -150,6 +152,15 @@ def PrintDifferences(diffs):
             print("*** Unknown key {0} (value {1})".format(type, str(diffs[type])), file=sys.stderrr)
 
 
+def PrintDownloadPlan(plan, total):
+    for entry in plan:
+        size = entry["Transfer"]
+        print("{0}: {1}{2}, {3} bytes to download".format(
+            entry["Name"], entry["Filename"], " (delta)" if entry["Delta"] else "",
+            "unknown" if size is None else size), file=sys.stderr)
+    print("Expected download: {0} bytes".format(total), file=sys.stderr)
+
+
 def DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=False):
 
     try:
@@ -166,7 +177,8 @@ def DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=False):
                 if rv is False:
                     progress_bar.update(message="No updates available")
         else:
-            rv = Update.DownloadUpdate(train, cache_dir, pkg_type=pkg_type, ignore_space=ignore_space)
+            rv = Update.DownloadUpdate(train, cache_dir, pkg_type=pkg_type, ignore_space=ignore_space,
+                                       plan_handler=PrintDownloadPlan)
     except Exceptions.ManifestInvalidSignature:
         log.error("Manifest has invalid signature")
         print("Manifest has invalid signature", file=sys.stderr)
@@ -257,15 +269,73 @@ def DoUpdate(cache_dir, verbose, ignore_space=False, force_trampoline=None):
 
     return rv
 
+def DoPipelinedUpdate(train, cache_dir, pkg_type, verbose, ignore_space=False, force_trampoline=None):
+    """
+    Download and apply an update at the same time, installing each
+    package as soon as it has been downloaded.  Returns None if there
+    was no update, otherwise as DoUpdate().
+    Raises an exception on error.
+    """
+    global log
+
+    try:
+        if not verbose:
+            with ProgressBar() as progress_bar:
+                handler = UpdateHandler(progress_bar.update)
+                rv = Update.PipelinedUpdate(
+                    train,
+                    cache_dir,
+                    get_handler=handler.get_handler,
+                    check_handler=handler.check_handler,
+                    install_handler=handler.install_handler,
+                    pkg_type=pkg_type,
+                    ignore_space=ignore_space,
+                    force_trampoline=force_trampoline,
+                )
+                if rv is None:
+                    progress_bar.update(message="No updates available")
+        else:
+            with ProgressHandler() as pf:
+                rv = Update.PipelinedUpdate(train, cache_dir,
+                                            pkg_type=pkg_type,
+                                            progressFunc=pf.update,
+                                            ignore_space=ignore_space,
+                                            force_trampoline=force_trampoline,
+                                            )
+    except Exceptions.ManifestInvalidSignature:
+        log.error("Manifest has invalid signature")
+        print("Manifest has invalid signature", file=sys.stderr)
+        sys.exit(1)
+    except Exceptions.UpdateBusyCacheException as e:
+        log.error(str(e))
+        print("Download cache directory is busy", file=sys.stderr)
+        sys.exit(1)
+    except Exceptions.UpdateInvalidUpdateException as e:
+        log.error(str(e))
+        print("Update not permitted:\n{0}".format(e.value), file=sys.stderr)
+        sys.exit(1)
+    except Exceptions.UpdateInsufficientSpace as e:
+        log.error(str(e))
+        print(e.value if e.value else "Insufficient space for update")
+        sys.exit(1)
+    except BaseException as e:
+        log.error("Unable to apply update: {0}".format(str(e)))
+        raise
+    if rv and verbose:
+        print("System should be rebooted now", file=sys.stderr)
+
+    return rv
+
 def main():
     global log
 
     def usage():
-        print("""Usage: {0} [-C cache_dir] [-d] [-T train] [--no-delta] [--reboot|-R] [--server|-S server][-B|--trampline yes|no] [--force|-F] [-v] <cmd>
+        print("""Usage: {0} [-C cache_dir] [-d] [-T train] [--no-delta] [--reboot|-R] [--server|-S server][-B|--trampline yes|no] [--force|-F] [--limit-rate rate] [--background] [--paranoid] [--checksum-workers count] [--pipeline] [-v] <cmd>
 or	{0} <update_tar_file>
 where cmd is one of:
         check\tCheck for updates
-        update\tDo an update""".format(sys.argv[0]), file=sys.stderr)
+        update\tDo an update
+        timeline [file]\tShow where the time went in the last update (or file)""".format(sys.argv[0]), file=sys.stderr)
         sys.exit(1)
 
     try:
@@ -280,6 +350,11 @@ where cmd is one of:
             "force",
             "server=",
             "trampoline=",
+            "limit-rate=",
+            "background",
+            "paranoid",
+            "checksum-workers=",
+            "pipeline",
             "snl"
         ]
         opts, args = getopt.getopt(sys.argv[1:], short_opts, long_opts)
@@ -299,6 +374,10 @@ where cmd is one of:
     force = False
     server = None
     force_trampoline = None
+    rate_limit = None
+    profile = None
+    paranoid = False
+    pipeline = False
     
     for o, a in opts:
         if o in ("-v", "--verbose"):
@@ -327,6 +406,24 @@ where cmd is one of:
             snl = True
         elif o in ("-F", "--force"):
             force = True
+        elif o in ("--limit-rate"):
+            try:
+                rate_limit = Configuration.ParseRate(a)
+            except ValueError:
+                print("Rate limit must be a number of bytes per second, optionally followed by K, M or G", file=sys.stderr)
+                usage()
+        elif o in ("--background"):
+            profile = Configuration.PROFILE_BACKGROUND
+        elif o in ("--paranoid"):
+            paranoid = True
+        elif o in ("--pipeline"):
+            pipeline = True
+        elif o in ("--checksum-workers"):
+            try:
+                Checksum.SetWorkers(int(a))
+            except ValueError:
+                print("Checksum workers must be a number", file=sys.stderr)
+                usage()
         else:
             assert False, "unhandled option {0}".format(o)
 
@@ -338,14 +435,35 @@ where cmd is one of:
     if server:
         assert server in config.ListUpdateServers(), "Unknown update server {}".format(server)
         config.SetUpdateServer(server, save=False)
+    if rate_limit is not None or profile is not None:
+        config.SetDownloadLimits(rate_limit=rate_limit, profile=profile, save=False)
         
     if train is None:
         train = config.SystemManifest().Train()
 
-    if len(args) != 1:
+    if len(args) == 2 and args[0] == "timeline":
+        path = args[1]
+    elif len(args) == 1 and args[0] == "timeline":
+        paths = Timeline.List()
+        if not paths:
+            print("No update timelines in {0}".format(Timeline.TIMELINE_DIR), file=sys.stderr)
+            sys.exit(1)
+        path = paths[-1]
+    elif len(args) != 1:
         usage()
 
-    if args[0] == "check":
+    if args[0] == "timeline":
+        try:
+            timeline = Timeline.Load(path)
+        except (IOError, OSError, ValueError) as e:
+            print("Unable to read timeline {0}: {1}".format(path, str(e)), file=sys.stderr)
+            sys.exit(1)
+        print(path)
+        for line in Timeline.Summary(timeline):
+            print(line)
+        sys.exit(0)
+
+    elif args[0] == "check":
         # To see if we have an update available, we
         # call Update.DownloadUpdate.  If we have been
         # given a cache directory, we pass that in; otherwise,
@@ -377,10 +495,11 @@ where cmd is one of:
         # and it will download the latest one as necessary, and then run
         # "freenas-update -c /foo update" if it said there was an update.
 
-        # See if the cache directory has an update downloaded already
+        # See if the cache directory has an update downloaded already.
+        # With --paranoid, every package file in it is hashed again.
         do_download = True
         try:
-            f = Update.VerifyUpdate(cache_dir)
+            f = Update.VerifyUpdate(cache_dir, paranoid=paranoid)
             if f:
                 f.close()
                 do_download = False
@@ -392,6 +511,25 @@ where cmd is one of:
         except:
             raise
 
+        if do_download and pipeline:
+            # Install each package as it's downloaded
+            try:
+                rv = DoPipelinedUpdate(train, cache_dir, pkg_type, verbose, ignore_space=force,
+                                       force_trampoline=force_trampoline)
+            except:
+                sys.exit(1)
+            if rv is None:
+                if verbose:
+                    print("No updates available")
+                Update.RemoveUpdate(cache_dir)
+                sys.exit(1)
+            if rv:
+                if do_reboot:
+                    os.system("/sbin/shutdown -r now")
+                sys.exit(0)
+            else:
+                sys.exit(1)
+
         if do_download:
             rv = DoDownload(train, cache_dir, pkg_type, verbose, ignore_space=force)
             if rv is False:
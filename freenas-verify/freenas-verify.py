@@ -1,5 +1,6 @@
 #!/usr/bin/env /usr/local/bin/python
 from __future__ import print_function
+import getopt
 import sys
 import traceback
 
@@ -7,8 +8,19 @@ sys.path.append("/usr/local/lib")
 from freenasOS import Configuration
 
 if __name__ == '__main__':
+    workers = None
     try:
-        error_flag, ed, warn_flag, wl = Configuration.do_verify()
+        opts, args = getopt.getopt(sys.argv[1:], "j:")
+        for o, a in opts:
+            if o == "-j":
+                workers = max(1, int(a))
+    except (getopt.GetoptError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        print("Usage: %s [-j count]\n\t-j\tNumber of files to checksum at once" % sys.argv[0], file=sys.stderr)
+        sys.exit(64)
+
+    try:
+        error_flag, ed, warn_flag, wl = Configuration.do_verify(workers=workers)
     except IOError as e:
         traceback.print_exc()
         sys.exit(74)
@@ -0,0 +1,100 @@
+from __future__ import print_function
+import hashlib
+import logging
+import mmap
+import os
+
+log = logging.getLogger('freenasOS.Checksum')
+
+# How much of a mapped file is given to the hash at a time.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# The number of files hashed at once by ChecksumFiles(), if
+# SetWorkers() hasn't been called.
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+_workers = None
+
+
+def SetWorkers(count):
+    """
+    Set how many files ChecksumFiles() hashes at once.
+    None goes back to the default.
+    """
+    global _workers
+    if count is not None:
+        count = max(1, int(count))
+    _workers = count
+
+
+def Workers():
+    return _workers or DEFAULT_WORKERS
+
+
+def _ReadChecksum(f, hash):
+    for piece in iter(lambda: f.read(1024 * 1024), b''):
+        hash.update(piece)
+    return hash.hexdigest()
+
+
+def ChecksumPath(path, mapped=True):
+    """
+    Return the sha256 checksum of the file at path.  The file is mapped
+    into memory rather than read (if it can't be mapped, it's read),
+    unless mapped is False.  Reading a mapped file that is truncated
+    while it is being hashed kills the process with SIGBUS, so only
+    files that nothing else changes, such as those in the update
+    cache, should be mapped.
+    Raises OSError (or IOError) if it can't be opened.
+    """
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        if not mapped:
+            return _ReadChecksum(f, hash)
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hash.hexdigest()
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            log.debug("Could not map %s, reading it instead" % path)
+            return _ReadChecksum(f, hash)
+        try:
+            view = memoryview(mapping)
+            try:
+                # hashlib releases the GIL while hashing large buffers
+                for offset in range(0, len(view), CHUNK_SIZE):
+                    hash.update(view[offset:offset + CHUNK_SIZE])
+            finally:
+                view.release()
+        finally:
+            mapping.close()
+    return hash.hexdigest()
+
+
+def ChecksumFiles(paths, workers=None, mapped=True):
+    """
+    Checksum several files at once, using up to workers threads
+    (default Workers()).  Returns a dictionary mapping each path to
+    its sha256 checksum, or to None if it couldn't be read.  Files
+    that may be changed while they are hashed (such as installed
+    files) need mapped set to False; see ChecksumPath().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def Checksum(path):
+        try:
+            return ChecksumPath(path, mapped=mapped)
+        except EnvironmentError as e:
+            log.debug("Could not checksum %s: %s" % (path, str(e)))
+            return None
+
+    # Keep the order, but only do each file once
+    paths = list(dict.fromkeys(paths))
+    if workers is None:
+        workers = Workers()
+    workers = max(1, min(workers, len(paths)))
+    if workers == 1:
+        return dict((path, Checksum(path)) for path in paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(Checksum, paths)))
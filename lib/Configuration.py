@@ -8,16 +8,21 @@ import tempfile
 import time
 import socket
 import ssl
+import json
+import shutil
+import threading
 import six
 
 import six.moves.configparser as configparser
 
 from http.client import REQUESTED_RANGE_NOT_SATISFIABLE as HTTP_RANGE
 from http.client import NOT_FOUND as HTTP_NOT_FOUND
+from http.client import NOT_MODIFIED as HTTP_NOT_MODIFIED
+from http.client import PARTIAL_CONTENT as HTTP_PARTIAL
 
 from . import (
     Avatar, UPDATE_SERVER, MASTER_UPDATE_SERVER, Exceptions,
-    Installer, Train, Package, Manifest, DEFAULT_CA_FILE
+    Installer, Train, Package, Manifest, DEFAULT_CA_FILE, Checksum
 )
 
 from stat import (
@@ -40,21 +45,80 @@ VERIFY_SKIP_PATHS = [
 CONFIG_DEFAULT = "Defaults"
 CONFIG_SEARCH = "Search"
 CONFIG_SERVER = "update_server"
+CONFIG_CACHE = "Cache"
+
+# Keys for the Cache section of the update configuration file.
+# enabled:  whether conditional requests and the on-disk cache are used at all.
+# max_age:  number of seconds a cached body is used without asking the server.
+#	0 (the default) means always revalidate with If-None-Match/If-Modified-Since.
+# directory:  where the cache lives; defaults to a directory under the
+#	temporary directory (the system dataset, if there is one).
+CACHE_ENABLED_KEY = "enabled"
+CACHE_MAX_AGE_KEY = "max_age"
+CACHE_DIRECTORY_KEY = "directory"
+HTTP_CACHE_DIR = "update-http-cache"
+
+CONFIG_DOWNLOAD = "Download"
+
+# Keys for the Download section of the update configuration file.
+# segments:  how many byte ranges of a large file are fetched at once.
+#	1 (the default) means large files are fetched over a single stream.
+# segment_threshold:  files smaller than this many bytes are never segmented.
+# rate_limit:  maximum download rate, in bytes per second (a K, M or G
+#	suffix may be used).  0 (the default) means no limit.
+# profile:  "normal" or "background".  The background profile runs
+#	downloads at a lower CPU and I/O priority, and keeps the downloaded
+#	files out of the buffer cache.
+DOWNLOAD_SEGMENTS_KEY = "segments"
+DOWNLOAD_THRESHOLD_KEY = "segment_threshold"
+DOWNLOAD_RATE_KEY = "rate_limit"
+DOWNLOAD_PROFILE_KEY = "profile"
+DOWNLOAD_SEGMENTS = 1
+DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+PROFILE_NORMAL = "normal"
+PROFILE_BACKGROUND = "background"
+# How much the background profile lowers the process priority.
+BACKGROUND_NICE = 10
+# Completed segments of an interrupted download are recorded
+# in a file with this suffix next to the download.
+SEGMENT_FILE_SUFFIX = ".segments"
 
 UPDATE_SERVER_NAME_KEY = "name"
 UPDATE_SERVER_MASTER_KEY = "master"
 UPDATE_SERVER_URL_KEY = "url"
 UPDATE_SERVER_SIGNED_KEY = "signing"
+# The name of another update server this one mirrors.  Mirrors of the
+# selected update server are probed, and files are fetched from the
+# fastest one, failing over to the others.
+UPDATE_SERVER_MIRROR_KEY = "mirror"
+
+# How long (in seconds) a mirror ranking is used before probing again.
+# This goes in the Defaults section.
+CONFIG_MIRROR_TTL = "mirror_ttl"
+MIRROR_TTL = 60 * 60
+MIRROR_FILE = "Mirrors.json"
+# Mirrors are ranked by the estimated time to fetch this many bytes.
+MIRROR_COST_BYTES = 1024 * 1024
+# A probe's throughput is only used if at least this much was read;
+# timing a small file (such as trains.txt) says nothing about it.
+PROBE_MIN_BYTES = 64 * 1024
 
 TRAIN_DESC_KEY = "Descripton"
 TRAIN_SEQ_KEY = "Sequence"
 TRAIN_CHECKED_KEY = "LastChecked"
+TRAIN_NOTES_KEY = "Notes"
+TRAIN_NOTICE_KEY = "Notice"
 
 log = logging.getLogger('freenasOS.Configuration')
 
 # List of trains
 TRAIN_FILE = "trains.txt"
 
+# Don't let a zfs pool get above this percentage used...
+ZFS_MAX_PCT = 90
+# ...unless the free space is at least this multiple of the required size
+ZFS_MULTIPLE = 4
+
 def CheckFreeSpace(path=None, pool=None, required=0):
     """
     Check for enough free space on the path/pool.
@@ -69,10 +133,6 @@ def CheckFreeSpace(path=None, pool=None, required=0):
     """
     import libzfs
     from bsd import statfs
-    # Don't let it get above 90% used for zfs
-    zfs_max_pct = 90
-    # Unless the free space is at least 4x the required size
-    zfs_multiple = 4
 
     log.debug("CheckFreeSpace(path={}, pool={}, required={})".format(path, pool, required))
     
@@ -97,14 +157,35 @@ def CheckFreeSpace(path=None, pool=None, required=0):
             pool_size = p.properties["size"].parsed
             pool_used = p.properties["allocated"].parsed
             pool_free = p.properties["free"].parsed
-        pool_max = int(pool_size * (zfs_max_pct / 100.0))
+        pool_max = int(pool_size * (ZFS_MAX_PCT / 100.0))
         if (pool_used + required) >= pool_max:
-            if pool_free > (zfs_multiple * required):
+            if pool_free > (ZFS_MULTIPLE * required):
                 return True
             log.debug("pool_used ({}) + required ({}) > pool_max ({})".format(pool_used, required, pool_max))
             return False
     return True
 
+def PoolShortfall(pool, required=0):
+    """
+    Return how many bytes would have to be freed on pool for
+    required bytes to fit, by the same rules as CheckFreeSpace().
+    0 means it fits already.
+    """
+    import libzfs
+
+    with libzfs.ZFS() as zfs:
+        p = zfs.get(pool)
+        pool_size = p.properties["size"].parsed
+        pool_used = p.properties["allocated"].parsed
+        pool_free = p.properties["free"].parsed
+    pool_max = int(pool_size * (ZFS_MAX_PCT / 100.0))
+    if (pool_used + required) < pool_max or pool_free > (ZFS_MULTIPLE * required):
+        return 0
+    # Freeing space works for either rule, whichever needs less
+    return max(0, min(pool_used + required - pool_max + 1,
+                      ZFS_MULTIPLE * required - pool_free + 1))
+
+
 def ChecksumFile(fobj):
     # Produce a SHA256 checksum of a file.
     # Read it in chunk
@@ -119,6 +200,92 @@ def ChecksumFile(fobj):
     return hash.hexdigest()
 
 
+def ParseRate(value):
+    """
+    Turn a rate such as "500K" or "2M" (bytes per second) into an integer.
+    """
+    value = str(value).strip()
+    multiplier = 1
+    if value and value[-1].upper() in "KMG":
+        multiplier = 1024 ** ("KMG".index(value[-1].upper()) + 1)
+        value = value[:-1]
+    rate = int(float(value) * multiplier)
+    if rate < 0:
+        raise ValueError("Rate cannot be negative")
+    return rate
+
+
+class TokenBucket(object):
+    """
+    Limits transfers to rate bytes per second, allowing bursts
+    of up to burst bytes (by default, a quarter second's worth).
+    consume() sleeps for as long as it takes to pay for the bytes;
+    a bucket may be shared by several threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate / 4), 16 * 1024)
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= count
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_background_priority = False
+def BackgroundPriority():
+    """
+    Lower the CPU and I/O priority of this process, for the
+    background download profile.  On FreeBSD, I/O is scheduled by
+    the issuing thread's priority, so nice covers both.  This is
+    only done once.
+    """
+    global _background_priority
+    if _background_priority:
+        return
+    _background_priority = True
+    try:
+        os.nice(BACKGROUND_NICE)
+    except OSError as e:
+        log.debug("Could not lower priority:  %s" % str(e))
+
+
+def DropCachedPages(fobj):
+    # Tell the kernel we won't be reading what we wrote soon, so a
+    # background download doesn't push out data the NAS is serving.
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fobj.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except (OSError, AttributeError):
+            pass
+
+
+def DownloadedBytes(path):
+    """
+    How much of a download to path is already there.  A segmented
+    download preallocates the whole file, so then only the completed
+    segments count.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    try:
+        with open(path + SEGMENT_FILE_SUFFIX, "r") as f:
+            state = json.load(f)
+        return sum(end + 1 - start for (start, end), done in zip(state["Segments"], state["Done"]) if done)
+    except:
+        return size
+
+
 def TryOpenFile(path):
     try:
         f = open(path, "r")
@@ -436,9 +603,117 @@ class PackageDB:
         return
 
 
+class TransferProgress(object):
+    """
+    Keeps a smoothed (exponentially weighted) download rate, and
+    calls the progress handler no more often than every interval
+    seconds, plus once when the transfer completes.  update() is
+    safe to call from several threads.
+    """
+    # Rate samples cover at least this many seconds.
+    SAMPLE_TIME = 0.1
+
+    def __init__(self, handler, url, size, read=0, interval=0.5, alpha=0.3):
+        self.handler = handler
+        self.url = url
+        self.size = size
+        self.read = read
+        self.interval = interval
+        self.alpha = alpha
+        self.rate = None
+        self._lock = threading.Lock()
+        self._start = self._sample_time = self._report_time = time.time()
+        self._start_read = read
+        self._sample_bytes = 0
+        self._percent = None
+
+    def update(self, count):
+        with self._lock:
+            now = time.time()
+            self.read += count
+            self._sample_bytes += count
+            elapsed = now - self._sample_time
+            if elapsed >= self.SAMPLE_TIME:
+                rate = self._sample_bytes / elapsed
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate = self.alpha * rate + (1 - self.alpha) * self.rate
+                self._sample_time = now
+                self._sample_bytes = 0
+            if not (self.handler and self.size):
+                return
+            percent = int((float(self.read) / float(self.size)) * 100.0)
+            if percent == self._percent:
+                return
+            if self.read < self.size and now - self._report_time < self.interval:
+                return
+            self._percent = percent
+            self._report_time = now
+            rate = self.rate
+            if rate is None and now > self._start:
+                # Not a full sample yet, so use the average so far.
+                rate = (self.read - self._start_read) / (now - self._start)
+        self.handler(
+            'network',
+            self.url,
+            size=self.size,
+            progress=percent,
+            download_rate=int(rate) if rate else None,
+        )
+
+
+def ProbeUpdateServer(url, timeout=5, probe_file=None, max_bytes=256 * 1024):
+    """
+    Measure how quickly an update server responds.  Returns a
+    dictionary with the url, the latency (seconds until the response
+    headers arrived) and the throughput (bytes per second while reading
+    up to max_bytes of the body; None if less than PROBE_MIN_BYTES
+    could be read).  If the server can't be reached, latency and
+    throughput are None.
+    """
+    import requests
+
+    if probe_file is None:
+        probe_file = TRAIN_FILE
+    rv = {"url": url, "latency": None, "throughput": None}
+    start = time.time()
+    try:
+        r = requests.get("%s/%s" % (url, probe_file), timeout=timeout,
+                         verify=DEFAULT_CA_FILE, stream=True)
+        try:
+            r.raise_for_status()
+            body_start = time.time()
+            latency = body_start - start
+            got = 0
+            for chunk in r.iter_content(64 * 1024):
+                got += len(chunk)
+                if got >= max_bytes:
+                    break
+            elapsed = time.time() - body_start
+            rv["latency"] = latency
+            if got >= PROBE_MIN_BYTES and elapsed > 0:
+                rv["throughput"] = int(got / elapsed)
+        finally:
+            r.close()
+    except BaseException as e:
+        log.debug("ProbeUpdateServer(%s):  %s" % (url, str(e)))
+    return rv
+
+
+def MirrorCost(probe):
+    # Estimated time to fetch MIRROR_COST_BYTES; unreachable servers go last.
+    if probe.get("latency") is None:
+        return float("inf")
+    cost = probe["latency"]
+    if probe.get("throughput"):
+        cost += float(MIRROR_COST_BYTES) / probe["throughput"]
+    return cost
+
+
 class UpdateServer(object):
 
-    def __init__(self, name=None, url=None, master=None, signing=True):
+    def __init__(self, name=None, url=None, master=None, signing=True, mirror=None):
         if name is None:
             raise ValueError("Cannot initialize UpdateServer with no name")
         else:
@@ -450,10 +725,11 @@ class UpdateServer(object):
         if master == url:
             self._master = None
         self._signature_required = signing
+        self._mirror = mirror
 
     def __repr__(self):
-        return "UpdateServer(name={}, url={}, master={}, signing={})".format(
-            self.name, self.url, self.master, self.signature_required)
+        return "UpdateServer(name={}, url={}, master={}, signing={}, mirror={})".format(
+            self.name, self.url, self.master, self.signature_required, self.mirror)
 
     def __str__(self):
         return "<UpdateServe name={} url={} master={} signing={}>".format(
@@ -463,6 +739,8 @@ class UpdateServer(object):
         retval = { "name" : self.name, "url" : self.url, "signing" : self.signature_required }
         if self._master and self._master != self.url:
             retval["master"] = self.master
+        if self._mirror:
+            retval["mirror"] = self._mirror
         return retval
     
     @property
@@ -500,6 +778,14 @@ class UpdateServer(object):
     def signature_required(self, sr):
         self._signature_required = sr
 
+    @property
+    def mirror(self):
+        return self._mirror
+
+    @mirror.setter
+    def mirror(self, name):
+        self._mirror = name
+
 default_update_server = UpdateServer(name="default",
                                      url=UPDATE_SERVER,
                                      master=MASTER_UPDATE_SERVER,
@@ -512,8 +798,19 @@ class Configuration(object):
     _temp = "/tmp"
     _system_dataset = "/var/db/system"
     _package_dir = None
+    _http_cache_enabled = True
+    _http_cache_max_age = 0
+    _http_cache_dir = None
+    _download_segments = DOWNLOAD_SEGMENTS
+    _download_threshold = DOWNLOAD_THRESHOLD
+    _download_rate = 0
+    _download_profile = PROFILE_NORMAL
+    _mirror_ttl = MIRROR_TTL
+    _mirror_ranking = None
+    _mirror_lock = threading.Lock()
 
     _manifest = None
+    _trains = None
 
     def __init__(self, root=None, file=None):
         if root is not None:
@@ -546,6 +843,109 @@ class Configuration(object):
     def ListUpdateServers(self):
         self.UpdateCache()
         return list(self._update_servers.keys())
+
+    def MirrorCandidates(self):
+        """
+        The base URLs files can be fetched from for the selected
+        update server:  its URL, its master, and the URL of each
+        configured server that says it is a mirror of it.
+        """
+        self.UpdateCache()
+        selected = self._update_servers[self._update_server_name]
+        rv = [selected.url]
+        if selected.master not in rv:
+            rv.append(selected.master)
+        for server in self._update_servers.values():
+            if server.mirror == selected.name and server.url not in rv:
+                rv.append(server.url)
+        return rv
+
+    def MirrorURLs(self):
+        """
+        Return MirrorCandidates(), fastest first.  If there are no
+        configured mirrors this is just the URL and master, in that
+        order.  Otherwise the candidates are probed (see ProbeMirrors),
+        and the ranking is kept for the mirror TTL.
+        """
+        candidates = self.MirrorCandidates()
+        if len(candidates) <= 2:
+            selected = self._update_servers[self._update_server_name]
+            if not any(s.mirror == selected.name for s in self._update_servers.values()):
+                return candidates
+        with self._mirror_lock:
+            ranking = self._mirror_ranking
+            if ranking is None:
+                ranking = self._LoadMirrorRanking()
+            if ranking is None or \
+               ranking.get("Server") != self._update_server_name or \
+               sorted(ranking.get("Candidates", [])) != sorted(candidates) or \
+               time.time() - ranking.get("Checked", 0) > self._mirror_ttl:
+                ranking = None
+        if ranking is None:
+            self.ProbeMirrors(candidates)
+            ranking = self._mirror_ranking
+        return [p["url"] for p in ranking["Ranking"]]
+
+    def ProbeMirrors(self, urls=None, timeout=5):
+        """
+        Probe the given base URLs (default MirrorCandidates()) concurrently,
+        and rank them by MirrorCost().  The ranking is saved, and the list
+        of probe results is returned in ranked order.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if urls is None:
+            urls = self.MirrorCandidates()
+        with ThreadPoolExecutor(max_workers=max(1, len(urls))) as executor:
+            results = list(executor.map(lambda u: ProbeUpdateServer(u, timeout=timeout), urls))
+        # sorted() is stable, so ties keep the configured order.
+        results = sorted(results, key=MirrorCost)
+        for probe in results:
+            log.debug("Mirror %s:  latency %s, throughput %s" % (probe["url"], probe["latency"], probe["throughput"]))
+        with self._mirror_lock:
+            self._mirror_ranking = {
+                "Server": self._update_server_name,
+                "Candidates": list(urls),
+                "Checked": int(time.time()),
+                "Ranking": results,
+            }
+            self._SaveMirrorRanking()
+        return results
+
+    def MirrorFailed(self, url):
+        """
+        Note that url (a base URL) failed, moving it to the end
+        of the ranking so later files come from another server.
+        """
+        with self._mirror_lock:
+            ranking = self._mirror_ranking
+            if ranking is None:
+                return
+            failed = [p for p in ranking["Ranking"] if p["url"] == url]
+            if not failed:
+                return
+            log.debug("Mirror %s failed, moving it to the end of the list" % url)
+            ranking["Ranking"] = [p for p in ranking["Ranking"] if p["url"] != url]
+            for p in failed:
+                p["latency"] = p["throughput"] = None
+            ranking["Ranking"].extend(failed)
+            self._SaveMirrorRanking()
+
+    def _LoadMirrorRanking(self):
+        try:
+            with open(os.path.join(self._temp, MIRROR_FILE), "r") as f:
+                self._mirror_ranking = json.load(f)
+        except:
+            self._mirror_ranking = None
+        return self._mirror_ranking
+
+    def _SaveMirrorRanking(self):
+        try:
+            with open(os.path.join(self._temp, MIRROR_FILE), "w") as f:
+                json.dump(self._mirror_ranking, f, sort_keys=True,
+                          indent=4, separators=(',', ': '))
+        except (IOError, OSError) as e:
+            log.debug("Could not save mirror ranking:  %s" % str(e))
     
     def SetUpdateServer(self, name=default_update_server.name, save=True):
         if name not in self._update_servers:
@@ -576,15 +976,162 @@ class Configuration(object):
             self._update_server_name = default_update_server.name
         if save:
             self.StoreUpdateConfigurationFile(self._config_path)
-        
+
+    def HTTPCacheDirectory(self):
+        if self._http_cache_dir:
+            return self._http_cache_dir
+        return os.path.join(self._temp, HTTP_CACHE_DIR)
+
+    def SetHTTPCache(self, enabled=None, max_age=None, directory=None, save=False):
+        """
+        Change the conditional-GET cache settings.  Any argument
+        left as None is not changed.
+        """
+        if enabled is not None:
+            self._http_cache_enabled = bool(enabled)
+        if max_age is not None:
+            if int(max_age) < 0:
+                raise ValueError("Cache max_age cannot be negative")
+            self._http_cache_max_age = int(max_age)
+        if directory is not None:
+            self._http_cache_dir = directory
+        if save:
+            self.StoreUpdateConfigurationFile(self._config_path)
+
+    def SetSegmentedDownload(self, segments=None, threshold=None, save=False):
+        """
+        Change how large files are downloaded.  With segments greater
+        than 1, files of at least threshold bytes are fetched as that
+        many concurrent byte ranges.  Any argument left as None is not
+        changed.
+        """
+        if segments is not None:
+            if int(segments) < 1:
+                raise ValueError("Download segments must be at least 1")
+            self._download_segments = int(segments)
+        if threshold is not None:
+            if int(threshold) < 0:
+                raise ValueError("Segment threshold cannot be negative")
+            self._download_threshold = int(threshold)
+        if save:
+            self.StoreUpdateConfigurationFile(self._config_path)
+
+    def SetDownloadLimits(self, rate_limit=None, profile=None, save=False):
+        """
+        Set the default download rate limit (bytes per second; 0 means
+        no limit), and the download profile (PROFILE_NORMAL or
+        PROFILE_BACKGROUND).  Any argument left as None is not changed.
+        """
+        if rate_limit is not None:
+            self._download_rate = ParseRate(rate_limit)
+        if profile is not None:
+            if profile not in (PROFILE_NORMAL, PROFILE_BACKGROUND):
+                raise ValueError("Unknown download profile %s" % profile)
+            self._download_profile = profile
+        if save:
+            self.StoreUpdateConfigurationFile(self._config_path)
+
+    def DownloadRateLimit(self):
+        return self._download_rate
+
+    def DownloadProfile(self):
+        return self._download_profile
+
+    def _HTTPCachePaths(self, url):
+        # Cache entries are named after the hash of the URL; the
+        # .json file holds the validators, the .body file the content.
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        base = os.path.join(self.HTTPCacheDirectory(), key)
+        return base + ".json", base + ".body"
+
+    def _LoadHTTPCache(self, url):
+        """
+        Return the cache metadata for url, or None if there is
+        no usable entry.
+        """
+        if not self._http_cache_enabled:
+            return None
+        meta_path, body_path = self._HTTPCachePaths(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if meta.get("URL") != url or not os.path.exists(body_path):
+                return None
+        except:
+            return None
+        return meta
+
+    def _CopyHTTPCache(self, url, dest):
+        meta_path, body_path = self._HTTPCachePaths(url)
+        dest.seek(0)
+        dest.truncate()
+        with open(body_path, "rb") as f:
+            shutil.copyfileobj(f, dest, 1024 * 1024)
+        dest.flush()
+        dest.seek(0)
+
+    def _StoreHTTPCache(self, url, headers, src):
+        """
+        Save the body in src (a file-like object, which is left
+        at offset 0) along with the validators from headers.
+        Errors are logged and otherwise ignored; the cache is
+        only an optimization.
+        """
+        if not self._http_cache_enabled:
+            return
+        if "no-store" in headers.get("Cache-Control", ""):
+            return
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag is None and last_modified is None and self._http_cache_max_age == 0:
+            # Nothing to revalidate with, and we'd never use it as-is.
+            return
+        meta_path, body_path = self._HTTPCachePaths(url)
+        try:
+            if not os.path.isdir(self.HTTPCacheDirectory()):
+                os.makedirs(self.HTTPCacheDirectory(), 0o755)
+            with tempfile.NamedTemporaryFile(dir=self.HTTPCacheDirectory(), delete=False) as tf:
+                src.seek(0)
+                shutil.copyfileobj(src, tf, 1024 * 1024)
+            os.rename(tf.name, body_path)
+            self._TouchHTTPCache(url, {"ETag": etag, "Last-Modified": last_modified})
+        except:
+            log.debug("Unable to cache %s" % url, exc_info=True)
+            try:
+                os.unlink(tf.name)
+            except:
+                pass
+        src.seek(0)
+
+    def _TouchHTTPCache(self, url, meta):
+        meta_path, body_path = self._HTTPCachePaths(url)
+        meta = dict(meta)
+        meta["URL"] = url
+        meta["Fetched"] = int(time.time())
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.rename(meta_path + ".tmp", meta_path)
+
     def TryGetNetworkFile(self, file=None, url=None, handler=None,
                           pathname=None, reason=None, intr_ok=False,
-                          ignore_space=False):
+                          ignore_space=False, use_cache=False, checksum=None,
+                          rate_limit=None):
         # Lazy import requests to not require it on install
         import requests
         import urllib3.exceptions
 
+        # If use_cache is set, the request is made conditional on the
+        # validators (ETag, Last-Modified) of a previous download, and the
+        # cached body is used when the server says it hasn't changed.
+        # This only makes sense for whole files, so intr_ok disables it.
+        # If checksum is given, the downloaded file must have that SHA256
+        # checksum; if it doesn't, it is removed, and ChecksumFailException
+        # is raised.
+        # rate_limit caps the download rate (bytes per second, 0 for no
+        # limit); if it is None, the configured limit is used.
         AVATAR_VERSION = "X-%s-Manifest-Version" % Avatar()
+        if intr_ok:
+            use_cache = False
         current_sequence = "unknown"
         current_train = None
         current_version = None
@@ -596,11 +1143,14 @@ class Configuration(object):
             log.debug("Must specify at file xor url for TryGetNetworkFile")
             raise Exception("Bad use of TryGetNetworkFile again")
 
+        mirror_base = {}
         if file:
-            # If we're looking for a file in general, look in the update server and the master.
-            file_url = ["%s/%s" % (self.UpdateServerURL(), file)]
-            if self.UpdateServerURL() != self.UpdateServerMaster():
-                file_url.append("%s/%s" % (self.UpdateServerMaster(), file))
+            # If we're looking for a file in general, look in the update server
+            # and the master, as well as any mirrors, fastest first.
+            file_url = []
+            for base in self.MirrorURLs():
+                file_url.append("%s/%s" % (base, file))
+                mirror_base[file_url[-1]] = base
         elif url:
             file_url = [url]
         log.debug("TryGetNetworkFile(%s)" % file_url)
@@ -627,6 +1177,53 @@ class Configuration(object):
         except:
             pass
 
+        header_dict = {
+            "X-iXSystems-Project" : Avatar(),
+            "X-iXSystems-Version" : current_sequence,
+            "User-Agent" : "%s=%s" % (AVATAR_VERSION, current_version)
+        }
+        if current_version:
+            header_dict["X-iXSystems-Version-Name"] = current_version
+        if current_train:
+            header_dict["X-iXSystems-Train"] = current_train
+        if host_id:
+            header_dict["X-iXSystems-HostID"] = host_id
+        if reason:
+            header_dict["X-iXSystems-Reason"] = reason
+        if license_data:
+            header_dict["X-iXSystems-License"] = license_data
+
+        def OpenURL(url, offset=None, cache_meta=None, end=None):
+            headers = header_dict.copy()
+            # Allow restarting
+            if offset is not None:
+                headers["Range"] = "bytes=%d-%s" % (offset, "" if end is None else end)
+            if cache_meta:
+                if cache_meta.get("ETag"):
+                    headers["If-None-Match"] = cache_meta["ETag"]
+                if cache_meta.get("Last-Modified"):
+                    headers["If-Modified-Since"] = cache_meta["Last-Modified"]
+            furl = requests.get(url, timeout=10, verify=DEFAULT_CA_FILE,
+                                stream=True, headers=headers)
+            furl.raise_for_status()
+            return furl
+
+        if rate_limit is None:
+            rate_limit = self._download_rate
+        bucket = TokenBucket(rate_limit) if rate_limit else None
+        background = self._download_profile == PROFILE_BACKGROUND
+        if background:
+            BackgroundPriority()
+
+        if self._download_segments > 1 and not use_cache:
+            retval = self._SegmentedDownload(file_url, mirror_base, OpenURL,
+                                             handler=handler, pathname=pathname,
+                                             intr_ok=intr_ok, checksum=checksum,
+                                             ignore_space=ignore_space,
+                                             bucket=bucket)
+            if retval:
+                return retval
+
         read = 0
         retval = None
         try:
@@ -649,36 +1246,29 @@ class Configuration(object):
             furl = None
             for url in file_url:
                 url_exc = None
+                cache_meta = None
+                if use_cache:
+                    cache_meta = self._LoadHTTPCache(url)
+                    if cache_meta and self._http_cache_max_age > 0 and \
+                       time.time() - cache_meta.get("Fetched", 0) < self._http_cache_max_age:
+                        log.debug("TryGetNetworkFile(%s):  using cached copy" % url)
+                        self._CopyHTTPCache(url, retval)
+                        return retval
                 try:
-                    header_dict = {
-                        "X-iXSystems-Project" : Avatar(),
-                        "X-iXSystems-Version" : current_sequence,
-                        "User-Agent" : "%s=%s" % (AVATAR_VERSION, current_version)
-                    }
-                    if current_version:
-                        header_dict["X-iXSystems-Version-Name"] = current_version
-                    if current_train:
-                        header_dict["X-iXSystems-Train"] = current_train
-                    if host_id:
-                        header_dict["X-iXSystems-HostID"] = host_id
-                    if reason:
-                        header_dict["X-iXSystems-Reason"] = reason
-                    if license_data:
-                        header_dict["X-iXSystems-License"] = license_data
-
-                    # Allow restarting
-                    if intr_ok:
-                        header_dict["Range"] = "bytes=%d-" % read
-
-                    furl = requests.get(url, timeout=10, verify=DEFAULT_CA_FILE,
-                                       stream=True, headers=header_dict)
-                    furl.raise_for_status()
+                    furl = OpenURL(url, read if intr_ok else None, cache_meta)
+                    if cache_meta and furl.status_code == HTTP_NOT_MODIFIED.value:
+                        log.debug("TryGetNetworkFile(%s):  not modified, using cached copy" % url)
+                        furl.close()
+                        self._CopyHTTPCache(url, retval)
+                        self._TouchHTTPCache(url, cache_meta)
+                        return retval
                 except requests.exceptions.HTTPError as error:
                     if error.response.status_code == HTTP_RANGE.value:
                         # We've reached the end of the file already
                         # Can I get this incorrectly from any other server?
                         # Do I need to do something different for the progress handler?
                         retval.seek(0)
+                        self._VerifyDownload(retval, checksum, pathname)
                         return retval
                     elif error.response.status_code == HTTP_NOT_FOUND.value:
                         # The requested file is not found on this server.
@@ -688,9 +1278,13 @@ class Configuration(object):
                         log.error("Got http error %s" % str(error))
                         url_exc = Exceptions.UpdateNetworkServerException("Unable to load from url %s: %d" % (url, error.response.status_code))
                         url_exc = error
+                        if url in mirror_base:
+                            self.MirrorFailed(mirror_base[url])
                 except requests.exceptions.ConnectionError as e:
                     log.error("Unable to connect to url %s: %s" % (url, str(e)))
                     url_exc = Exceptions.UpdateNetworkConnectionException("Uable to connect to url %s" % url)
+                    if url in mirror_base:
+                        self.MirrorFailed(mirror_base[url])
                 except BaseException as e:
                     log.error("Unable to load %s: %s", url, str(e))
                     url_exc = e
@@ -728,50 +1322,240 @@ class Configuration(object):
                     # Hm, we don't distinguish between out of space, and zfs performance check
                     raise Exceptions.UpdateInsufficientSpace("Insufficient space")
 
+            # If the transfer breaks part way through, we carry on from
+            # where it stopped using the next server in the list.
+            remaining = file_url[file_url.index(url) + 1:]
+            # Data is read into one reusable buffer.  The amount asked for
+            # starts at 64k, and doubles (up to the buffer size) whenever a
+            # read fills it, so fast connections make fewer, larger reads.
             chunk_size = 64 * 1024
+            max_chunk = 1024 * 1024
+            if bucket:
+                # Don't read more than the bucket allows in one go.
+                max_chunk = min(max_chunk, bucket.burst)
+                chunk_size = min(chunk_size, max_chunk)
+            buffer = memoryview(bytearray(max_chunk))
             mbyte = 1024 * 1024
-            lastpercent = percent = 0
-            lasttime = time.time()
-            try:
-                while True:
-                    data = furl.raw.read(chunk_size)
-                    tmptime = time.time()
-                    if tmptime - lasttime > 0:
-                        downrate = int(chunk_size / (tmptime - lasttime))
-                    else:
-                        downrate = chunk_size
-                    lasttime = tmptime
-                    if not data:
-                        log.debug("TryGetNetworkFile(%s):  Read %d bytes total" % (file_url, read))
-                        break
-                    read += len(data)
-                    if ((read % mbyte) == 0):
-                        log.debug("TryGetNetworkFile(%s):  Read %d bytes" % (file_url, read))
-
-                    if handler and totalsize:
-                        percent = int((float(read) / float(totalsize)) * 100.0)
-                        if percent != lastpercent:
-                            handler(
-                                'network',
-                                url,
-                                size=totalsize,
-                                progress=percent,
-                                download_rate=downrate,
-                            )
-                        lastpercent = percent
-                    retval.write(data)
-            except Exception as e:
-                log.debug("Got exception %s" % str(e), exc_info=True)
-                if intr_ok is False and pathname:
-                    os.unlink(pathname)
-                raise e
+            next_log = (int(read / mbyte) + 1) * mbyte
+            progress = TransferProgress(handler, url, totalsize, read=read)
+            while True:
+                try:
+                    while True:
+                        count = furl.raw.readinto(buffer[:chunk_size])
+                        if not count:
+                            log.debug("TryGetNetworkFile(%s):  Read %d bytes total" % (file_url, read))
+                            break
+                        retval.write(buffer[:count])
+                        read += count
+                        progress.update(count)
+                        if bucket:
+                            bucket.consume(count)
+                        if count == chunk_size and chunk_size < max_chunk:
+                            chunk_size = min(chunk_size * 2, max_chunk)
+                        if read >= next_log:
+                            log.debug("TryGetNetworkFile(%s):  Read %d bytes" % (file_url, read))
+                            next_log = (int(read / mbyte) + 1) * mbyte
+                            if background and pathname:
+                                retval.flush()
+                                DropCachedPages(retval)
+                    if totalsize and read < totalsize:
+                        raise Exceptions.UpdateNetworkConnectionException(
+                            "Connection to %s closed after %d of %d bytes" % (url, read, totalsize))
+                    break
+                except Exception as e:
+                    furl.close()
+                    furl = None
+                    while furl is None and remaining:
+                        if url in mirror_base:
+                            self.MirrorFailed(mirror_base[url])
+                        url = remaining.pop(0)
+                        log.debug("TryGetNetworkFile:  transfer failed (%s), resuming at %d from %s" % (str(e), read, url))
+                        try:
+                            furl = OpenURL(url, read)
+                        except Exception as e2:
+                            log.debug("Unable to resume from %s: %s" % (url, str(e2)))
+                            furl = None
+                    if furl is None:
+                        log.debug("Got exception %s" % str(e), exc_info=True)
+                        if intr_ok is False and pathname:
+                            os.unlink(pathname)
+                        raise e
+                    if furl.status_code != HTTP_PARTIAL.value:
+                        # This server ignored the range, so start from the beginning.
+                        retval.seek(0)
+                        retval.truncate()
+                        read = 0
+                    try:
+                        totalsize = read + int(furl.headers['Content-Length'].strip())
+                    except:
+                        pass
+                    progress = TransferProgress(handler, url, totalsize, read=read)
             retval.seek(0)
+            if use_cache and (totalsize is None or read == totalsize):
+                self._StoreHTTPCache(url, furl.headers, retval)
+            self._VerifyDownload(retval, checksum, pathname)
         except:
             if retval:
                 retval.close()
             raise
         return retval
 
+    def _VerifyDownload(self, fobj, checksum, pathname=None):
+        if not checksum:
+            return
+        h = ChecksumFile(fobj)
+        if h != checksum:
+            log.debug("Checksum for %s doesn't match, removing file" % (pathname or "download"))
+            if pathname:
+                try:
+                    os.unlink(pathname)
+                except OSError:
+                    pass
+            raise Exceptions.ChecksumFailException("%s has invalid checksum" % (pathname or "download"))
+
+    def _SegmentedDownload(self, file_url, mirror_base, open_url, handler=None,
+                           pathname=None, intr_ok=False, checksum=None,
+                           ignore_space=False, bucket=None):
+        """
+        Fetch a file as several concurrent byte ranges, written in place
+        into a file preallocated to the full size.  If intr_ok is set,
+        the completed segments are recorded in a sidecar file next to
+        pathname, so an interrupted download only fetches the rest.
+        Returns None, without fetching anything, if the file is below
+        the segment threshold or the server can't do ranges; the caller
+        then uses a single stream.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        sidecar = pathname + SEGMENT_FILE_SUFFIX if pathname and intr_ok else None
+        state = None
+        if sidecar and os.path.exists(sidecar):
+            try:
+                with open(sidecar, "r") as f:
+                    state = json.load(f)
+                if os.path.getsize(pathname) != state["Size"]:
+                    state = None
+            except:
+                state = None
+        elif pathname and intr_ok and os.path.exists(pathname):
+            # A partial download from a single stream; let it resume that way.
+            return None
+
+        # Find out how large the file is, and whether ranges work,
+        # by asking for the first byte.
+        totalsize = None
+        for url in file_url:
+            try:
+                furl = open_url(url, 0, end=0)
+            except BaseException as e:
+                log.debug("_SegmentedDownload(%s):  %s" % (url, str(e)))
+                continue
+            try:
+                if furl.status_code == HTTP_PARTIAL.value:
+                    totalsize = int(furl.headers["Content-Range"].split("/")[1])
+            except:
+                totalsize = None
+            finally:
+                furl.close()
+            break
+        else:
+            return None
+        if totalsize is None:
+            log.debug("_SegmentedDownload(%s):  no range support, using one stream" % url)
+            return None
+        if state and state.get("Size") != totalsize:
+            state = None
+        if state is None and totalsize < max(self._download_threshold, 1):
+            return None
+
+        urls = file_url[file_url.index(url):] + file_url[:file_url.index(url)]
+        if state is None:
+            count = self._download_segments
+            seg_size = max(int(totalsize / count) + 1, 1024 * 1024)
+            segments = [[start, min(start + seg_size, totalsize) - 1] for start in range(0, totalsize, seg_size)]
+            state = {"Size": totalsize, "Segments": segments, "Done": [False] * len(segments)}
+            log.debug("_SegmentedDownload(%s):  %d bytes in %d segments" % (url, totalsize, len(segments)))
+        else:
+            log.debug("_SegmentedDownload(%s):  resuming, %d of %d segments done" %
+                      (url, state["Done"].count(True), len(state["Segments"])))
+
+        needed = sum(end + 1 - start for (start, end), done in zip(state["Segments"], state["Done"]) if not done)
+        if pathname and ignore_space is False:
+            if CheckFreeSpace(path=pathname, required=needed) is False:
+                raise Exceptions.UpdateInsufficientSpace("Insufficient space")
+
+        if pathname:
+            retval = open(pathname, "r+b" if os.path.exists(pathname) else "w+b")
+        else:
+            retval = tempfile.TemporaryFile(dir=self._temp)
+        retval.truncate(totalsize)
+        fd = retval.fileno()
+
+        lock = threading.Lock()
+        progress = TransferProgress(handler, url, totalsize, read=totalsize - needed)
+
+        def SaveState():
+            if sidecar:
+                with open(sidecar + ".tmp", "w") as f:
+                    json.dump(state, f)
+                os.rename(sidecar + ".tmp", sidecar)
+
+        def FetchSegment(index):
+            start, end = state["Segments"][index]
+            pos = start
+            seg_exc = None
+            for seg_url in urls:
+                try:
+                    furl = open_url(seg_url, pos, end=end)
+                    try:
+                        if furl.status_code != HTTP_PARTIAL.value:
+                            raise Exceptions.UpdateNetworkServerException(
+                                "%s ignored the byte range request" % seg_url)
+                        while pos <= end:
+                            data = furl.raw.read(min(64 * 1024, end + 1 - pos))
+                            if not data:
+                                break
+                            os.pwrite(fd, data, pos)
+                            pos += len(data)
+                            progress.update(len(data))
+                            if bucket:
+                                bucket.consume(len(data))
+                    finally:
+                        furl.close()
+                    if pos <= end:
+                        raise Exceptions.UpdateNetworkConnectionException(
+                            "Connection to %s closed at %d, expected %d" % (seg_url, pos, end + 1))
+                    with lock:
+                        state["Done"][index] = True
+                        SaveState()
+                    return
+                except BaseException as e:
+                    log.debug("_SegmentedDownload:  segment %d from %s failed at %d: %s" % (index, seg_url, pos, str(e)))
+                    seg_exc = e
+                    if seg_url in mirror_base:
+                        self.MirrorFailed(mirror_base[seg_url])
+            raise seg_exc
+
+        try:
+            SaveState()
+            todo = [i for i, done in enumerate(state["Done"]) if not done]
+            with ThreadPoolExecutor(max_workers=self._download_segments) as executor:
+                results = [executor.submit(FetchSegment, i) for i in todo]
+            for r in results:
+                r.result()
+            if sidecar:
+                os.unlink(sidecar)
+            if self._download_profile == PROFILE_BACKGROUND and pathname:
+                DropCachedPages(retval)
+            retval.seek(0)
+            self._VerifyDownload(retval, checksum, pathname)
+        except:
+            retval.close()
+            if pathname and not intr_ok and os.path.exists(pathname):
+                os.unlink(pathname)
+            raise
+        return retval
+
     # Load the list of currently-watched trains.
     # The file is a JSON file.
     # This sets self._trains as a dictionary of
@@ -792,6 +1576,10 @@ class Configuration(object):
                         temp.SetLastSequence(trains[train_name][TRAIN_SEQ_KEY])
                     if TRAIN_CHECKED_KEY in trains[train_name]:
                         temp.SetLastCheckedTime(trains[train_name][TRAIN_CHECKED_KEY])
+                    if TRAIN_NOTES_KEY in trains[train_name]:
+                        temp.SetNotes(trains[train_name][TRAIN_NOTES_KEY])
+                    if TRAIN_NOTICE_KEY in trains[train_name]:
+                        temp.SetNotice(trains[train_name][TRAIN_NOTICE_KEY])
                     self._trains[train_name] = temp
             except:
                 pass
@@ -800,17 +1588,51 @@ class Configuration(object):
             temp = Train.Train(sys_mani.Train(), "Installed OS", sys_mani.Sequence())
             self._trains[temp.Name()] = temp
         if updatecheck:
-            for train in self._trains:
-                new_man = self.FindLatestManifest(train.Name())
-                if new_man:
-                    if new_man.Sequence() != train.LastSequence():
-                        # We have an update
-                        train.SetLastSequence(new_man.Sequence())
-                        train.SetLastCheckedTime()
-                        train.SetNotes(new_man.Notes())
-                        train.SetNotice(new_man.Notice())
-                        train.SetUpdate(True)
-        return
+            self.CheckTrainsForUpdates()
+        return self._trains
+
+    def CheckTrainsForUpdates(self, trains=None, max_workers=8):
+        """
+        Fetch, and verify the signature of, the LATEST manifest for each
+        of the given trains (default:  all watched trains) at the same
+        time.  A train whose sequence has changed gets the new sequence,
+        notes and notice, and is marked as having an update.  The
+        trains are then saved with SaveTrainsConfig.  Returns a list of
+        the trains with updates.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if trains is None:
+            trains = list(self.WatchedTrains().values())
+        if not trains:
+            return []
+        # Load this before starting the threads, since they all use it.
+        self.SystemManifest()
+
+        def CheckTrain(train):
+            try:
+                return self.FindLatestManifest(train.Name(), require_signature=True)
+            except BaseException as e:
+                log.error("Could not check train %s for updates: %s" % (train.Name(), str(e)))
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(trains)))) as executor:
+            manifests = list(executor.map(CheckTrain, trains))
+
+        updated = []
+        for train, new_man in zip(trains, manifests):
+            if new_man is None:
+                continue
+            train.SetLastCheckedTime(str(int(time.time())))
+            if new_man.Sequence() != train.LastSequence():
+                # We have an update
+                train.SetLastSequence(new_man.Sequence())
+                train.SetNotes(new_man.Notes())
+                train.SetNotice(new_man.Notice())
+                train.SetUpdate(True)
+                updated.append(train)
+        self.SaveTrainsConfig()
+        return updated
 
     # Save the list of currently-watched trains.
     def SaveTrainsConfig(self):
@@ -832,6 +1654,10 @@ class Configuration(object):
                     temp[TRAIN_SEQ_KEY] = train.LastSequence()
                 if train.LastCheckedTime():
                     temp[TRAIN_CHECKED_KEY] = train.LastCheckedTime()
+                if train.Notes():
+                    temp[TRAIN_NOTES_KEY] = train.Notes()
+                if train.Notice():
+                    temp[TRAIN_NOTICE_KEY] = train.Notice()
                 obj[train_name] = temp
             train_path = self._temp + "/Trains.json"
             try:
@@ -867,6 +1693,27 @@ class Configuration(object):
             # We are using a different one
             cfp.add_section(CONFIG_DEFAULT)
             cfp.set(CONFIG_DEFAULT, CONFIG_SERVER, self._update_server_name)
+        if self._mirror_ttl != MIRROR_TTL:
+            if not cfp.has_section(CONFIG_DEFAULT):
+                cfp.add_section(CONFIG_DEFAULT)
+            cfp.set(CONFIG_DEFAULT, CONFIG_MIRROR_TTL, str(self._mirror_ttl))
+        if self._http_cache_enabled != Configuration._http_cache_enabled or \
+           self._http_cache_max_age != Configuration._http_cache_max_age or \
+           self._http_cache_dir is not None:
+            cfp.add_section(CONFIG_CACHE)
+            cfp.set(CONFIG_CACHE, CACHE_ENABLED_KEY, str(self._http_cache_enabled))
+            cfp.set(CONFIG_CACHE, CACHE_MAX_AGE_KEY, str(self._http_cache_max_age))
+            if self._http_cache_dir is not None:
+                cfp.set(CONFIG_CACHE, CACHE_DIRECTORY_KEY, self._http_cache_dir)
+        if self._download_segments != DOWNLOAD_SEGMENTS or \
+           self._download_threshold != DOWNLOAD_THRESHOLD or \
+           self._download_rate or \
+           self._download_profile != PROFILE_NORMAL:
+            cfp.add_section(CONFIG_DOWNLOAD)
+            cfp.set(CONFIG_DOWNLOAD, DOWNLOAD_SEGMENTS_KEY, str(self._download_segments))
+            cfp.set(CONFIG_DOWNLOAD, DOWNLOAD_THRESHOLD_KEY, str(self._download_threshold))
+            cfp.set(CONFIG_DOWNLOAD, DOWNLOAD_RATE_KEY, str(self._download_rate))
+            cfp.set(CONFIG_DOWNLOAD, DOWNLOAD_PROFILE_KEY, self._download_profile)
         for name, server in self._update_servers.items():
             if name == default_update_server.name:
                 # We don't write this one out
@@ -916,6 +1763,37 @@ class Configuration(object):
             if section == CONFIG_DEFAULT:
                 if cfp.has_option(CONFIG_DEFAULT, CONFIG_SERVER):
                     self._update_server_name = cfp.get(CONFIG_DEFAULT, CONFIG_SERVER)
+                if cfp.has_option(CONFIG_DEFAULT, CONFIG_MIRROR_TTL):
+                    try:
+                        self._mirror_ttl = cfp.getint(CONFIG_DEFAULT, CONFIG_MIRROR_TTL)
+                    except ValueError:
+                        log.error("Invalid %s value, using default" % CONFIG_MIRROR_TTL)
+            elif section == CONFIG_CACHE:
+                try:
+                    if cfp.has_option(section, CACHE_ENABLED_KEY):
+                        self._http_cache_enabled = cfp.getboolean(section, CACHE_ENABLED_KEY)
+                    if cfp.has_option(section, CACHE_MAX_AGE_KEY):
+                        self._http_cache_max_age = max(0, cfp.getint(section, CACHE_MAX_AGE_KEY))
+                    if cfp.has_option(section, CACHE_DIRECTORY_KEY):
+                        self._http_cache_dir = cfp.get(section, CACHE_DIRECTORY_KEY)
+                except ValueError:
+                    log.error("Invalid value in %s section, ignoring" % CONFIG_CACHE)
+            elif section == CONFIG_DOWNLOAD:
+                try:
+                    if cfp.has_option(section, DOWNLOAD_SEGMENTS_KEY):
+                        self._download_segments = max(1, cfp.getint(section, DOWNLOAD_SEGMENTS_KEY))
+                    if cfp.has_option(section, DOWNLOAD_THRESHOLD_KEY):
+                        self._download_threshold = max(0, cfp.getint(section, DOWNLOAD_THRESHOLD_KEY))
+                    if cfp.has_option(section, DOWNLOAD_RATE_KEY):
+                        self._download_rate = ParseRate(cfp.get(section, DOWNLOAD_RATE_KEY))
+                    if cfp.has_option(section, DOWNLOAD_PROFILE_KEY):
+                        profile = cfp.get(section, DOWNLOAD_PROFILE_KEY)
+                        if profile in (PROFILE_NORMAL, PROFILE_BACKGROUND):
+                            self._download_profile = profile
+                        else:
+                            log.error("Unknown download profile %s, ignoring" % profile)
+                except ValueError:
+                    log.error("Invalid value in %s section, ignoring" % CONFIG_DOWNLOAD)
             else:
                 if cfp.has_option(section, UPDATE_SERVER_NAME_KEY) and \
                    cfp.has_option(section, UPDATE_SERVER_URL_KEY):
@@ -926,8 +1804,10 @@ class Configuration(object):
                         if cfp.has_option(section, UPDATE_SERVER_SIGNED_KEY) else True
                     m = cfp.get(section, UPDATE_SERVER_MASTER_KEY) \
                         if cfp.has_option(section, UPDATE_SERVER_MASTER_KEY) else None
+                    mirror = cfp.get(section, UPDATE_SERVER_MIRROR_KEY) \
+                        if cfp.has_option(section, UPDATE_SERVER_MIRROR_KEY) else None
                     try:
-                        update_server = UpdateServer(name=n, url=u, signing=s, master=m)
+                        update_server = UpdateServer(name=n, url=u, signing=s, master=m, mirror=mirror)
                         self._update_servers[section] = update_server
                     except:
                         log.error("Cannot set update server to %s, using default", n)
@@ -1102,6 +1982,7 @@ class Configuration(object):
 
         mani_file = self.TryGetNetworkFile(url="%s/%s/LATEST" % (self.UpdateServerMaster(), train),
                                       reason="GetLatestManifest",
+                                      use_cache=True,
                                       )
         if mani_file is None:
             log.debug("Could not get latest manifest file for train %s" % train)
@@ -1137,100 +2018,145 @@ class Configuration(object):
                 handler=handler,
                 pathname=save_path,
                 reason="GetChangeLog",
+                use_cache=True,
             )
             return file
         except:
             log.debug("Could not get ChangeLog.txt, ignoring")
             return None
 
-    def FindPackageFile(self, package, upgrade_from=None, handler=None,
-                        save_dir=None, pkg_type=None, ignore_space=False):
-        # Given a package, and optionally a version to upgrade from, find
-        # the package file for it.  Returns a file-like
-        # object for the package file.
-        # If the package object has a checksum set, it
-        # attempts to verify the checksum; if it doesn't match,
-        # it goes onto the next one.
-        # If upgrade_from is set, it tries to find delta packages
-        # first, and will verify the checksum for that.  If the
-        # package does not have an upgrade field set, or it does
-        # but there's no checksum, then we are probably creating
-        # the manifest file, so we won't do the checksum verification --
-        # we'll only go by name.
-        # If it can't find one, it returns None
-
-        # We have at least one, and at most two, files
-        # to look for.
-        # The first file is the full package.
-
+    def PackageFilePlan(self, package, upgrade_from=None, save_dir=None, pkg_type=None):
+        """
+        Work out which files could provide package, and what each would
+        cost.  There is the full package, and a delta package if there is
+        one from the installed version (or upgrade_from, if given).  The
+        return value is a list of dictionaries, cheapest first, with keys:
+        Filename, Checksum, Delta, Reboot (delta only), FileSize (None if
+        the manifest doesn't say), Local (the path of a copy in the package
+        directory, or None), Cached (bytes of it already in save_dir, from
+        an earlier, perhaps interrupted, download), and Transfer (bytes
+        left to download, or None if unknown).
+
+        The cost is the number of bytes to download; a local copy costs
+        nothing.  Files of unknown size go after the ones with a known
+        cost.  Ties keep the old order:  local full, local delta, network
+        delta, network full.
+        """
         # Leave this local import here as otherwise it causes circular import issues
         from .Update import PkgFileDeltaOnly, PkgFileFullOnly
         package_files = []
         if pkg_type is not PkgFileDeltaOnly:
-            package_files.append({"Filename": package.FileName(), "Checksum": package.Checksum()})
+            package_files.append({
+                "Filename": package.FileName(),
+                "Checksum": package.Checksum(),
+                "Delta": False,
+                Package.SIZE_KEY: package.Size(),
+            })
         # The next one is the delta package, if it exists.
         # For that, we look through package.Updates(), looking for one that
         # has the same version as what is currently installed.
         # So first we have to get the current version.
         if pkg_type is not PkgFileFullOnly:
             try:
-                pkgdb = self.PackageDB(create=False)
-                if pkgdb:
-                    pkgInfo = pkgdb.FindPackage(package.Name())
-                    if pkgInfo:
-                        curVers = pkgInfo[package.Name()]
-                        if curVers and curVers != package.Version():
-                            upgrade = package.Update(curVers)
-                            if upgrade:
-                                tdict = {
-                                    "Filename": package.FileName(curVers),
-                                    "Checksum": None,
-                                    "Reboot": upgrade.RequiresReboot(),
-                                    "Delta": True,
-                                }
-                                if upgrade.Checksum():
-                                    tdict[Package.CHECKSUM_KEY] = upgrade.Checksum()
-                                if upgrade.Size():
-                                    tdict[Package.SIZE_KEY] = upgrade.Size()
-                                package_files.append(tdict)
+                curVers = upgrade_from
+                if curVers is None:
+                    pkgdb = self.PackageDB(create=False)
+                    if pkgdb:
+                        pkgInfo = pkgdb.FindPackage(package.Name())
+                        if pkgInfo:
+                            curVers = pkgInfo[package.Name()]
+                if curVers and curVers != package.Version():
+                    upgrade = package.Update(curVers)
+                    if upgrade:
+                        package_files.append({
+                            "Filename": package.FileName(curVers),
+                            "Checksum": upgrade.Checksum(),
+                            "Reboot": upgrade.RequiresReboot(),
+                            "Delta": True,
+                            Package.SIZE_KEY: upgrade.Size(),
+                        })
             except:
                 # No update packge that matches.
                 pass
 
-        # At this point, package_files now has at least one element.
-        # We want to search in this order:
-        # * Local full copy
-        # * Local delta copy
-        # * Network delta copy
-        # * Network full copy
+        for search_attempt in package_files:
+            size = search_attempt[Package.SIZE_KEY]
+            search_attempt["Local"] = None
+            search_attempt["Cached"] = 0
+            if self._package_dir:
+                p = "{0}/{1}".format(self._package_dir, search_attempt["Filename"])
+                if os.path.exists(p):
+                    search_attempt["Local"] = p
+            if save_dir:
+                search_attempt["Cached"] = DownloadedBytes(os.path.join(save_dir, search_attempt["Filename"]))
+            if search_attempt["Local"]:
+                search_attempt["Transfer"] = 0
+            elif size is None:
+                search_attempt["Transfer"] = None
+            else:
+                search_attempt["Transfer"] = max(0, int(size) - search_attempt["Cached"])
+
+        def Cost(search_attempt):
+            transfer = search_attempt["Transfer"]
+            if search_attempt["Local"]:
+                order = 1 if search_attempt["Delta"] else 0
+            else:
+                order = 2 if search_attempt["Delta"] else 3
+            return (transfer is None, transfer or 0, order)
+
+        return sorted(package_files, key=Cost)
+
+    def FindPackageFile(self, package, upgrade_from=None, handler=None,
+                        save_dir=None, pkg_type=None, ignore_space=False,
+                        rate_limit=None):
+        # Given a package, and optionally a version to upgrade from, find
+        # the package file for it.  Returns a file-like
+        # object for the package file.
+        # If the package object has a checksum set, it
+        # attempts to verify the checksum; if it doesn't match,
+        # it goes onto the next one.
+        # The full and delta package files are tried cheapest first,
+        # as ordered by PackageFilePlan(); a copy in the package directory
+        # costs nothing, otherwise the cost is the number of bytes left
+        # to download.  If the package does not have an upgrade field set,
+        # or it does but there's no checksum, then we are probably creating
+        # the manifest file, so we won't do the checksum verification --
+        # we'll only go by name.
+        # If it can't find one, it returns None
+
+        plan = self.PackageFilePlan(package, upgrade_from=upgrade_from,
+                                    save_dir=save_dir, pkg_type=pkg_type)
 
-        # We want to look for each one in _package_dir and off the network.
         # If we find it, and the checksum matches, we're good to go.
-        # If not, we have to grab it off the network and use that.  We can't
-        # check that checksum until we get it.
+        # If not, we have to grab it off the network and use that.
+        # Any local copies are checksummed together up front.
+        local_sums = Checksum.ChecksumFiles(
+            [entry["Local"] for entry in plan if entry["Local"] and entry["Checksum"]]
+        )
         pkg_exception = None
-        for search_attempt in package_files:
-            # First try the local copy.
-            log.debug("Searching for %s" % search_attempt["Filename"])
-            try:
-                if self._package_dir:
-                    p = "{0}/{1}".format(self._package_dir, search_attempt["Filename"])
-                    if os.path.exists(p):
-                        file = open(p, 'rb')
-                        log.debug("Found package file %s" % p)
-                        if search_attempt["Checksum"]:
-                            h = ChecksumFile(file)
-                            if h == search_attempt["Checksum"]:
-                                return file
-                            else:
-                                pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(search_attempt["Filename"]))
-                        else:
-                            # No checksum for the file, so we'll just go with it.
+        file = None
+        for search_attempt in plan:
+            log.debug("Searching for %s (%s bytes to transfer)" % (search_attempt["Filename"], search_attempt["Transfer"]))
+            if search_attempt["Local"]:
+                try:
+                    p = search_attempt["Local"]
+                    file = open(p, 'rb')
+                    log.debug("Found package file %s" % p)
+                    if search_attempt["Checksum"]:
+                        h = local_sums.get(p) or ChecksumFile(file)
+                        if h == search_attempt["Checksum"]:
                             return file
-            except:
-                pass
+                        else:
+                            pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(search_attempt["Filename"]))
+                    else:
+                        # No checksum for the file, so we'll just go with it.
+                        return file
+                except:
+                    pass
+                # The local copy is no good, so try the network for it last.
+                plan.append(dict(search_attempt, Local=None))
+                continue
 
-        for search_attempt in reversed(package_files):
             # Next we try to get it from the network.
             pFile = "Packages/%s" % search_attempt["Filename"]
             save_name = None
@@ -1239,33 +2165,27 @@ class Configuration(object):
 
             try:
                 file = None
+                # TryGetNetworkFile checks the checksum, and removes
+                # the file if it doesn't match.
                 file = self.TryGetNetworkFile(
                     file=pFile,
                     handler=handler,
                     pathname=save_name,
                     reason="DownloadPackageFile",
                     intr_ok=True,
-                    ignore_space=ignore_space
+                    ignore_space=ignore_space,
+                    checksum=search_attempt["Checksum"],
+                    rate_limit=rate_limit
                 )
+            except Exceptions.ChecksumFailException:
+                pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(pFile))
+                continue
             except BaseException as e:
                 log.debug("Trying to get %s, got exception %s, continuing" % (pFile, str(e)))
                 continue
 
             if file:
-                if search_attempt["Checksum"]:
-                    h = ChecksumFile(file)
-                    if h == search_attempt["Checksum"]:
-                        return file
-                    else:
-                        # For an interrupted download of a package file,
-                        # this won't be reached due to an exception.
-                        log.debug("Checksum doesn't match, removing file")
-                        if save_name:
-                            os.unlink(save_name)
-                        pkg_exception = Exceptions.ChecksumFailException("%{0} has invalid checksum".format(pFile))
-                else:
-                    # No checksum for the file, so we just go with it
-                    return file
+                return file
 
         if file:
             file.close()
@@ -1347,10 +2267,12 @@ def check_ftype(objs):
     return ed, pd
 
 
-def do_verify(verify_handler=None):
+def do_verify(verify_handler=None, workers=None):
     """
     A function that goes through the provided pkgdb filelist and verifies it with
     the current root filesystem.
+    Files are checksummed in batches, workers (default Checksum.Workers())
+    at a time.
     """
 
     error_flag = False
@@ -1369,7 +2291,23 @@ def do_verify(verify_handler=None):
     filelist = pkgdb.FindFilesForPackage()
     total_files = len(filelist)
 
+    def HashedFile(objs):
+        return objs["kind"] == "file" and \
+            objs["checksum"] and objs["checksum"] != "-" and \
+            not objs["path"].endswith(".pyc") and \
+            not is_ignore_path(objs["path"])
+
+    batch_size = (workers or Checksum.Workers()) * 64
+    file_sums = {}
     for objs in filelist:
+        if i % batch_size == 0:
+            # Checksum the files in the next batch together.  They're
+            # live files, which may be rewritten, so they aren't mapped.
+            file_sums = Checksum.ChecksumFiles(
+                [o["path"] for o in filelist[i:i + batch_size] if HashedFile(o)],
+                workers=workers,
+                mapped=False
+            )
         i = i+1
         if verify_handler is not None:
             verify_handler(i, total_files, objs["path"])
@@ -1406,15 +2344,16 @@ def do_verify(verify_handler=None):
         if objs["kind"] == "file":
             if objs["path"].endswith(".pyc"):
                 continue
-            with open(objs["path"], 'rb') as f:
-                tmp = f.read()
+            digest = file_sums.get(objs["path"])
+        else:
+            digest = hashlib.sha256(tmp).hexdigest()
 
         # Do this last (as it needs to be done for all, but dirs, as dirs have no checksum d'oh!)
         if (
             objs["kind"] != 'dir' and
             objs["checksum"] and
             objs["checksum"] != "-" and
-            hashlib.sha256(tmp).hexdigest() != objs["checksum"]
+            digest != objs["checksum"]
            ):
             error_flag = True
             error_list['checksum'].append(dict([
@@ -9,7 +9,7 @@ import hashlib
 import logging
 import tempfile
 import subprocess
-from . import modified_call
+from . import modified_call, Timeline
 
 debug = 0
 verbose = False
@@ -339,7 +339,8 @@ def RunPkgScript(scripts, type, root=None, **kwargs):
         script_env = os.environ.copy()
         if "PKG_PREFIX" in kwargs and kwargs["PKG_PREFIX"] is not None:
                 script_env["PKG_PREFIX"] = kwargs["PKG_PREFIX"]
-        status = modified_call(args, log, preexec_fn=prefunc, env=script_env)
+        with Timeline.StartSpan("RunPkgScript", Script=scriptName):
+            status = modified_call(args, log, preexec_fn=prefunc, env=script_env)
         if status != 0:
             # Should I raise an exception?
             log.error("Sub procss exited with status %#x" % status)
@@ -854,14 +855,15 @@ def install_file(pkgfile, dest, **kwargs):
                     **kwargs
                 )
 
-    if pkgDeltaVersion is not None:
-        if pkgdb.UpdatePackage(pkgName, pkgDeltaVersion, pkgVersion, pkgScripts) == False:
-            log.error("Could not update package from %s to %s in database" % (pkgDeltaVersion, pkgVersion))
+    with Timeline.StartSpan("PackageDB", Package=pkgName):
+        if pkgDeltaVersion is not None:
+            if pkgdb.UpdatePackage(pkgName, pkgDeltaVersion, pkgVersion, pkgScripts) == False:
+                log.error("Could not update package from %s to %s in database" % (pkgDeltaVersion, pkgVersion))
+                return False
+            log.debug("Updated package %s from %s to %s in database" % (pkgName, pkgDeltaVersion, pkgVersion))
+        elif pkgdb.AddPackage(pkgName, pkgVersion, pkgScripts) == False:
+            log.debug("Could not add package %s to database" % pkgName)
             return False
-        log.debug("Updated package %s from %s to %s in database" % (pkgName, pkgDeltaVersion, pkgVersion))
-    elif pkgdb.AddPackage(pkgName, pkgVersion, pkgScripts) == False:
-        log.debug("Could not add package %s to database" % pkgName)
-        return False
 
     # Is this correct behaviour for delta packages?
     if upgrade_aware is False:
@@ -875,48 +877,51 @@ def install_file(pkgfile, dest, **kwargs):
     # Go through the tarfile, looking for entries in the manifest list.
     pkgFiles = []
     progress_count = 0
-    while member is not None:
-        # To figure out the hash, we need to look
-        # at <file>, <prefix + file>, and both of those
-        # with and without a leading "/".  (Why?  Because
-        # the manifest may have relative or absolute paths,
-        # and tar may remove a leading slash to make us secure.)
-        # We also have to look in the directories hash
-        # print >> sys.stderr, "member = %s, prefix = %s" % (member.name, prefix)
-        mFileHash = "-"
-        if member.name in mfiles:
-            mFileHash = mfiles[member.name]
-        elif member.name.startswith("/") == False and ("/" + member.name) in mfiles:
-            mFileHash = mfiles["/" + member.name]
-        elif prefix + member.name in mfiles:
-            mFileHash = mfiles[prefix + member.name]
-        elif (prefix + member.name).startswith("/") == False:
-            if "/" + prefix + member.name in mfiles:
-                mFileHash = mfiles["/" + prefix + member.name]
-        else:
-            # If it's not in the manifest, then ignore it
-            # It may be a directory, however, so let's check
-            if EntryInDictionary(member.name, mdirs, prefix) == False:
-                # If we don't skip it, we infinite loop.  That's bad.
-                member = t.next()
-                continue
-        if pkgDeltaVersion is not None:
-            if verbose or debug:
-                log.debug("Extracting %s from delta package" % member.name)
-        list = ExtractEntry(t, member, dest, prefix, mFileHash)
-        if list is not None:
-            pkgFiles.append((pkgName,) + list)
-        progress_count += 1
-        try:
-            progress(index=progress_count, total=len(mfiles)+len(mdirs), name=member.name)
-        except:
-            log.debug("Got an exception calling the progress handler", exc_info=True)
-        member = t.next()
+    with Timeline.StartSpan("Extract", Package=pkgName) as extract:
+        while member is not None:
+            # To figure out the hash, we need to look
+            # at <file>, <prefix + file>, and both of those
+            # with and without a leading "/".  (Why?  Because
+            # the manifest may have relative or absolute paths,
+            # and tar may remove a leading slash to make us secure.)
+            # We also have to look in the directories hash
+            # print >> sys.stderr, "member = %s, prefix = %s" % (member.name, prefix)
+            mFileHash = "-"
+            if member.name in mfiles:
+                mFileHash = mfiles[member.name]
+            elif member.name.startswith("/") == False and ("/" + member.name) in mfiles:
+                mFileHash = mfiles["/" + member.name]
+            elif prefix + member.name in mfiles:
+                mFileHash = mfiles[prefix + member.name]
+            elif (prefix + member.name).startswith("/") == False:
+                if "/" + prefix + member.name in mfiles:
+                    mFileHash = mfiles["/" + prefix + member.name]
+            else:
+                # If it's not in the manifest, then ignore it
+                # It may be a directory, however, so let's check
+                if EntryInDictionary(member.name, mdirs, prefix) == False:
+                    # If we don't skip it, we infinite loop.  That's bad.
+                    member = t.next()
+                    continue
+            if pkgDeltaVersion is not None:
+                if verbose or debug:
+                    log.debug("Extracting %s from delta package" % member.name)
+            list = ExtractEntry(t, member, dest, prefix, mFileHash)
+            if list is not None:
+                pkgFiles.append((pkgName,) + list)
+            extract.Add(Files=1, Bytes=member.size)
+            progress_count += 1
+            try:
+                progress(index=progress_count, total=len(mfiles)+len(mdirs), name=member.name)
+            except:
+                log.debug("Got an exception calling the progress handler", exc_info=True)
+            member = t.next()
 
     t.close()
 
     if len(pkgFiles) > 0:
-        pkgdb.AddFilesBulk(pkgFiles)
+        with Timeline.StartSpan("PackageDB", Package=pkgName, Files=len(pkgFiles)):
+            pkgdb.AddFilesBulk(pkgFiles)
 
     if upgrade_aware:
         RunPkgScript(pkgScripts,
@@ -1077,15 +1082,28 @@ class Installer(object):
         # ready for installation
         return True
 
+    def InstallPackage(self, pkgname, pkgfile, progressFunc=None):
+        # Install a single package file, which doesn't have to
+        # have come from GetPackages().
+        with Timeline.StartSpan("InstallPackage", Package=pkgname) as span:
+            try:
+                span.Add(Bytes=os.fstat(pkgfile.fileno()).st_size)
+            except (AttributeError, OSError):
+                pass
+            if install_file(pkgfile, self._root,
+                            progress=progressFunc,
+                            trampoline=self.trampoline) is False:
+                log.error("Unable to install package %s" % pkgname)
+                return False
+        return True
+
+    @Timeline.Timed("InstallPackages", failure=False)
     def InstallPackages(self, progressFunc=None, handler=None):
         for i, pkg in enumerate(self._packages):
             for pkgname in pkg:
                 log.debug("Installing package %s" % pkg)
                 if handler is not None:
                     handler(index=i + 1, name=pkgname, packages=self._packages)
-                if install_file(pkg[pkgname], self._root,
-                                progress=progressFunc,
-                                trampoline=self.trampoline) is False:
-                    log.error("Unable to install package %s" % pkgname)
+                if self.InstallPackage(pkgname, pkg[pkgname], progressFunc=progressFunc) is False:
                     return False
         return True
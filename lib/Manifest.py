@@ -1,10 +1,14 @@
 from __future__ import print_function
+import codecs
 import os
+import hashlib
 import json
 import logging
 import re
+import threading
+import time
 
-from . import Exceptions, Package
+from . import Exceptions, Package, Timeline
 
 log = logging.getLogger('freenasOS.Manifest')
 
@@ -15,6 +19,10 @@ VALIDATE_INSTALL = "ValidateInstall"
 # Where validation programs go (on the update server)
 VALIDATION_DIR = "Validators"
 
+# A successful validation run is recorded in the cache directory,
+# next to the program, in a file with this suffix.
+VALIDATION_RESULT_SUFFIX = ".passed"
+
 SYSTEM_MANIFEST_FILE = "/data/manifest"
 
 # The keys are as follows:
@@ -83,6 +91,371 @@ class ChecksumFailException(Exception):
     pass
 
 
+# How long (in seconds) the verification store, and the CRL in it,
+# are used before being loaded again.
+VERIFIER_TTL = 60 * 60
+
+
+class SignatureVerifier(object):
+    """
+    Verifies manifest signatures, keeping what it can between calls:
+    the X509 store (the iX root CA and the CRL) for up to ttl seconds,
+    the parsed certificates of each certificate file until the file
+    changes, and the result for each manifest.  Results are keyed by
+    a digest of the manifest's canonical form, its signature, and the
+    certificate file and its mtime, and are dropped whenever the
+    store is reloaded.
+    The same manifest loaded several times is only verified once.
+    """
+
+    def __init__(self, ttl=VERIFIER_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self.Reset()
+
+    def Reset(self):
+        self._store = None
+        self._store_time = 0
+        self._certs = {}
+        self._results = {}
+
+    def Store(self, config):
+        """
+        Return the X509 store, building it if it is missing
+        or older than the TTL.  Returns None if the root CA
+        can't be loaded.
+        """
+        from . import IX_ROOT_CA_FILE, IX_CRL
+        import OpenSSL.crypto as Crypto
+
+        if self._store and time.time() - self._store_time < self.ttl:
+            return self._store
+
+        store = Crypto.X509Store()
+        store.set_flags(Crypto.X509StoreFlags.CRL_CHECK)
+        # Load our root CA
+        try:
+            with open(IX_ROOT_CA_FILE, "r") as f:
+                root_ca = Crypto.load_certificate(Crypto.FILETYPE_PEM, f.read())
+                store.add_cert(root_ca)
+        except:
+            log.debug("VerifySignature:  Could not load iX root CA", exc_info=True)
+            return None
+
+        # Now need to get the CRL
+        try:
+            crl_file = config.TryGetNetworkFile(
+                url=IX_CRL,
+                reason="FetchCRL",
+                use_cache=True,
+            )
+            if not crl_file:
+                # TGNF will raise an exception in most cases.
+                raise Exception("Could not get CRL file")
+        except:
+            log.error("Could not get CRL file %s" % IX_CRL)
+            crl_file = None
+
+        if crl_file:
+            try:
+                crl = Crypto.load_crl(Crypto.FILETYPE_PEM, crl_file.read())
+                store.add_crl(crl)
+            except:
+                log.debug("Could not load CRL, ignoring for now", exc_info=True)
+            crl_file.close()
+
+        self._store = store
+        self._store_time = time.time()
+        self._results = {}
+        return store
+
+    def Certificates(self, cert_file):
+        """
+        Return the parsed certificates in cert_file, or None.
+        """
+        import OpenSSL.crypto as Crypto
+
+        try:
+            mtime = os.stat(cert_file).st_mtime
+        except OSError:
+            return None
+        if cert_file in self._certs and self._certs[cert_file][0] == mtime:
+            return self._certs[cert_file][1]
+        try:
+            with open(cert_file, "r") as f:
+                regexp = r'-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----'
+                certs = re.findall(regexp, f.read(), re.DOTALL)
+        except:
+            log.error("Could not load certificates", exc_info=True)
+            return None
+        parsed = []
+        for cert in certs:
+            try:
+                parsed.append(Crypto.load_certificate(Crypto.FILETYPE_PEM, cert))
+            except:
+                # For now, just ignore
+                pass
+        self._certs[cert_file] = (mtime, parsed)
+        return parsed
+
+    @Timeline.Timed("VerifySignature")
+    def Verify(self, manifest):
+        from . import IX_ROOT_CA_FILE
+        from base64 import b64decode
+        import OpenSSL.crypto as Crypto
+
+        try:
+            cert_file = VerificationCertificateFile(manifest)
+        except ValueError:
+            cert_file = None
+
+        if not os.path.isfile(IX_ROOT_CA_FILE) \
+           or cert_file is None \
+           or not os.path.isfile(cert_file):
+            log.debug("VerifySignature:  Cannot find a required file")
+            return False
+
+        # Almost done:  we need the signature as binary data
+        try:
+            signature = b64decode(manifest.Signature())
+        except:
+            log.error("Could not decode signature", exc_info=True)
+            return False
+
+        canonical = manifest.UnsignedString()
+
+        with self._lock:
+            if self.Store(manifest._config) is None:
+                return False
+            # This reloads the certificates if the file has changed,
+            # and its mtime goes in the key, so that results using
+            # the old certificates aren't used.
+            certs = self.Certificates(cert_file)
+            if certs is None:
+                return False
+            key = hashlib.sha256()
+            for part in (canonical.encode('utf8'), signature, cert_file.encode('utf8'),
+                         repr(self._certs[cert_file][0]).encode('utf8')):
+                key.update(hashlib.sha256(part).digest())
+            key = key.hexdigest()
+            if key in self._results:
+                log.debug("VerifySignature:  using cached result")
+                return self._results[key]
+
+            verified = False
+            for test_cert in certs:
+                try:
+                    Crypto.verify(test_cert, signature, canonical, "sha256")
+                    verified = True
+                    break
+                except:
+                    # For now, just ignore
+                    pass
+            self._results[key] = verified
+            return verified
+
+
+_system_verifier = None
+def SystemVerifier():
+    global _system_verifier
+    if _system_verifier is None:
+        _system_verifier = SignatureVerifier()
+    return _system_verifier
+
+
+def ValidationStamp(prog_path, checksum, old_sequence, new_sequence):
+    """
+    What a validation run depends on:  the program (its checksum, and the
+    size and modification time of the file, so that it doesn't have to be
+    hashed again), and the sequences being updated from and to.
+    Returns None if the program isn't there.
+    """
+    try:
+        st = os.stat(prog_path)
+    except OSError:
+        return None
+    return {
+        "Checksum": checksum,
+        "Size": st.st_size,
+        "Modified": st.st_mtime,
+        "CurrentSequence": old_sequence,
+        "NewSequence": new_sequence,
+    }
+
+
+class ManifestReader(object):
+    """
+    Parse a manifest from a file-like object as it is read, rather
+    than reading it all and then parsing it.  Iterating over it
+    yields (key, value) for each top-level key, except that the
+    packages are yielded one at a time, as (PACKAGES_KEY, dict).
+    Only the current value, and one chunk of the file, are held.
+    Raises ManifestInvalidException if the file isn't a JSON object.
+
+    Top-level keys in required have to be present (and packages
+    non-empty).  If ordered is set, the keys are expected to be
+    sorted, as MakeString() writes them, so a missing one is
+    noticed as soon as a later key shows up, rather than at the
+    end.  (A manifest that wasn't written that way may then be
+    rejected even though it has all of the keys.)
+    """
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    # A separator between packages, and the whitespace around it
+    _separator = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+    # How much of the buffer is left when it's topped up
+    _low_water = 4096
+
+    def __init__(self, file, chunk_size=64 * 1024, required=None, ordered=False):
+        self._file = file
+        self._required = required or ()
+        self._ordered = ordered
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf8')()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _Fill(self):
+        # Read another chunk, dropping what has been parsed.
+        # Returns False at the end of the file.
+        if self._eof:
+            return False
+        data = self._file.read(self._chunk_size)
+        if not data:
+            self._eof = True
+        if isinstance(data, bytes):
+            data = self._utf8.decode(data, final=self._eof)
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _Next(self):
+        # Skip whitespace, and return the next character (or None at the end)
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._Fill():
+                return None
+
+    def _Expect(self, chars):
+        c = self._Next()
+        if c is None or c not in chars:
+            raise Exceptions.ManifestInvalidException("Expected %s in manifest, got %s" % (" or ".join(chars), c))
+        self._pos += 1
+        return c
+
+    def _Value(self):
+        if self._pos >= len(self._buf) or self._buf[self._pos] in " \t\n\r":
+            self._Next()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError as e:
+                if self._Fill():
+                    continue
+                raise Exceptions.ManifestInvalidException("Invalid manifest: %s" % str(e))
+            if end == len(self._buf) and self._Fill():
+                # A number may continue in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def _Packages(self):
+        # Yield the packages, from the first one up to the closing ].
+        # This is most of a manifest, so packages in the buffer are
+        # decoded without going through _Value() and _Expect().  The
+        # buffer is topped up before it runs low, since a package cut
+        # off at the end of it is slow to fail to decode.
+        decode = self._decoder.raw_decode
+        separator = self._separator.match
+        while True:
+            if not self._eof and len(self._buf) - self._pos <= self._low_water:
+                self._Fill()
+                continue
+            buf = self._buf
+            pos = self._pos
+            stop = len(buf) if self._eof else len(buf) - self._low_water
+            while pos < stop:
+                try:
+                    value, end = decode(buf, pos)
+                except ValueError:
+                    break
+                m = separator(buf, end)
+                if m is None or m.end() == len(buf):
+                    break
+                self._pos = pos = m.end()
+                yield value
+                if m.group(1) == "]":
+                    return
+            if pos < stop or self._eof:
+                # An unusually large package, or a bad manifest
+                yield self._Value()
+                if self._Expect(",]") == "]":
+                    return
+                self._Next()
+
+    def _Missing(self, key):
+        if key == PACKAGES_KEY:
+            return Exceptions.ManifestInvalidException("No packages")
+        return Exceptions.ManifestInvalidException("%s is not set" % key)
+
+    def __iter__(self):
+        missing = set(self._required)
+        last = "" if self._ordered else None
+        self._Expect("{")
+        if self._Next() == "}":
+            self._pos += 1
+        else:
+            while True:
+                key = self._Value()
+                if not isinstance(key, str):
+                    raise Exceptions.ManifestInvalidException("Invalid manifest key %s" % key)
+                missing.discard(key)
+                if last is not None:
+                    if key < last:
+                        # Not sorted, so this has to wait for the end
+                        last = None
+                    else:
+                        last = key
+                        early = [k for k in missing if k < key]
+                        if early:
+                            raise self._Missing(min(early))
+                self._Expect(":")
+                if key == PACKAGES_KEY:
+                    self._Expect("[")
+                    if self._Next() == "]":
+                        self._pos += 1
+                        if key in self._required:
+                            raise self._Missing(key)
+                    else:
+                        for package in self._Packages():
+                            yield (key, package)
+                else:
+                    yield (key, self._Value())
+                if self._Expect(",}") == "}":
+                    break
+        if missing:
+            raise self._Missing(min(missing))
+
+
+REQUIRED_KEYS = (PACKAGES_KEY, SEQUENCE_KEY, TRAIN_KEY)
+
+
+def ManifestPackages(path):
+    """
+    Yield the packages in the manifest at path, as Package objects,
+    one at a time, without loading the whole manifest; see
+    ManifestReader.  The manifest isn't validated beyond having
+    the required keys, and its signature isn't checked.
+    """
+    with open(path, "rb") as f:
+        for key, value in ManifestReader(f, required=REQUIRED_KEYS, ordered=True):
+            if key == PACKAGES_KEY:
+                yield Package.Package(value)
+
+
 def MakeString(obj):
     retval = json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': '), cls=ManifestEncoder)
     return retval
@@ -104,29 +477,26 @@ def DiffManifests(m1, m2):
     """
     return_diffs = {}
 
-    def DiffPackages(old_packages, new_packages):
+    def DiffPackages(old_manifest, new_manifest):
         retval = []
-        old_list = {}
-        for P in old_packages:
-            old_list[P.Name()] = P
-
-        for P in new_packages:
-            if P.Name() in old_list:
+        for P in new_manifest.Packages():
+            old = old_manifest.Package(P.Name())
+            if old is not None:
                 # Either it's the same version, or a new version
-                if old_list[P.Name()].Version() != P.Version():
-                    retval.append((P, "upgrade", old_list[P.Name()]))
-                old_list.pop(P.Name())
+                if old.Version() != P.Version():
+                    retval.append((P, "upgrade", old))
             else:
                 retval.append((P, "install", None))
 
-        for P in old_list.values():
-            retval.insert(0, (P, "delete", None))
+        for P in old_manifest.Packages():
+            if new_manifest.Package(P.Name()) is None:
+                retval.insert(0, (P, "delete", None))
 
         return retval
 
     # First thing, let's compare the packages
     # This will go into the Packages key, if it's non-empty.
-    package_diffs = DiffPackages(m1.Packages(), m2.Packages())
+    package_diffs = DiffPackages(m1, m2)
     if len(package_diffs) > 0:
         return_diffs["Packages"] = package_diffs
         # Now let's see if we need to do a reboot
@@ -205,6 +575,13 @@ class Manifest(object):
     _switch = None
     _timestamp = None
     _requireSignature = False
+    # Cached canonical serializations, with and without the
+    # signature.  Both are dropped whenever the manifest changes.
+    _canonical = None
+    _unsigned = None
+    # Package objects for the manifest, and an index by name.
+    # Built when first needed, and dropped when the packages change.
+    _package_index = None
 
     def __init__(self, configuration=None, require_signature=False):
         if configuration is None:
@@ -217,11 +594,47 @@ class Manifest(object):
         return
 
     def dict(self):
+        # The caller may change the dictionary, so
+        # the cached serializations and packages can't be trusted after this.
+        self.Changed()
+        self.PackagesChanged()
         return self._dict
 
+    def Changed(self):
+        """
+        Mark the manifest as modified, dropping the cached
+        serializations.  The setters call this; anything that
+        changes the manifest's data by other means (such as a
+        Package object that was added) needs to call it as well.
+        """
+        self._canonical = None
+        self._unsigned = None
+
+    def PackagesChanged(self):
+        """
+        Drop the cached Package objects.
+        """
+        self._packages = None
+        self._package_index = None
+
     def String(self):
-        retval = MakeString(self.dict())
-        return retval
+        if self._canonical is None:
+            self._canonical = MakeString(self._dict)
+        return self._canonical
+
+    def UnsignedString(self):
+        """
+        The canonical form of the manifest without its signature;
+        this is what is signed and verified.
+        """
+        if self._unsigned is None:
+            if SIGNATURE_KEY in self._dict:
+                tdata = self._dict.copy()
+                tdata.pop(SIGNATURE_KEY)
+                self._unsigned = MakeString(tdata)
+            else:
+                self._unsigned = self.String()
+        return self._unsigned
 
     def LoadFile(self, file):
         # Load a manifest from a file-like object.
@@ -230,6 +643,31 @@ class Manifest(object):
             self._dict = json.loads(file.read().decode('utf8'))
         else:
             self._dict = json.loads(file.read())
+        self.Changed()
+        self.PackagesChanged()
+
+        self.Validate()
+        return
+
+    def LoadStream(self, file, skip=None):
+        """
+        Load a manifest from a file-like object, parsing it as it is
+        read; see ManifestReader.  Top-level keys in skip (such as
+        NOTES_KEY or SIGNATURE_KEY) are parsed past, but not kept.
+        A manifest loaded without its signature can't be verified,
+        so that should only be skipped when it isn't needed.
+        """
+        self._dict = {}
+        packages = []
+        for key, value in ManifestReader(file, required=REQUIRED_KEYS, ordered=True):
+            if key == PACKAGES_KEY:
+                packages.append(value)
+            elif skip is None or key not in skip:
+                self._dict[key] = value
+        if packages:
+            self._dict[PACKAGES_KEY] = packages
+        self.Changed()
+        self.PackagesChanged()
 
         self.Validate()
         return
@@ -307,6 +745,7 @@ class Manifest(object):
         self._dict[NOTICE_KEY] = n
         if n is None:
             self._dict.pop(NOTICE_KEY)
+        self.Changed()
         return
 
     def Scheme(self):
@@ -317,6 +756,7 @@ class Manifest(object):
 
     def SetScheme(self, s):
         self._dict[SCHEME_KEY] = s
+        self.Changed()
         return
 
     def Sequence(self):
@@ -324,6 +764,7 @@ class Manifest(object):
 
     def SetSequence(self, seq):
         self._dict[SEQUENCE_KEY] = seq
+        self.Changed()
         return
 
     def SetNote(self, name, location):
@@ -332,6 +773,7 @@ class Manifest(object):
         if location.startswith(self._config.UpdateServerURL()):
             location = location[len(location):]
         self._dict[NOTES_KEY][name] = location
+        self.Changed()
 
     def Notes(self, raw=False):
         if NOTES_KEY in self._dict:
@@ -353,6 +795,7 @@ class Manifest(object):
                 if loc.startswith(self._config.UpdateServerURL()):
                     loc = loc[len(self._config.UpdateServerURL()):]
                 self._dict[NOTES_KEY][name] = os.path.basename(loc)
+        self.Changed()
         return
 
     def Note(self, name):
@@ -373,19 +816,45 @@ class Manifest(object):
 
     def SetTrain(self, train):
         self._dict[TRAIN_KEY] = train
+        self.Changed()
         return
 
+    def _LoadPackages(self):
+        if self._packages is None:
+            pkgs = []
+            index = {}
+            for p in self._dict[PACKAGES_KEY]:
+                pkg = Package.Package(p)
+                pkgs.append(pkg)
+                index[pkg.Name()] = pkg
+            self._packages = pkgs
+            self._package_index = index
+        return self._packages
+
     def Packages(self):
-        pkgs = []
-        for p in self._dict[PACKAGES_KEY]:
-            pkg = Package.Package(p)
-            pkgs.append(pkg)
-        return pkgs
+        """
+        The packages in the manifest, in install order.
+        The Package objects are kept by the manifest and shared
+        between calls; a caller that changes them needs to give
+        them back with SetPackages().
+        """
+        return list(self._LoadPackages())
+
+    def Package(self, name):
+        """
+        The package with the given name, or None.
+        """
+        if PACKAGES_KEY not in self._dict:
+            return None
+        self._LoadPackages()
+        return self._package_index.get(name)
 
     def AddPackage(self, pkg):
         if PACKAGES_KEY not in self._dict:
             self._dict[PACKAGES_KEY] = []
         self._dict[PACKAGES_KEY].append(pkg.dict())
+        self.Changed()
+        self.PackagesChanged()
         return
 
     def AddPackages(self, list):
@@ -398,101 +867,17 @@ class Manifest(object):
     def SetPackages(self, list):
         self._dict[PACKAGES_KEY] = []
         self.AddPackages(list)
+        self.Changed()
+        self.PackagesChanged()
         return
 
     def VerifySignature(self):
-        from . import IX_ROOT_CA_FILE, VERIFIER_HELPER, IX_CRL
         from . import SIGNATURE_FAILURE
 
         if self.Signature() is None:
             return not SIGNATURE_FAILURE
         # Probably need a way to ignore the signature
-        else:
-            import subprocess
-            import tempfile
-            from base64 import b64decode
-            import OpenSSL.crypto as Crypto
-            try:
-                cert_file = VerificationCertificateFile(self)
-            except ValueError:
-                cert_file = None
-                
-            if not os.path.isfile(IX_ROOT_CA_FILE) \
-               or cert_file is None \
-               or not os.path.isfile(cert_file):
-                log.debug("VerifySignature:  Cannot find a required file")
-                return False
-
-            # First we create a store
-            store = Crypto.X509Store()
-            store.set_flags(Crypto.X509StoreFlags.CRL_CHECK)
-            # Load our root CA
-            try:
-                with open(IX_ROOT_CA_FILE, "r") as f:
-                    root_ca = Crypto.load_certificate(Crypto.FILETYPE_PEM, f.read())
-                    store.add_cert(root_ca)
-            except:
-                log.debug("VerifySignature:  Could not load iX root CA", exc_info=True)
-                return False
-                
-            # Now need to get the CRL
-            crl_file = tempfile.NamedTemporaryFile(suffix=".pem")
-            if crl_file is None:
-                log.debug("Could not create CRL, ignoring for now")
-            else:
-                try:
-                    if not self._config.TryGetNetworkFile(
-                            url=IX_CRL,
-                            pathname=crl_file.name,
-                            reason="FetchCRL"
-                    ):
-                        # TGNF will raise an exception in most cases.
-                        raise Exception("Could not get CRL file")
-                except:
-                    log.error("Could not get CRL file %s" % IX_CRL)
-                    crl_file.close()
-                    crl_file = None
-
-            if crl_file:
-                try:
-                    crl = Crypto.load_crl(Crypto.FILETYPE_PEM, crl_file.read())
-                    store.add_crl(crl)
-                except:
-                    log.debug("Could not load CRL, ignoring for now", exc_info=True)
-                
-            # Now load the certificate files
-            try:
-                with open(cert_file, "r") as f:
-                    regexp = r'-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----'
-                    certs = re.findall(regexp, f.read(), re.DOTALL)
-            except:
-                log.error("Could not load certificates", exc_info=True)
-                return false
-                    
-            # Almost done:  we need the signature as binary data
-            try:
-                signature = b64decode(self.Signature())
-            except:
-                log.error("Could not decode signature", exc_info=True)
-                return False
-            
-            verified = False
-            tdata = self.dict().copy()
-            tdata.pop(SIGNATURE_KEY, None)
-            canonical = MakeString(tdata)
-            
-            for cert in certs:
-                try:
-                    test_cert = Crypto.load_certificate(Crypto.FILETYPE_PEM, cert)
-                    Crypto.verify(test_cert, signature, canonical, "sha256")
-                    verified = True
-                    break
-                except:
-                    # For now, just ignore
-                    pass
-
-            return verified
-        return False
+        return SystemVerifier().Verify(self)
 
     def Signature(self):
         if SIGNATURE_KEY in self._dict:
@@ -500,6 +885,7 @@ class Manifest(object):
 
     def SetSignature(self, signed_hash):
         self._dict[SIGNATURE_KEY] = signed_hash
+        self.Changed()
         return
 
     def SignWithKey(self, key_data):
@@ -507,6 +893,7 @@ class Manifest(object):
             # We'll cheat, and say this means "get rid of the signature"
             if SIGNATURE_KEY in self._dict:
                 self._dict.pop(SIGNATURE_KEY)
+                self.Changed()
         else:
             import OpenSSL.crypto as Crypto
             from base64 import b64encode as base64
@@ -519,15 +906,13 @@ class Manifest(object):
                 key = Crypto.load_privatekey(Crypto.FILETYPE_PEM, key_data)
 
             # Generate a canonical representation of the manifest
-            temp = self.dict()
-            temp.pop(SIGNATURE_KEY, None)
-            tstr = MakeString(temp)
+            tstr = self.UnsignedString()
 
             # Sign it.
             signed_value = base64(Crypto.sign(key, tstr, "sha256"))
 
             # And now set the signature
-            self._dict[SIGNATURE_KEY] = signed_value
+            self.SetSignature(signed_value)
         return
 
     def Version(self):
@@ -538,10 +923,12 @@ class Manifest(object):
 
     def SetVersion(self, version):
         self._dict[VERSION_KEY] = version
+        self.Changed()
         return
 
     def SetTimeStamp(self, ts):
         self._dict[TIMESTAMP_KEY] = ts
+        self.Changed()
 
     def TimeStamp(self):
         if TIMESTAMP_KEY in self._dict:
@@ -558,6 +945,7 @@ class Manifest(object):
         self._dict[REBOOT_KEY] = reboot
         if reboot is None:
             self._dict.pop(REBOOT_KEY)
+        self.Changed()
 
     def Reboot(self):
         if REBOOT_KEY in self._dict:
@@ -603,6 +991,7 @@ class Manifest(object):
             raise ValueError("Unknown validation kind %s" % str(kind))
         vdict = {}
         self._dict[key] = vdict
+        self.Changed()
         if name is None:
             # Similar to methods above, None means to remove the element
             self._dict.pop(key)
@@ -612,6 +1001,7 @@ class Manifest(object):
         vdict["Kind"] = kind
         return
 
+    @Timeline.Timed("RunValidationProgram")
     def RunValidationProgram(self, cache_dir, kind=VALIDATE_UPDATE):
         # Not sure this should go here
         # kind is currently unused.
@@ -652,6 +1042,21 @@ class Manifest(object):
             prog_path = tmp_file.name
         else:
             prog_path = os.path.join(cache_dir, kind)
+            # If it already passed with this program, for these
+            # sequences, there's no need to run it again.
+            result_path = prog_path + VALIDATION_RESULT_SUFFIX
+            stamp = ValidationStamp(prog_path, v["Checksum"], old_sequence, new_sequence)
+            try:
+                with open(result_path, "r") as f:
+                    if stamp and json.load(f) == stamp:
+                        log.debug("Validation program %s already passed" % v["Name"])
+                        return True
+            except:
+                pass
+            try:
+                os.remove(result_path)
+            except OSError:
+                pass
         if tmp_file or (not os.path.exists(prog_path)):
             # If tmp_file is set, we did not have a cache directory,
             # and so it's not possible to have it pre-downloaded.
@@ -684,6 +1089,14 @@ class Manifest(object):
             raise Exceptions.UpdateInvalidUpdateException(err.output.rstrip())
         finally:
             if tmp_file: os.remove(prog_path)
-            
+
+        if not tmp_file:
+            stamp = ValidationStamp(prog_path, v["Checksum"], old_sequence, new_sequence)
+            try:
+                with open(result_path + ".tmp", "w") as f:
+                    json.dump(stamp, f)
+                os.rename(result_path + ".tmp", result_path)
+            except:
+                log.debug("Could not save validation result %s" % result_path, exc_info=True)
         return True
     
@@ -8,15 +8,14 @@ SERVICES_KEY = "RestartServices"
 
 
 class Package(object):
-    _name = None
-    _version = None
-    _checksum = None
-    _size = None
-    _updates = None
-    _dirty = False
-    _services = None
+    # All of the package's data is kept in _dict, in the form it
+    # has in the manifest.  _updates and _update_index are the
+    # PackageUpdate objects for the upgrades, and an index of them
+    # by the version upgraded from; they are built when first needed.
+    __slots__ = ("_dict", "_updates", "_update_index")
 
     class PackageUpdate(object):
+        __slots__ = ("_dict", "_base")
 
         def __init__(self, pkg, dict):
             self._dict = dict
@@ -83,6 +82,8 @@ class Package(object):
 
     def __init__(self, *args):
         self._dict = {}
+        self._updates = None
+        self._update_index = None
         # We can be called with a dictionary, or with (name, version, checksum)
         if len(args) == 1 and isinstance(args[0], dict):
             tdict = args[0]
@@ -107,6 +108,9 @@ class Package(object):
         return
 
     def dict(self):
+        # The caller may change the upgrades, so the index has to go.
+        self._updates = None
+        self._update_index = None
         return self._dict
 
     def Size(self):
@@ -142,6 +146,8 @@ class Package(object):
 
     def SetUpdates(self, updates):
         self._dict[UPGRADES_KEY] = []
+        self._updates = None
+        self._update_index = None
         if updates is None:
             self._dict.pop(UPGRADES_KEY)
         else:
@@ -163,23 +169,31 @@ class Package(object):
                 t[REBOOT_KEY] = RequiresReboot
         self._dict[UPGRADES_KEY].append(t)
 
-        return Package.PackageUpdate(self, t)
+        upd = Package.PackageUpdate(self, t)
+        if self._updates is not None:
+            self._updates.append(upd)
+            self._update_index.setdefault(old, upd)
+        return upd
+
+    def _LoadUpdates(self):
+        if self._updates is None:
+            updates = []
+            index = {}
+            for upd in self._dict.get(UPGRADES_KEY, []):
+                pkg_update = Package.PackageUpdate(self, upd)
+                updates.append(pkg_update)
+                # The first one listed for a version is the one used.
+                index.setdefault(pkg_update.Version(), pkg_update)
+            self._updates = updates
+            self._update_index = index
+        return self._updates
 
     def Updates(self):
-        if UPGRADES_KEY in self._dict:
-            rv = []
-            for upd in self._dict[UPGRADES_KEY]:
-                rv.append(Package.PackageUpdate(self, upd))
-            return rv
-        return []
+        return list(self._LoadUpdates())
 
     def Update(self, old_version):
-        updates = self.Updates()
-        if updates:
-            for upd in updates:
-                if upd.Version() == old_version:
-                    return upd
-        return None
+        self._LoadUpdates()
+        return self._update_index.get(old_version)
 
     def FileName(self, old=None):
         # Very simple function, simply concatenate name, version.
@@ -0,0 +1,303 @@
+from __future__ import print_function
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger('freenasOS.Timeline')
+
+# Where update timelines are saved, and how many are kept.
+TIMELINE_DIR = "/var/log/update"
+TIMELINE_SUFFIX = ".timeline.json"
+TIMELINE_KEEP = 10
+
+_current = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NoSpan(object):
+    # Used when there's no timeline running, so that
+    # tracing costs next to nothing.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+    def Add(self, **counts):
+        pass
+
+    def Set(self, **attrs):
+        pass
+
+    def Fail(self, reason):
+        pass
+
+    def Failed(self):
+        return None
+
+
+class Span(object):
+    """
+    A timed part of an update, used as a context manager.  Spans
+    started inside another one (in the same thread) are its
+    children.  Add() adds to counts (such as Bytes or Files),
+    and Set() sets other values to be saved with it.  Fail()
+    marks it as failed, for failures that aren't exceptions.
+    """
+    __slots__ = ("_timeline", "_record", "_start")
+
+    def __init__(self, timeline, name, **attrs):
+        self._timeline = timeline
+        self._record = dict(attrs, Name=name)
+        self._start = None
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        parent = stack[-1] if stack and stack[-1]._timeline is self._timeline else None
+        self._record["Id"] = self._timeline._NextId()
+        self._record["Parent"] = parent._record["Id"] if parent else None
+        self._record["Thread"] = threading.current_thread().name
+        self._start = time.monotonic()
+        self._record["Start"] = round(self._start - self._timeline._clock, 6)
+        stack.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._record["Duration"] = round(time.monotonic() - self._start, 6)
+        if type is not None:
+            self._record["Error"] = str(value) or type.__name__
+        stack = _local.stack
+        if self in stack:
+            stack.remove(self)
+        self._timeline._Finished(self._record)
+        return False
+
+    def Add(self, **counts):
+        for key, value in counts.items():
+            self._record[key] = self._record.get(key, 0) + value
+
+    def Set(self, **attrs):
+        self._record.update(attrs)
+
+    def Fail(self, reason):
+        self._record["Error"] = reason
+
+    def Failed(self):
+        """
+        Why the span failed, or None.
+        """
+        return self._record.get("Error")
+
+
+class Timeline(object):
+    """
+    The spans recorded during one update (or download).
+    """
+    def __init__(self, name):
+        self._name = name
+        self._started = datetime.now()
+        self._clock = time.monotonic()
+        self._spans = []
+        self._ids = 0
+        self._lock = threading.Lock()
+
+    def _NextId(self):
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def _Finished(self, record):
+        with self._lock:
+            self._spans.append(record)
+
+    def Name(self):
+        return self._name
+
+    def Span(self, name, **attrs):
+        return Span(self, name, **attrs)
+
+    def dict(self, status=None):
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: (span["Start"], span["Id"]))
+        return {
+            "Name": self._name,
+            "Started": self._started.strftime("%Y-%m-%d %H:%M:%S"),
+            "Duration": round(time.monotonic() - self._clock, 6),
+            "Status": status,
+            "Spans": spans,
+        }
+
+    def Save(self, status=None, directory=None):
+        """
+        Write the timeline to a new file in directory (default
+        TIMELINE_DIR), removing the oldest ones there beyond
+        TIMELINE_KEEP.  Returns the path, or None if it couldn't
+        be written.
+        """
+        if directory is None:
+            directory = TIMELINE_DIR
+        path = os.path.join(directory, "%s-%s%s" % (
+            self._started.strftime("%Y%m%d-%H%M%S"), self._name, TIMELINE_SUFFIX))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".timeline")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.dict(status=status), f, indent=1, sort_keys=True)
+            os.rename(tmp, path)
+        except (OSError, IOError) as e:
+            log.debug("Unable to save update timeline in %s: %s" % (directory, str(e)))
+            return None
+        for old in List(directory)[:-TIMELINE_KEEP]:
+            try:
+                os.unlink(old)
+            except OSError:
+                pass
+        return path
+
+
+def Current():
+    """
+    The timeline being recorded, or None.
+    """
+    return _current
+
+
+def StartSpan(name, **attrs):
+    """
+    Return a Span on the current timeline; if there isn't one,
+    the returned object does nothing.
+    """
+    timeline = _current
+    if timeline is None:
+        return _NoSpan()
+    return timeline.Span(name, **attrs)
+
+
+class _Run(object):
+    # See Run()
+    def __init__(self, name, attrs):
+        self._name = name
+        self._attrs = attrs
+        self._timeline = None
+        self._span = None
+
+    def __enter__(self):
+        global _current
+        with _lock:
+            if _current is None:
+                self._timeline = _current = Timeline(self._name)
+        self._span = StartSpan(self._name, **self._attrs)
+        return self._span.__enter__()
+
+    def __exit__(self, type, value, traceback):
+        global _current
+        self._span.__exit__(type, value, traceback)
+        if self._timeline is not None:
+            with _lock:
+                _current = None
+            if self._span.Failed() is None:
+                status = "ok"
+            else:
+                status = "failed: %s" % self._span.Failed()
+            path = self._timeline.Save(status=status)
+            if path:
+                log.debug("Saved update timeline in %s" % path)
+        return False
+
+
+def Run(name, **attrs):
+    """
+    A context manager for an update (or download).  If no
+    timeline is being recorded, it starts one, and saves it when
+    it is done; otherwise, it's just a span.  The timeline is
+    saved as failed if an exception was raised, or the span's
+    Fail() was called.
+    """
+    return _Run(name, attrs)
+
+
+def Timed(name, run=False, failure=None):
+    """
+    A decorator to make each call of a function a span called
+    name.  With run set, calls are like Run(), so a timeline is
+    started (and saved) if none is being recorded.  For functions
+    which report failure by returning a value (such as False),
+    failure is that value, and the span fails when it's returned.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with (Run(name) if run else StartSpan(name)) as span:
+                rv = func(*args, **kwargs)
+                if failure is not None and rv is failure:
+                    span.Fail("returned %s" % rv)
+                return rv
+        return wrapper
+    return decorator
+
+
+def List(directory=None):
+    """
+    The saved timelines in directory (default TIMELINE_DIR),
+    oldest first.
+    """
+    if directory is None:
+        directory = TIMELINE_DIR
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.endswith(TIMELINE_SUFFIX) and not name.startswith(".")]
+
+
+def Load(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def Summary(timeline):
+    """
+    Return a list of lines describing a saved timeline (as
+    returned by Load()):  its top-level phases in order, and
+    then the totals for each kind of span, slowest first.
+    """
+    spans = timeline.get("Spans", [])
+    lines = ["{0}: started {1}, took {2:.2f}s ({3})".format(
+        timeline.get("Name"), timeline.get("Started"),
+        timeline.get("Duration", 0), timeline.get("Status"))]
+
+    # The phases are the children of the span for the whole
+    # update (the first one), and spans from other threads.
+    lines.append("Phases:")
+    for span in spans:
+        if span["Parent"] == 1 or (span["Parent"] is None and span["Id"] != 1):
+            lines.append("  {0:8.2f}s {1:8.2f}s  {2}{3}".format(
+                span["Start"], span["Duration"], span["Name"],
+                "  ({0})".format(span["Error"]) if "Error" in span else ""))
+
+    totals = {}
+    for span in spans:
+        total = totals.setdefault(span["Name"], {"Count": 0, "Duration": 0, "Bytes": 0, "Files": 0})
+        total["Count"] += 1
+        total["Duration"] += span["Duration"]
+        total["Bytes"] += span.get("Bytes", 0)
+        total["Files"] += span.get("Files", 0)
+    lines.append("Totals:")
+    for name, total in sorted(totals.items(), key=lambda item: item[1]["Duration"], reverse=True):
+        extra = ""
+        if total["Bytes"]:
+            extra += "  {0} bytes".format(total["Bytes"])
+        if total["Files"]:
+            extra += "  {0} files".format(total["Files"])
+        lines.append("  {0:8.2f}s  {1:5d} x {2}{3}".format(total["Duration"], total["Count"], name, extra))
+    return lines
@@ -1,19 +1,16 @@
 import time
 
 class Train(object):
-    _name = None
-    _descr = None
-    _seqno = None
-    _time = None
-    _notes = None
-    _notice = None
-    _update = False
+    __slots__ = ("_name", "_descr", "_seqno", "_time", "_notes", "_notice", "_update")
 
     def __init__(self, name, description=None, sequence=None, checked=None):
         self._name = name
         self._descr = description
         self._seqno = sequence
         self._time = checked
+        self._notes = None
+        self._notice = None
+        self._update = False
         return
 
     def __repr__(self):
@@ -10,7 +10,13 @@ import random
 import shutil
 import fcntl
 import errno
+import hashlib
+import json
 import tarfile
+import threading
+import time
+import functools
+from collections import OrderedDict
 
 try:
     import libzfs
@@ -23,7 +29,9 @@ except ImportError:
 from . import Avatar, modified_call
 import freenasOS.Manifest as Manifest
 import freenasOS.Configuration as Configuration
+import freenasOS.Checksum as Checksum
 import freenasOS.Installer as Installer
+import freenasOS.Timeline as Timeline
 from freenasOS.Exceptions import (
     UpdateIncompleteCacheException, UpdateInvalidCacheException, UpdateBusyCacheException,
     UpdateBootEnvironmentException, UpdateNetworkException, UpdatePackageException, UpdateSnapshotException,
@@ -49,42 +57,56 @@ PkgFileDeltaOnly = "delta-only"
 PkgFileFullOnly = "full-only"
 
 
+# Services which may be restarted by an update.  "Requires" lists
+# the services (keys in here) a service depends on; those are started
+# before it, and stopped after it.  A service with "Last" set is
+# stopped and started after all of the others (the web UI, which may
+# be what is running the update).  Services which don't depend on
+# each other are stopped and started at the same time, at most
+# SERVICE_WORKERS at once.
+SERVICE_WORKERS = 4
 SERVICES = {
     "SMB": {
         "Name": "CIFS",
         "ServiceName": "cifs",
         "Description": "Restart CIFS sharing",
         "CheckStatus": True,
+        "Requires": [],
     },
     "AFP": {
         "Name": "AFP",
         "ServiceName": "afp",
         "Description": "Restart AFP sharing",
         "CheckStatus": True,
+        "Requires": [],
     },
     "NFS": {
         "Name": "NFS",
         "ServiceName": "nfs",
         "Description": "Restart NFS sharing",
         "CheckStatus": True,
+        "Requires": [],
     },
     "iSCSI": {
         "Name": "iSCSI",
         "ServiceName": "iscsitarget",
         "Description": "Restart iSCSI services",
         "CheckStatus": True,
+        "Requires": [],
     },
     "FTP": {
         "Name": "FTP",
         "ServiceName": "ftp",
         "Description": "Restart FTP services",
         "CheckStatus": True,
+        "Requires": [],
     },
     "WebDAV": {
         "Name": "WebDAV",
         "ServiceName": "webdav",
         "Description": "Restart WebDAV services",
         "CheckStatus": True,
+        "Requires": [],
     },
     # Not sure what DirectoryServices would be
     #    "DirectoryServices" : {
@@ -106,6 +128,8 @@ if IsFN9():
         "ServiceName": "django",
         "Description": "Restart Web UI (forces a logout)",
         "CheckStatus": False,
+        "Requires": [],
+        "Last": True,
     }
 else:
     SERVICES["gui"] = {
@@ -113,6 +137,8 @@ else:
         "ServiceName": "gui",
         "Description": "Restart Web UI (forces a logout)",
         "CheckStatus": False,
+        "Requires": [],
+        "Last": True,
     }
 
 
@@ -133,6 +159,86 @@ def VerifyServices(svc_names):
     return True
 
 
+def _ServiceRequirements(svc_list):
+    """
+    Return a dictionary mapping each service in svc_list to the
+    set of services in svc_list which it requires.  Raises
+    ValueError for an unknown service, or a loop.  A service that
+    goes last can only require (or be required by) others that go
+    last, since otherwise stopping them would be a loop.
+    """
+    rv = OrderedDict()
+    for svc in svc_list:
+        if svc not in SERVICES:
+            raise ValueError("%s is not a known service" % svc)
+        rv[svc] = set(dep for dep in SERVICES[svc].get("Requires", []) if dep in svc_list)
+        for dep in rv[svc]:
+            if bool(SERVICES[dep].get("Last")) != bool(SERVICES[svc].get("Last")):
+                raise ValueError("%s can't require %s, as only one of them goes last" % (svc, dep))
+
+    checked = set()
+
+    def Check(svc, seen):
+        if svc in seen:
+            raise ValueError("Services %s require each other" % ", ".join(seen))
+        if svc not in checked:
+            for dep in rv[svc]:
+                Check(dep, seen + [svc])
+            checked.add(svc)
+
+    for svc in rv:
+        Check(svc, [])
+    return rv
+
+
+def _RunServices(svc_list, func, what, reverse=False):
+    """
+    Call func(svc) for each service in svc_list, logging how long
+    each one took.  A service is handled once the services it
+    requires have been (or, if reverse is set, once the services
+    requiring it have been), and services with "Last" set once all
+    of the others have been; others are handled at the same time.
+    Returns a dictionary of what func returned for each service.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    def Timed(svc):
+        start = time.monotonic()
+        try:
+            with Timeline.StartSpan(what, Service=svc):
+                return func(svc)
+        finally:
+            log.info("%s:  %s took %.2f seconds" % (what, svc, time.monotonic() - start))
+
+    waiting = _ServiceRequirements(list(OrderedDict.fromkeys(svc_list)))
+    if reverse:
+        waiting = OrderedDict((svc, set(other for other in waiting if svc in waiting[other]))
+                              for svc in waiting)
+    last = set(svc for svc in waiting if SERVICES[svc].get("Last"))
+    for svc in last:
+        waiting[svc] |= set(waiting) - last
+    start = time.monotonic()
+    results = OrderedDict()
+    if not waiting:
+        return results
+    with ThreadPoolExecutor(max_workers=min(len(waiting), SERVICE_WORKERS)) as executor:
+        running = {}
+        while waiting or running:
+            for svc in [svc for svc in waiting if waiting[svc] <= set(results)]:
+                running[executor.submit(Timed, svc)] = svc
+                del waiting[svc]
+            if not running:
+                # _ServiceRequirements() should make this impossible
+                raise ValueError("Services %s are waiting for each other" % ", ".join(waiting))
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                # If it failed, nothing more is started
+                results[running.pop(future)] = future.result()
+    log.info("%s:  %d services took %.2f seconds" % (what, len(results), time.monotonic() - start))
+    return results
+
+
+@Timeline.Timed("StopServices")
 def StopServices(svc_list):
     """
     Stop a set of services.  Returns the list of those that
@@ -155,21 +261,28 @@ def StopServices(svc_list):
         from django.db.models.loading import cache
         cache.get_apps()
 
+        from django.db import connection
         from freenasUI.middleware.notifier import notifier
-        n = notifier()
-        # Hm, this doesn't handle any particular ordering.
-        # May need to fix this.
-        for svc in svc_list:
-            if svc not in SERVICES:
-                raise ValueError("%s is not a known service" % svc)
+
+        def Stop(svc):
             s = SERVICES[svc]
             svc_name = s["ServiceName"]
             log.debug("StopServices:  svc %s maps to %s" % (svc, svc_name))
-            if (not s["CheckStatus"]) or n.started(svc_name):
-                retval.append(svc)
-                n.stop(svc_name)
-            else:
+            try:
+                n = notifier()
+                if (not s["CheckStatus"]) or n.started(svc_name):
+                    n.stop(svc_name)
+                    return True
                 log.debug("svc %s is not started" % svc)
+                return False
+            finally:
+                # Django opens a database connection for each thread,
+                # and won't close it when the thread is done.
+                connection.close()
+
+        # Services are stopped before the ones they require
+        stopped = _RunServices(svc_list, Stop, "StopServices", reverse=True)
+        retval = [svc for svc in OrderedDict.fromkeys(svc_list) if stopped[svc]]
 
         # Should I remove the environment settings?
         if old_environ:
@@ -196,6 +309,7 @@ def StopServices(svc_list):
     return retval
 
 
+@Timeline.Timed("StartServices")
 def StartServices(svc_list):
     """
     Start a set of services.  THis is the output
@@ -217,15 +331,17 @@ def StartServices(svc_list):
         from django.db.models.loading import cache
         cache.get_apps()
 
+        from django.db import connection
         from freenasUI.middleware.notifier import notifier
-        n = notifier()
-        # Hm, this doesn't handle any particular ordering.
-        # May need to fix this.
-        for svc in svc_list:
-            if svc not in SERVICES:
-                raise ValueError("%s is not a known service" % svc)
-            svc_name = SERVICES[svc]["ServiceName"]
-            n.start(svc_name)
+
+        def Start(svc):
+            try:
+                notifier().start(SERVICES[svc]["ServiceName"])
+            finally:
+                # See Stop() in StopServices()
+                connection.close()
+
+        _RunServices(svc_list, Start, "StartServices")
 
         # Should I remove the environment settings?
         if old_environ:
@@ -301,184 +417,560 @@ def GetRootDataset():
     return rv
 
 
-def CloneSetAttr(clone, **kwargs):
+def _CloneSpace(zfs, ds, tdict):
+    # Fill in rawspace and keep for a BE, given its dataset.
+    tdict["rawspace"] = ds.properties["usedbydataset"].parsed + \
+        ds.properties["usedbyrefreservation"].parsed + \
+        ds.properties["usedbysnapshots"].parsed
+    origin = ds.properties["origin"].parsed
+    if origin and '@' in origin:
+        snapshot = zfs.get_snapshot(origin)
+        tdict["rawspace"] += snapshot.properties["used"].parsed
+    try:
+        kstr = ds.properties["beadm:keep"].value
+        if kstr == "True":
+            tdict["keep"] = True
+        elif kstr == "False":
+            tdict["keep"] = False
+    except KeyError:
+        pass
+
+
+def _SpaceString(size):
+    # Roughly the way beadm shows sizes
+    size = float(size)
+    for suffix in ("", "K", "M", "G"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        suffix = "T"
+    return "%.1f%s" % (size, suffix) if suffix else "%d" % size
+
+
+class BeadmBootEnvironments(object):
     """
-    Given a clone, set attributes defined in kwargs.
-    Currently only 'keep' (which maps to beadm:keep)
-    is allowed.
+    Boot environments, managed by beadm(8).  This is the
+    interface the clone functions below use; all of the
+    methods take the real (not nick) name of a BE, except
+    as noted, and return False on failure.
     """
-    if clone is None:
-        raise ValueError("Clone must be set")
-    if kwargs is None:
-        return True
+    def List(self):
+        """
+        Return a list of dictionaries, one per BE, with the keys
+        realname, name (the nickname, if it has one), active,
+        mountpoint, space, created, keep and rawspace.  Returns
+        None on error.
+        """
+        # The outer loop is just a simple wrapper for
+        # "beadm list -H"; it then gets a set of properties
+        # for each BE.
+        # Because of that, it can't use RunCommand
+        cmd = [beadm, "list", "-H"]
+        rv = []
+        if debug:
+            print(cmd, file=sys.stderr)
+            return None
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except:
+            log.error("Could not run %s", cmd)
+            return None
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            log.error("`%s' returned %d" % (cmd, p.returncode))
+            return None
 
-    dsname = "freenas-boot/ROOT/{0}".format(clone["realname"])
-    try:
+        # Get all of the BE datasets at once, with one handle, rather
+        # than opening one for each BE.
         with libzfs.ZFS() as zfs:
-            ds = zfs.get_dataset(dsname)
-    except:
-        log.debug("Unable to find BE {0}".format(clone["realname"]), exc_info=True)
-        return False
-    
-    for k, v in kwargs.items():
-        if k == "keep":
-            # This maps to zfs set beadm:keep=%s freenas-boot/ROOT/${bename}
             try:
-                with libzfs.ZFS() as zfs:
-                    ds = zfs.get_dataset(dsname)
-                    if "beadm:keep" in ds.properties:
-                        ds.properties["beadm:keep"].value = str(v)
-                    else:
-                        ds.properties["beadm:keep"] = libzfs.ZFSUserProperty(str(v))
-            except:
-                log.debug("Unable to set beadm:keep value on BE {0}".format(clone["realname"]), exc_info=True)
+                datasets = dict((ds.name, ds) for ds in
+                                zfs.get_dataset("{0}/ROOT".format(freenas_pool)).children)
+            except libzfs.ZFSException:
+                log.debug("Unable to get BE properties", exc_info=True)
+                datasets = {}
+
+            for line in stdout.decode('utf8').strip('\n').split('\n'):
+                fields = line.split('\t')
+                name = fields[0]
+                if len(fields) > 5 and fields[5] != "-":
+                    name = fields[5]
+                tdict = {
+                    'realname': fields[0],
+                    'name': name,
+                    'active': fields[1],
+                    'mountpoint': fields[2],
+                    'space': fields[3],
+                    'created': datetime.strptime(fields[4], '%Y-%m-%d %H:%M'),
+                    'keep': None,
+                    'rawspace': None
+                }
+                ds = datasets.get("{0}/ROOT/{1}".format(freenas_pool, tdict["realname"]))
+                if ds is not None:
+                    try:
+                        _CloneSpace(zfs, ds, tdict)
+                    except libzfs.ZFSException:
+                        pass
+                rv.append(tdict)
+        return rv
+
+    def Exists(self, name):
+        with libzfs.ZFS() as zfs:
+            try:
+                zfs.get_dataset("{0}/ROOT/{1}".format(freenas_pool, name))
+            except libzfs.ZFSException:
+                return False
+        return True
+
+    def Create(self, name, source=None):
+        # Clone the current BE, or source, as name.
+        args = ["create"]
+        if source:
+            args.extend(["-e", source])
+        args.append(name)
+        return RunCommand(beadm, args)
+
+    def Rename(self, oldname, newname):
+        # Either name may be a nickname
+        return RunCommand(beadm, ["rename", oldname, newname])
+
+    def Mount(self, name, mount_point):
+        if RunCommand(beadm, ["mount", name, mount_point]) is False:
+            return False
+
+        # If all that worked... we now need
+        # to set up /dev, /var/tmp
+        # Let's see if we need to do that
+        # Now let's mount devfs, tmpfs
+        args_array = [
+            ["-t", "devfs", "devfs", mount_point + "/dev"],
+            ["-t", "tmpfs", "tmpfs", mount_point + "/var/tmp"],
+        ]
+        cmd = "/sbin/mount"
+        for fs_args in args_array:
+            rv = RunCommand(cmd, fs_args)
+            if rv is False:
+                self.Unmount(name)
                 return False
-        elif k == "sync":
+        return True
+
+    def Unmount(self, name, mount_point=None):
+        # We can also unmount /dev and /var/tmp
+        # If this fails, we ignore it for now
+        if mount_point is not None:
+            cmd = "/sbin/umount"
+            for dir in ["/dev", "/var/tmp"]:
+                args = ["-f", mount_point + dir]
+                RunCommand(cmd, args)
+
+        # Now we ask beadm to unmount it.
+        return RunCommand(beadm, ["unmount", "-f", name])
+
+    def Activate(self, name):
+        return RunCommand(beadm, ["activate", name])
+
+    def Destroy(self, name):
+        return RunCommand(beadm, ["destroy", "-F", name])
+
+    def SetAttributes(self, name, **kwargs):
+        """
+        Set keep (beadm:keep) and sync (None to inherit it)
+        on a BE.
+        """
+        dsname = "{0}/ROOT/{1}".format(freenas_pool, name)
+        with libzfs.ZFS() as zfs:
             try:
-                with libzfs.ZFS() as zfs:
-                    ds = zfs.get_dataset(dsname)
-                    if v is None:
-                        ds.properties["sync"].inherit()
-                    else:
-                        ds.properties["sync"].value = v
+                ds = zfs.get_dataset(dsname)
             except:
-                log.debug("Unable to set dataset sync value on BE {0} to {1}".
-                          format(clone["realname"], str(v)), exc_info=True)
+                log.debug("Unable to find BE {0}".format(name), exc_info=True)
                 return False
-    return True
 
-def PruneClones(cb=None, required=0):
+            for k, v in kwargs.items():
+                if k == "keep":
+                    # This maps to zfs set beadm:keep=%s freenas-boot/ROOT/${bename}
+                    try:
+                        if "beadm:keep" in ds.properties:
+                            ds.properties["beadm:keep"].value = str(v)
+                        else:
+                            ds.properties["beadm:keep"] = libzfs.ZFSUserProperty(str(v))
+                    except:
+                        log.debug("Unable to set beadm:keep value on BE {0}".format(name), exc_info=True)
+                        return False
+                elif k == "sync":
+                    try:
+                        if v is None:
+                            ds.properties["sync"].inherit()
+                        else:
+                            ds.properties["sync"].value = v
+                    except:
+                        log.debug("Unable to set dataset sync value on BE {0} to {1}".
+                                  format(name, str(v)), exc_info=True)
+                        return False
+        return True
+
+
+class LibzfsBootEnvironments(BeadmBootEnvironments):
     """
-    Attempt to prune boot environments based on age.
-    It will try deleting BEs until either:
-    1:  There are no more BEs suitable for deletion.
-    2:  At least 80% of the pool is free.
-    3:  At least 2gbytes is free.
-    If cb is not None, it will be called with something.
-    required should be the estimated size (in bytes)
-    needed for the install.
+    Boot environments, listed in-process with libzfs rather than by
+    running beadm.  Creating, renaming, mounting, activating and
+    destroying a BE are still done by beadm, since it also has to
+    take care of the boot loader.
+    """
+    def List(self):
+        rv = []
+        try:
+            with libzfs.ZFS() as zfs:
+                bootfs = zfs.get(freenas_pool).properties["bootfs"].value
+                root = zfs.get_dataset("{0}/ROOT".format(freenas_pool))
+                for ds in root.children:
+                    rv.append(self._Describe(zfs, ds, bootfs))
+        except libzfs.ZFSException:
+            log.debug("Unable to list boot environments with libzfs, trying beadm", exc_info=True)
+            return BeadmBootEnvironments.List(self)
+        return rv
+
+    def _Describe(self, zfs, ds, bootfs):
+        realname = ds.name.split("/")[-1]
+        name = realname
+        try:
+            nickname = ds.properties["beadm:nickname"].value
+            if nickname and nickname != "-":
+                name = nickname
+        except KeyError:
+            pass
+        mountpoint = ds.mountpoint or "-"
+        active = ""
+        if mountpoint == "/":
+            active += "N"
+        if ds.name == bootfs:
+            active += "R"
+        created = datetime.fromtimestamp(int(ds.properties["creation"].rawvalue))
+        tdict = {
+            'realname': realname,
+            'name': name,
+            'active': active or "-",
+            'mountpoint': mountpoint,
+            'space': None,
+            # beadm only shows the minute
+            'created': created.replace(second=0, microsecond=0),
+            'keep': None,
+            'rawspace': None
+        }
+        _CloneSpace(zfs, ds, tdict)
+        tdict["space"] = _SpaceString(tdict["rawspace"])
+        return tdict
+
+
+class MemoryBootEnvironments(object):
     """
-    def PruneDone(req):
-        # We'll say an install requires at least 512mbytes.
-        mbytes_min = 512 * 1024 * 1024
-        if req > mbytes_min:
-            mbytes_min = req
-            
-        return Configuration.CheckFreeSpace(pool=freenas_pool, required=mbytes_min)
+    Boot environments that only exist in memory, for trying out
+    the update code without ZFS or beadm.  Mounting a BE just
+    remembers where it was mounted.  Starts with one BE, root,
+    which is mounted on / and active.
+    """
+    def __init__(self, root="default"):
+        self._clones = OrderedDict()
+        self.Add(root, active="NR", mountpoint="/")
 
+    def Add(self, name, active="-", mountpoint="-", created=None, keep=False, rawspace=0):
+        self._clones[name] = {
+            'realname': name,
+            'name': name,
+            'active': active,
+            'mountpoint': mountpoint,
+            'space': _SpaceString(rawspace),
+            'created': created or datetime.now().replace(second=0, microsecond=0),
+            'keep': keep,
+            'rawspace': rawspace,
+            'sync': None,
+        }
 
-    def DCW(be):
-        """
-        Dead Clone Walking:  return true if the
-        clone is eligible for pruning.  That is, if
-        it does not have a keep property set to True,
-        and is not currently mounted or active.
-        For now, if "keep" is not in it, we exclude it
-        as well, but log it.
-        """
-        if "keep" not in be:
-            log.debug(
-                "Cannot prune clone {0} since it is missing a keep option".format(be["name"])
-            )
+    def _Find(self, name):
+        # Like FindClone(), this accepts a nickname or a real name
+        for clone in self._clones.values():
+            if clone["name"] == name:
+                return clone
+        return self._clones.get(name)
+
+    def List(self):
+        return [dict(clone) for clone in self._clones.values()]
+
+    def Exists(self, name):
+        return name in self._clones
+
+    def Create(self, name, source=None):
+        if name in self._clones:
             return False
-        if be["keep"] is None:
-            log.debug("Cannot prune clone {0} since keep is None".format(be["name"]))
+        if source is not None and self._Find(source) is None:
             return False
-        if be["keep"] == True:
+        self.Add(name)
+        return True
+
+    def Rename(self, oldname, newname):
+        clone = self._Find(oldname)
+        if clone is None:
             return False
-        if be["mountpoint"] != "-":
-            log.debug("Cannot prune clone {0} since it is mounted at {1}".format(be["name"], be["mountpoint"]))
+        if any(c["name"] == newname for c in self._clones.values() if c is not clone):
             return False
-        if be["active"] != "-":
-            log.debug(
-                "Cannot prune clone {0} since it is active {1}".format(be["name"], be["active"])
-            )
+        clone["name"] = newname
+        return True
+
+    def Mount(self, name, mount_point):
+        clone = self._Find(name)
+        if clone is None or clone["mountpoint"] != "-":
             return False
+        clone["mountpoint"] = mount_point
         return True
 
+    def Unmount(self, name, mount_point=None):
+        clone = self._Find(name)
+        if clone is None or clone["mountpoint"] == "/":
+            return False
+        clone["mountpoint"] = "-"
+        return True
 
-    
-    if PruneDone(required):
+    def Activate(self, name):
+        clone = self._Find(name)
+        if clone is None:
+            return False
+        for c in self._clones.values():
+            c["active"] = c["active"].replace("R", "") or "-"
+        clone["active"] = clone["active"].replace("-", "") + "R"
+        return True
+
+    def Destroy(self, name):
+        clone = self._Find(name)
+        if clone is None or clone["mountpoint"] == "/":
+            return False
+        del self._clones[clone["realname"]]
+        return True
+
+    def SetAttributes(self, name, **kwargs):
+        clone = self._clones.get(name)
+        if clone is None:
+            return False
+        for k, v in kwargs.items():
+            if k in ("keep", "sync"):
+                clone[k] = v
+        return True
+
+
+_be_backend = None
+
+
+def SetBootEnvironmentBackend(backend):
+    """
+    Set the object used to manage boot environments (see
+    BeadmBootEnvironments).  None goes back to the default.
+    """
+    global _be_backend
+    _be_backend = backend
+    _ClonesChanged()
+
+
+def BootEnvironmentBackend():
+    """
+    The object used to manage boot environments:  the one given
+    to SetBootEnvironmentBackend(), or, by default, libzfs if it
+    is available, and beadm if it isn't.
+    """
+    global _be_backend
+    if _be_backend is None:
+        if "libzfs" in globals():
+            _be_backend = LibzfsBootEnvironments()
+        else:
+            _be_backend = BeadmBootEnvironments()
+    return _be_backend
+
+
+# How long (in seconds) ListClones() may return the same list
+# for, if nothing is done to a boot environment in between.
+CLONE_CACHE_TIME = 5
+
+_clone_cache = None
+_clone_cache_time = 0
+_clone_generation = 0
+_clone_lock = threading.Lock()
+
+
+def _ClonesChanged():
+    # Forget the list of clones, after a BE has been changed.
+    global _clone_cache, _clone_generation
+    with _clone_lock:
+        _clone_cache = None
+        _clone_generation += 1
+
+
+def _ChangesClones(func):
+    # For the functions below which change a BE:  the cached
+    # list of clones is dropped once they're done, whether or
+    # not they worked.  They're also timed for the update
+    # timeline.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with Timeline.StartSpan(func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            _ClonesChanged()
+    return wrapper
+
+
+@_ChangesClones
+def CloneSetAttr(clone, **kwargs):
+    """
+    Given a clone, set attributes defined in kwargs.
+    Currently only 'keep' (which maps to beadm:keep)
+    and 'sync' (None to inherit it) are allowed.
+    """
+    if clone is None:
+        raise ValueError("Clone must be set")
+    if kwargs is None:
+        return True
+
+    return BootEnvironmentBackend().SetAttributes(clone["realname"], **kwargs)
+
+def _PrunableClone(be):
+    """
+    Dead Clone Walking:  return true if the
+    clone is eligible for pruning.  That is, if
+    it does not have a keep property set to True,
+    and is not currently mounted or active.
+    For now, if "keep" is not in it, we exclude it
+    as well, but log it.
+    """
+    if "keep" not in be:
+        log.debug(
+            "Cannot prune clone {0} since it is missing a keep option".format(be["name"])
+        )
+        return False
+    if be["keep"] is None:
+        log.debug("Cannot prune clone {0} since keep is None".format(be["name"]))
+        return False
+    if be["keep"] == True:
+        return False
+    if be["mountpoint"] != "-":
+        log.debug("Cannot prune clone {0} since it is mounted at {1}".format(be["name"], be["mountpoint"]))
+        return False
+    if be["active"] != "-":
+        log.debug(
+            "Cannot prune clone {0} since it is active {1}".format(be["name"], be["active"])
+        )
+        return False
+    return True
+
+
+def _PruneRequired(required):
+    # We'll say an install requires at least 512mbytes.
+    mbytes_min = 512 * 1024 * 1024
+    if required > mbytes_min:
+        return required
+    return mbytes_min
+
+
+def PlanPruneClones(required=0):
+    """
+    Work out which boot environments PruneClones() would delete
+    to make room for required bytes.  Returns a tuple of the
+    number of bytes that need to be freed (0 if there is room
+    already), and a list of clones (as from ListClones()).
+    The clones are chosen by the space each one would free, so
+    that as few as possible are deleted, preferring older ones
+    when that doesn't matter.  If even all of them wouldn't free
+    enough, the list is every clone eligible for deletion.
+    """
+    needed = Configuration.PoolShortfall(freenas_pool, required=_PruneRequired(required))
+    if needed == 0:
+        return (0, [])
+    clones = ListClones() or []
+    eligible = sorted([be for be in clones if _PrunableClone(be)], key=lambda be: be["created"])
+    # The biggest n clones free the most that n clones can, so
+    # taking them biggest first finds how few will do.  Clones
+    # whose size isn't known can't be counted on.
+    known = [be for be in eligible if be["rawspace"] is not None]
+    count = 0
+    freed = 0
+    for be in sorted(known, key=lambda be: be["rawspace"], reverse=True):
+        if freed >= needed:
+            break
+        count += 1
+        freed += be["rawspace"]
+    if freed < needed:
+        return (needed, eligible)
+
+    # Of the sets of that many clones which free enough, pick
+    # the oldest:  a clone is taken if the rest can still be
+    # made up from the biggest of the newer ones.
+    plan = []
+    freed = 0
+    for i, be in enumerate(known):
+        if len(plan) == count:
+            break
+        rest = sorted((b["rawspace"] for b in known[i + 1:]), reverse=True)
+        if freed + be["rawspace"] + sum(rest[:count - len(plan) - 1]) >= needed:
+            plan.append(be)
+            freed += be["rawspace"]
+    return (needed, plan)
+
+
+@Timeline.Timed("PruneClones", failure=False)
+def PruneClones(cb=None, required=0, dry_run=False):
+    """
+    Attempt to prune boot environments, to make room for an
+    install.  It picks the BEs to delete with PlanPruneClones(),
+    deletes them, and then checks (once) whether at least
+    required bytes (but no less than 512mbytes) now fit in the
+    pool.
+    If cb is not None, it will be called with something.
+    required should be the estimated size (in bytes)
+    needed for the install.
+    If dry_run is set, nothing is deleted; the plan is logged,
+    and the return value says whether it should free enough.
+    """
+    (needed, plan) = PlanPruneClones(required=required)
+    if needed == 0:
         log.debug("No pruning necessary")
         return True
-    clones = sorted(ListClones(), key=lambda be: be["created"])
-    for be in clones:
-        # Check if clone is eligible.
-        if DCW(be):
-            log.debug("I want to get rid of clone %s" % be["name"])
-            if DeleteClone(be["realname"]) is True:
-                log.debug("Successfully deleted clone %s" % be["realname"])
-                if PruneDone(required):
-                    log.debug("Pruning done!")
-                    return True
-            else:
-                log.debug("Could not delete clone %s" % be["realname"])
+    planned = sum(be["rawspace"] or 0 for be in plan)
+    log.info("PruneClones:  need to free %d bytes; deleting %d BEs (%s) should free %d" % (
+        needed, len(plan), ", ".join(be["name"] for be in plan), planned))
+    if dry_run:
+        return planned >= needed
+
+    for be in plan:
+        log.debug("I want to get rid of clone %s" % be["name"])
+        if DeleteClone(be["realname"]) is True:
+            log.debug("Successfully deleted clone %s" % be["realname"])
         else:
-            log.debug("Clone %s not eligible for pruning" % be["realname"])
-        # Next BE, please
+            log.debug("Could not delete clone %s" % be["realname"])
 
+    if Configuration.CheckFreeSpace(pool=freenas_pool, required=_PruneRequired(required)):
+        log.debug("Pruning done!")
+        return True
     log.debug("Done with prune loop.  Must have failed.")
     return False
 
 
 def ListClones():
-    # Return a list of boot-environment clones.
-    # The outer loop is just a simple wrapper for
-    # "beadm list -H"; it then gets a set of properties
-    # for each BE.
-    # Because of that, it can't use RunCommand
-    cmd = [beadm, "list", "-H"]
-    rv = []
-    if debug:
-        print(cmd, file=sys.stderr)
-        return None
-    try:
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    except:
-        log.error("Could not run %s", cmd)
-        return None
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        log.error("`%s' returned %d" % (cmd, p.returncode))
+    # Return a list of boot-environment clones, as
+    # dictionaries; see BeadmBootEnvironments.List().
+    # The list is reused for up to CLONE_CACHE_TIME seconds,
+    # unless a BE is changed.
+    global _clone_cache, _clone_cache_time
+    with _clone_lock:
+        if _clone_cache is not None and time.monotonic() - _clone_cache_time < CLONE_CACHE_TIME:
+            return [dict(clone) for clone in _clone_cache]
+        generation = _clone_generation
+    clones = BootEnvironmentBackend().List()
+    if clones is None:
         return None
-
-    for line in stdout.decode('utf8').strip('\n').split('\n'):
-        fields = line.split('\t')
-        name = fields[0]
-        if len(fields) > 5 and fields[5] != "-":
-            name = fields[5]
-        tdict = {
-            'realname': fields[0],
-            'name': name,
-            'active': fields[1],
-            'mountpoint': fields[2],
-            'space': fields[3],
-            'created': datetime.strptime(fields[4], '%Y-%m-%d %H:%M'),
-            'keep': None,
-            'rawspace': None
-        }
-        try:
-            with libzfs.ZFS() as zfs:
-                ds = zfs.get_dataset("freenas-boot/ROOT/{0}".format(tdict["realname"]))
-                tdict["rawspace"] = ds.properties["usedbydataset"].parsed + \
-                    ds.properties["usedbyrefreservation"].parsed + \
-                    ds.properties["usedbysnapshots"].parsed
-                origin = ds.properties["origin"].parsed
-                if '@' in origin:
-                    snapshot = zfs.get_snapshot(origin)
-                    tdict["rawspace"] += snapshot.properties["used"].parsed
-                try:
-                    kstr = ds.properties["beadm:keep"].value
-                    if kstr == "True":
-                        tdict["keep"] = True
-                    elif kstr == "False":
-                        tdict["keep"] = False
-                except KeyError:
-                    pass
-        except libzfs.ZFSException:
-            pass
-        rv.append(tdict)
-    return rv
+    with _clone_lock:
+        # Don't keep it if a BE was changed while listing
+        if generation == _clone_generation:
+            _clone_cache = [dict(clone) for clone in clones]
+            _clone_cache_time = time.monotonic()
+    return clones
 
 
 def FindClone(name):
@@ -527,6 +1019,7 @@ def _CheckBEName(name):
     if any(elem in name for elem in badChars):
         raise InvalidBootEnvironmentNameException
     
+@_ChangesClones
 def CreateClone(name, bename=None, rename=None):
     # Create a boot environment from the current
     # root, using the given name.  Returns False
@@ -541,7 +1034,8 @@ def CreateClone(name, bename=None, rename=None):
     # pre-${name} to ${rename}.  In the event of
     # an error anywhere along, we undo as much as we can
     # and return an error.
-    args = ["create"]
+    backend = BootEnvironmentBackend()
+    source = None
     if bename:
         _CheckBEName(bename)
         # Due to how beadm works, if we are given a starting name,
@@ -551,29 +1045,24 @@ def CreateClone(name, bename=None, rename=None):
             log.error("CreateClone:  Cannot find starting clone %s" % bename)
             return False
         log.debug("FindClone returned %s" % cl)
-        args.extend(["-e", cl["realname"]])
+        source = cl["realname"]
     if rename:
         _CheckBEName(rename)
         temp_name = "Pre-%s-%d" % (name, random.SystemRandom().randint(0, 1024 * 1024))
-        args.append(temp_name)
+        create_name = temp_name
         log.debug("CreateClone with rename, temp_name = %s" % temp_name)
     else:
-        args.append(name)
+        create_name = name
 
     # Let's see if the given name already exists
-    with libzfs.ZFS() as zfs:
-        try:
-            zfs.get_dataset("freenas-boot/ROOT/{0}".format(name))
-        except libzfs.ZFSException:
-            pass
-        else:
-            raise KeyError
+    if backend.Exists(name):
+        raise KeyError
 
     try:
         if os.path.exists(dsinit) and not RunCommand(dsinit, ["--lock"]):
             return False
 
-        rv = RunCommand(beadm, args)
+        rv = backend.Create(create_name, source=source)
         if rv is False:
             return False
     finally:
@@ -584,29 +1073,25 @@ def CreateClone(name, bename=None, rename=None):
         # We've created Pre-<newname>-<random>
         # Now we want to reame the root environment, which is rename, to
         # the new name.
-        args = ["rename", rename, name]
-        rv = RunCommand(beadm, args)
+        rv = backend.Rename(rename, name)
         if rv is False:
             # We failed.  Clean up the temp one
-            args = ["destroy", "-F", temp_name]
-            RunCommand(beadm, args)
+            backend.Destroy(temp_name)
             return False
         # Root has been renamed, so let's rename the temporary one
-        args = ["rename", temp_name, rename]
-        rv = RunCommand(beadm, args)
+        rv = backend.Rename(temp_name, rename)
         if rv is False:
             # We failed here.  How annoying.
             # So let's delete the newlyp-created BE
             # and rename root
-            args = ["destroy", "-F", rename]
-            RunCommand(beadm, args)
-            args = ["rename", name, rename]
-            RunCommand(beadm, args)
+            backend.Destroy(rename)
+            backend.Rename(name, rename)
             return False
 
     return True
 
 
+@_ChangesClones
 def RenameClone(oldname, newname):
     # Create a boot environment from the current
     # root, using the given name.  Returns False
@@ -614,13 +1099,13 @@ def RenameClone(oldname, newname):
     _CheckBEName(oldname)
     _CheckBEName(newname)
     
-    args = ["rename", oldname, newname]
-    rv = RunCommand(beadm, args)
+    rv = BootEnvironmentBackend().Rename(oldname, newname)
     if rv is False:
         return False
     return True
 
 
+@_ChangesClones
 def MountClone(name, mountpoint=None):
     # Mount the given boot environment.  It will
     # create a random name in /tmp.  Returns the
@@ -636,8 +1121,7 @@ def MountClone(name, mountpoint=None):
 
     if mount_point is None:
         return None
-    args = ["mount", name, mount_point]
-    rv = RunCommand(beadm, args)
+    rv = BootEnvironmentBackend().Mount(name, mount_point)
     if rv is False:
         try:
             os.rmdir(mount_point)
@@ -645,45 +1129,20 @@ def MountClone(name, mountpoint=None):
             pass
         return None
 
-    # If all that worked... we now need
-    # to set up /dev, /var/tmp
-    # Let's see if we need to do that
-    # Now let's mount devfs, tmpfs
-    args_array = [
-        ["-t", "devfs", "devfs", mount_point + "/dev"],
-        ["-t", "tmpfs", "tmpfs", mount_point + "/var/tmp"],
-    ]
-    cmd = "/sbin/mount"
-    for fs_args in args_array:
-        rv = RunCommand(cmd, fs_args)
-        if rv is False:
-            UnmountClone(name, None)
-            return None
-
     return mount_point
 
 
+@_ChangesClones
 def ActivateClone(name):
     # Set the clone to be active for the next boot
-    args = ["activate", name]
-    return RunCommand(beadm, args)
+    return BootEnvironmentBackend().Activate(name)
 
 
+@_ChangesClones
 def UnmountClone(name, mount_point=None):
     # Unmount the given clone.  After unmounting,
     # it removes the mount directory.
-    # We can also unmount /dev and /var/tmp
-    # If this fails, we ignore it for now
-    if mount_point is not None:
-        cmd = "/sbin/umount"
-        for dir in ["/dev", "/var/tmp"]:
-            args = ["-f", mount_point + dir]
-            RunCommand(cmd, args)
-
-    # Now we ask beadm to unmount it.
-    args = ["unmount", "-f", name]
-
-    if RunCommand(beadm, args) is False:
+    if BootEnvironmentBackend().Unmount(name, mount_point) is False:
         return False
 
     if mount_point is not None:
@@ -694,6 +1153,7 @@ def UnmountClone(name, mount_point=None):
     return True
 
 
+@_ChangesClones
 def DeleteClone(name):
     # Delete the clone we created.
 
@@ -706,107 +1166,283 @@ def DeleteClone(name):
     if clone is None:
         return False
     
-    args = ["destroy", "-F", clone["realname"]]
-    rv = RunCommand(beadm, args)
-    if rv is False:
-        return rv
-    
-    return rv
+    return BootEnvironmentBackend().Destroy(clone["realname"])
 
 
-def GetUpdateChanges(old_manifest, new_manifest, cache_dir=None):
+def MergeServiceList(base_list, new_list):
     """
-    This is used by both PendingUpdatesChanges() and CheckForUpdates().
-    The difference between the two is that the latter doesn't necessarily
-    have a cache directory, so if cache_dir is none, we have to assume the
-    update package exists.
-    This returns a dictionary that will have at least "Reboot" as a key.
+    Merge new_list into base_list.
+    For each service in new_list (which is a dictionary),
+    if the value is True, add it to base_list.
+    If new_list is an array, simply add each item to
+    base_list; if it's a dict, we check the value.
     """
-    def MergeServiceList(base_list, new_list):
-        """
-        Merge new_list into base_list.
-        For each service in new_list (which is a dictionary),
-        if the value is True, add it to base_list.
-        If new_list is an array, simply add each item to
-        base_list; if it's a dict, we check the value.
-        """
-        if new_list is None:
-            return base_list
-        if isinstance(new_list, list):
-            for svc in new_list:
+    if new_list is None:
+        return base_list
+    if isinstance(new_list, list):
+        for svc in new_list:
+            if svc not in base_list:
+                base_list.append(svc)
+    elif isinstance(new_list, dict):
+        for svc, val in new_list.items():
+            if val:
                 if svc not in base_list:
                     base_list.append(svc)
-        elif isinstance(new_list, dict):
-            for svc, val in new_list.items():
-                if val:
-                    if svc not in base_list:
-                        base_list.append(svc)
-        return base_list
+    return base_list
 
-    svcs = []
-    diffs = Manifest.DiffManifests(old_manifest, new_manifest)
-    if len(diffs) == 0:
-        return None
 
-    reboot = False
-    if REQUIRE_REBOOT:
-        reboot = True
+class PackageChange(object):
+    """
+    One package's part of a ChangeSet:  the package, the operation
+    ("delete", "install" or "upgrade"), the installed package it
+    replaces (for upgrades), the file that will be used to install it,
+    and whether it needs a reboot or which services it restarts.
+    For deleted packages, File() is None.
+    """
+    __slots__ = ("_pkg", "_op", "_old", "_file", "_delta", "_reboot", "_services")
+
+    def __init__(self, pkg, op, old=None, file=None, delta=False, reboot=False, services=None):
+        self._pkg = pkg
+        self._op = op
+        self._old = old
+        self._file = file
+        self._delta = delta
+        self._reboot = reboot
+        self._services = services or []
+
+    def Package(self):
+        return self._pkg
+
+    def Operation(self):
+        return self._op
+
+    def Old(self):
+        return self._old
+
+    def File(self):
+        return self._file
+
+    def Delta(self):
+        return self._delta
+
+    def RequiresReboot(self):
+        return self._reboot
+
+    def RestartServices(self):
+        return list(self._services)
+
+    def dict(self):
+        return {
+            "Name": self._pkg.Name(),
+            "Operation": self._op,
+            "Version": self._pkg.Version(),
+            "OldVersion": self._old.Version() if self._old else None,
+            "File": self._file,
+            "Delta": self._delta,
+            "Reboot": self._reboot,
+            "Services": list(self._services),
+        }
 
-    if "Packages" in diffs:
-        # Look through the install/upgrade packages
-        for pkg, op, old in diffs["Packages"]:
+
+class ChangeSet(object):
+    """
+    The changes needed to go from one manifest to another:  the
+    package changes, the train and sequence changes, whether a reboot
+    is needed (and why), and the services to restart if not.
+    Use UpdateChangeSet() to get one; they're shared, so they
+    shouldn't be modified.
+    If cache_dir was given, a delta package file is only used when it's
+    in the directory; otherwise it is assumed to be available.
+    """
+
+    def __init__(self, old_manifest, new_manifest, cache_dir=None):
+        self._cache_dir = cache_dir
+        # Delta files looked for in cache_dir, and whether they were there.
+        self._files = {}
+        self._changes = []
+        self._train = None
+        self._sequence = None
+        self._reboot = False
+        self._reason = None
+        self._restart = []
+        self._compute(old_manifest, new_manifest)
+
+    def _DeltaAvailable(self, pkg, old):
+        if self._cache_dir is None:
+            return True
+        path = os.path.join(self._cache_dir, pkg.FileName(old.Version()))
+        self._files[path] = os.path.exists(path)
+        return self._files[path]
+
+    def _compute(self, old_manifest, new_manifest):
+        diffs = Manifest.DiffManifests(old_manifest, new_manifest)
+        self._train = diffs.get("Train")
+        self._sequence = diffs.get("Sequence")
+        for pkg, op, old in diffs.get("Packages", []):
+            services = MergeServiceList([], pkg.RestartServices())
             if op == "delete":
-                continue
-            if op == "install":
-                if pkg.RequiresReboot() == True:
-                    reboot = True
-                else:
-                    pkg_services = pkg.RestartServices()
-                    if pkg_services:
-                        svcs = MergeServiceList(svcs, pkg_services)
-            elif op == "upgrade":
-                # A bit trickier.
+                change = PackageChange(pkg, op, services=services)
+            elif op == "install":
+                reboot = pkg.RequiresReboot() == True
+                change = PackageChange(pkg, op, file=pkg.FileName(),
+                                       reboot=reboot, services=services)
+            else:
                 # If there is a list of services to restart, the update
                 # path wants to look at that rather than the requires reboot.
-                # However, one service could be to reboot (this is handled
-                # below).
                 upd = pkg.Update(old.Version())
-                if cache_dir:
-                    update_fname = os.path.join(cache_dir, pkg.FileName(old.Version()))
-                else:
-                    update_fname = None
-
-                if upd and (update_fname is None or os.path.exists(update_fname)):
-                    pkg_services = upd.RestartServices()
-                    if pkg_services:
-                        svcs = MergeServiceList(svcs, pkg_services)
-                    else:
-                        if upd.RequiresReboot() == True:
-                            reboot = True
+                if upd and self._DeltaAvailable(pkg, old):
+                    services = MergeServiceList([], upd.RestartServices())
+                    reboot = not services and upd.RequiresReboot() == True
+                    change = PackageChange(pkg, op, old, file=pkg.FileName(old.Version()),
+                                           delta=True, reboot=reboot, services=services)
                 else:
                     # Have to assume the full package exists
-                    if pkg.RequiresReboot() == True:
-                        reboot = True
-                    else:
-                        pkg_services = pkg.RestartServices()
-                        if pkg_services:
-                            svcs = MergeServiceList(svcs, pkg_services)
-    else:
-        reboot = False
-    if len(diffs) == 0:
-        return None
-    if not reboot and svcs:
-        if not VerifyServices(svcs):
-            reboot = True
-        else:
-            diffs["Restart"] = svcs
-    diffs["Reboot"] = reboot
-    return diffs
+                    reboot = pkg.RequiresReboot() == True
+                    change = PackageChange(pkg, op, old, file=pkg.FileName(),
+                                           reboot=reboot, services=services)
+            self._changes.append(change)
+
+        if not self._changes:
+            # By definition, no package changes means no reboot.
+            return
+        if REQUIRE_REBOOT:
+            self._reboot = True
+            self._reason = "Rebootless updates are disabled"
+            return
+        for change in self._changes:
+            if change.RequiresReboot():
+                self._reboot = True
+                self._reason = "Package %s requires a reboot" % change.Package().Name()
+                return
+            if change.Operation() != "delete":
+                MergeServiceList(self._restart, change.RestartServices())
+        if self._restart and not VerifyServices(self._restart):
+            self._reboot = True
+            self._reason = "Unknown services to restart: %s" % ", ".join(
+                [svc for svc in self._restart if svc not in SERVICES])
+            self._restart = []
+
+    def Valid(self):
+        """
+        Whether the delta files looked for are still as they were.
+        """
+        for path, exists in self._files.items():
+            if os.path.exists(path) != exists:
+                return False
+        return True
 
+    def Empty(self):
+        return not (self._changes or self._train or self._sequence)
 
-def CheckForUpdates(handler=None, train=None, cache_dir=None, diff_handler=None):
-    """
-    Check for an updated manifest.  If cache_dir is none, then we try
+    def Changes(self):
+        return list(self._changes)
+
+    def Reboot(self):
+        return self._reboot
+
+    def RebootReason(self):
+        return self._reason
+
+    def Restart(self):
+        """
+        The services to restart for the update, if no reboot is needed.
+        """
+        return list(self._restart)
+
+    def ServiceRestarts(self):
+        """
+        As Restart(), but including the services of deleted packages.
+        """
+        if self._reboot:
+            return []
+        retval = []
+        for change in self._changes:
+            MergeServiceList(retval, change.RestartServices())
+        return retval
+
+    def Diffs(self):
+        """
+        The changes in the form GetUpdateChanges() returns, or None
+        if there are no changes.  This is a new dictionary each time.
+        """
+        if self.Empty():
+            return None
+        diffs = {}
+        if self._changes:
+            diffs["Packages"] = [(c.Package(), c.Operation(), c.Old()) for c in self._changes]
+            if self._restart:
+                diffs["Restart"] = list(self._restart)
+        if self._train:
+            diffs["Train"] = self._train
+        if self._sequence:
+            diffs["Sequence"] = self._sequence
+        diffs["Reboot"] = self._reboot
+        return diffs
+
+    def dict(self):
+        return {
+            "Packages": [c.dict() for c in self._changes],
+            "Train": list(self._train) if self._train else None,
+            "Sequence": list(self._sequence) if self._sequence else None,
+            "Reboot": self._reboot,
+            "RebootReason": self._reason,
+            "Restart": list(self._restart),
+        }
+
+    def String(self):
+        return json.dumps(self.dict(), sort_keys=True, indent=4, separators=(',', ': '))
+
+
+# The most recent change sets, keyed by the two manifests,
+# the cache directory, and REQUIRE_REBOOT.
+CHANGE_SET_CACHE_SIZE = 8
+_change_sets = OrderedDict()
+_change_sets_lock = threading.Lock()
+
+
+def UpdateChangeSet(old_manifest, new_manifest, cache_dir=None):
+    """
+    Return the ChangeSet for going from old_manifest to new_manifest.
+    This is only computed once for the same manifests and cache
+    directory, unless the delta files in the directory change.
+    """
+    key = (
+        hashlib.sha256(old_manifest.String().encode('utf8')).hexdigest(),
+        hashlib.sha256(new_manifest.String().encode('utf8')).hexdigest(),
+        cache_dir,
+        REQUIRE_REBOOT,
+    )
+    with _change_sets_lock:
+        changes = _change_sets.get(key)
+        if changes is not None:
+            if changes.Valid():
+                _change_sets.move_to_end(key)
+                return changes
+            _change_sets.pop(key)
+
+    changes = ChangeSet(old_manifest, new_manifest, cache_dir=cache_dir)
+    with _change_sets_lock:
+        _change_sets[key] = changes
+        while len(_change_sets) > CHANGE_SET_CACHE_SIZE:
+            _change_sets.popitem(last=False)
+    return changes
+
+
+def GetUpdateChanges(old_manifest, new_manifest, cache_dir=None):
+    """
+    This is used by both PendingUpdatesChanges() and CheckForUpdates().
+    The difference between the two is that the latter doesn't necessarily
+    have a cache directory, so if cache_dir is none, we have to assume the
+    update package exists.
+    This returns a dictionary that will have at least "Reboot" as a key,
+    or None if there are no changes; see UpdateChangeSet().
+    """
+    return UpdateChangeSet(old_manifest, new_manifest, cache_dir=cache_dir).Diffs()
+
+
+def CheckForUpdates(handler=None, train=None, cache_dir=None, diff_handler=None):
+    """
+    Check for an updated manifest.  If cache_dir is none, then we try
     to download just the latest manifest for the given train, and
     compare it to the current system.  If cache_dir is set, then we
     use the manifest in that directory.
@@ -879,9 +1515,34 @@ def CheckForUpdates(handler=None, train=None, cache_dir=None, diff_handler=None)
     return new_manifest
 
 
+def DownloadPlan(packages, directory, pkg_type=None):
+    """
+    Work out which file will be used for each of packages, given what
+    is already in directory.  Returns a tuple of a list and the total
+    number of bytes expected to be downloaded.  Each list element is
+    the cheapest entry from Configuration.PackageFilePlan(), with the
+    package name added (as "Name").  If the size of a file isn't known,
+    its Transfer is None, and it isn't counted in the total.
+    """
+    conf = Configuration.SystemConfiguration()
+    plan = []
+    total = 0
+    for pkg in packages:
+        choices = conf.PackageFilePlan(pkg, save_dir=directory, pkg_type=pkg_type)
+        if not choices:
+            continue
+        choice = dict(choices[0], Name=pkg.Name())
+        plan.append(choice)
+        if choice["Transfer"]:
+            total += choice["Transfer"]
+    return plan, total
+
+
+@Timeline.Timed("DownloadUpdate", run=True, failure=False)
 def DownloadUpdate(train, directory, get_handler=None,
                    check_handler=None, pkg_type=None,
-                   ignore_space=False):
+                   ignore_space=False, plan_handler=None, rate_limit=None,
+                   pipeline=None):
     """
     Download, if necessary, the LATEST update for train; download
     delta packages if possible.  Checks to see if the existing content
@@ -892,6 +1553,12 @@ def DownloadUpdate(train, directory, get_handler=None,
     it has to redownload for any reason.
     Returns True if an update is available, False if no update is avialbale.
     Raises exceptions on errors.
+    Before downloading the packages, the plan from DownloadPlan() is
+    logged, and passed to plan_handler (if given) as plan_handler(plan, total).
+    rate_limit (bytes per second) overrides the configured download rate limit.
+    If pipeline (an UpdatePipeline) is given, it is started once the
+    packages to download are known, and each package is handed to it
+    as soon as it has been downloaded and verified.
     """
 
     conf = Configuration.SystemConfiguration()
@@ -1006,7 +1673,7 @@ def DownloadUpdate(train, directory, get_handler=None,
         latest_mani.RunValidationProgram(directory, kind=Manifest.VALIDATE_UPDATE)
 
         # Find out what differences there are
-        diffs = Manifest.DiffManifests(mani, latest_mani)
+        diffs = GetUpdateChanges(mani, latest_mani)
         if diffs is None or len(diffs) == 0:
             log.debug("DownloadUpdate:  No update available")
             # Remove the cache directory and empty manifest file
@@ -1029,31 +1696,47 @@ def DownloadUpdate(train, directory, get_handler=None,
 
         log.debug("Update does%s seem to require a reboot" % "" if reboot_required else " not")
 
+        plan, total = DownloadPlan(download_packages, directory, pkg_type=pkg_type)
+        for entry in plan:
+            log.debug("DownloadUpdate:  %s will use %s%s, %s bytes to transfer (%d already cached)" % (
+                entry["Name"], entry["Filename"], " (delta)" if entry["Delta"] else "",
+                entry["Transfer"], entry["Cached"]))
+        log.info("DownloadUpdate:  %d packages, %d bytes expected to be downloaded" % (len(plan), total))
+        if plan_handler:
+            plan_handler(plan, total)
+        if pipeline:
+            pipeline.Start(latest_mani, diffs)
+
         # Next steps:  download the package files.
         for indx, pkg in enumerate(download_packages):
             # This is where we find out for real if a reboot is required.
             # To do that, we may need to know which update was downloaded.
             if check_handler:
                 check_handler(indx + 1, pkg=pkg, pkgList=download_packages)
-            pkg_file = conf.FindPackageFile(
-                pkg, save_dir=directory, handler=get_handler, pkg_type=pkg_type,
-                ignore_space=ignore_space
-            )
+            with Timeline.StartSpan("FindPackageFile", Package=pkg.Name()) as span:
+                pkg_file = conf.FindPackageFile(
+                    pkg, save_dir=directory, handler=get_handler, pkg_type=pkg_type,
+                    ignore_space=ignore_space, rate_limit=rate_limit
+                )
+                if pkg_file is not None:
+                    span.Add(Bytes=os.fstat(pkg_file.fileno()).st_size)
             if pkg_file is None:
                 log.error("Could not download package file for %s" % pkg.Name())
                 RemoveUpdate(directory)
                 return False
             else:
-                pkg_file.close()
+                try:
+                    if pipeline and pipeline.Active():
+                        pipeline.Install(pkg, pkg_file, index=indx + 1, pkgList=download_packages)
+                finally:
+                    pkg_file.close()
 
         # Almost done:  get a changelog if one exists for the train
         # If we can't get it, we don't care.
-        try:
-            with conf.GetChangeLog(train, save_dir=directory, handler=get_handler):
-                pass
-        except AttributeError:
-            # GetChangeLog can return None, which throws things, no pun intended
-            pass
+        # GetChangeLog returns None if there isn't one.
+        changelog = conf.GetChangeLog(train, save_dir=directory, handler=get_handler)
+        if changelog:
+            changelog.close()
         # Then save the manifest file.
         # Create the SEQUENCE file.
         with open(directory + "/SEQUENCE", "w") as f:
@@ -1084,9 +1767,20 @@ def PendingUpdates(directory):
         return False
 
 
-def PendingUpdatesChanges(directory):
+def PendingUpdatesChanges(directory, paranoid=False):
     """
-    Return a list (a la CheckForUpdates handler right now) of
+    Return a dictionary (as GetUpdateChanges() does) of the changes
+    for the update in <directory>, or None; see PendingUpdatesChangeSet().
+    """
+    changes = PendingUpdatesChangeSet(directory, paranoid=paranoid)
+    if changes is None:
+        return None
+    return changes.Diffs()
+
+
+def PendingUpdatesChangeSet(directory, paranoid=False):
+    """
+    Return the ChangeSet (see UpdateChangeSet()) for the
     changes between the currently installed system and the
     downloaded contents in <directory>.  If <directory>'s values
     are incomplete or invalid for whatever reason, return
@@ -1095,11 +1789,12 @@ def PendingUpdatesChanges(directory):
     one part of it is invalid -- manifest is not valid, signature isn't
     valid, checksum for a file is invalid, or the stashed sequence
     number does not match the current system's sequence.
+    paranoid is passed on to VerifyUpdate().
     """
     mani_file = None
     conf = Configuration.SystemConfiguration()
     try:
-        mani_file = VerifyUpdate(directory)
+        mani_file = VerifyUpdate(directory, paranoid=paranoid)
     except UpdateBusyCacheException:
         log.debug("Cache directory %s is busy, so no update available" % directory)
         raise
@@ -1129,8 +1824,7 @@ def PendingUpdatesChanges(directory):
         # updates if that's what got downloaded.
         # By definition, if there are no Packages differences, a reboot
         # isn't required.
-        diffs = GetUpdateChanges(conf.SystemManifest(), new_manifest, cache_dir=directory)
-        return diffs
+        return UpdateChangeSet(conf.SystemManifest(), new_manifest, cache_dir=directory)
     else:
         return None
 
@@ -1143,53 +1837,27 @@ def ServiceRestarts(directory):
     which will be an array with no items.)  If a reboot is required,
     it returns an empty array.
     """
-    changes = PendingUpdatesChanges(directory)
-    if changes is None:
+    changes = PendingUpdatesChangeSet(directory)
+    if changes is None or changes.Empty():
         return None
-    retval = []
-    if changes["Reboot"] is False:
-        # Only look if we don't need to reboot
-        if "Packages" in changes:
-            # All service changes are package-specific
-            for (pkg, op, old) in changes["Packages"]:
-                svcs = None
-                if op in ("install", "delete"):
-                    # Either the service is added or removed,
-                    # either way we add it to the list.
-                    svcs = pkg.RestartServices()
-                elif op == "upgrade":
-                    # We need to see if we have the delta package
-                    # file or not.
-                    delta_pkg_file = os.path.join(directory, pkg.FileName(old.Version()))
-                    if os.path.exists(delta_pkg_file):
-                        # Okay, we're doing an update
-                        upd = pkg.Update(old.Version())
-                        if not upd:
-                            # How can this happen?
-                            raise Exception("I am confused")
-                        svcs = upd.RestartServices()
-                    else:
-                        # Only need to the services listed at the outer level
-                        svcs = pkg.RestartServices()
-
-                if svcs:
-                    for svc in svcs:
-                        if svc not in retval:
-                            retval.append(svc)
-
-    return retval
+    return changes.ServiceRestarts()
 
 def ExtractFrozenUpdate(tarball, dest_dir, verbose=False):
     """
     Extract the files in the given tarball into dest_dir.
     This assumes dest_dir already exists.
+    The tarball is read once, as a stream:  each file is hashed as
+    it is written, and the checksums are saved in the verification
+    stamp (see VerifiedStamp), so that VerifyUpdate() doesn't need
+    to read the files again.
     """
     extracted = False
     conf = Configuration.SystemConfiguration()
+    stamp = VerifiedStamp(dest_dir)
     try:
-        with tarfile.open(tarball) as tf:
-            files = tf.getmembers()
-            for f in files:
+        with Timeline.StartSpan("ExtractFrozenUpdate") as span, \
+             tarfile.open(tarball, mode="r|*") as tf:
+            for f in tf:
                 if f.name in ("./", ".", "./."):
                     continue
                 if not f.name.startswith("./"):
@@ -1200,15 +1868,31 @@ def ExtractFrozenUpdate(tarball, dest_dir, verbose=False):
                     if verbose:
                         log.debug("Illegal member name {0} has too many path components".format(f.name))
                     continue
+                name = f.name[2:]
+                if name in ("", "..", VERIFIED_STAMP_FILE) or not f.isfile():
+                    if verbose:
+                        log.debug("Illegal member {0}".format(f.name))
+                    continue
                 if verbose:
                     log.debug("Extracting {0}".format(f.name))
-                tf.extract(f.name, path=dest_dir)
+                path = os.path.join(dest_dir, name)
+                hash = hashlib.sha256()
+                src = tf.extractfile(f)
+                with open(path, "wb") as dst:
+                    for piece in iter(lambda: src.read(1024 * 1024), b''):
+                        hash.update(piece)
+                        dst.write(piece)
+                os.chmod(path, f.mode & 0o777)
+                os.utime(path, (f.mtime, f.mtime))
+                stamp.Record(name, hash.hexdigest())
+                span.Add(Files=1, Bytes=f.size)
                 extracted = True
                 if verbose:
                     log.debug("Done extracting {0}".format(f.name))
     except tarfile.TarError:
-        raise Exceptions.UpdateBadFrozenFile("Bad tar file {0}".format(tarball))
+        raise UpdateBadFrozenFile("Bad tar file {0}".format(tarball))
     if extracted:
+        stamp.Save()
         # We've extracted some files, and it may be an updated!
         with open(os.path.join(dest_dir, "SEQUENCE"), "w") as s:
             s.write(conf.SystemManifest().Sequence())
@@ -1217,22 +1901,156 @@ def ExtractFrozenUpdate(tarball, dest_dir, verbose=False):
     return True
 
 
+def _NewBootName(new_manifest):
+    """
+    The name of the boot environment new_manifest is installed into.
+    """
+    if new_manifest.Version().startswith(Avatar() + "-"):
+        return new_manifest.Version()[len(Avatar() + "-"):]
+    else:
+        return "%s-%s" % (Avatar(), new_manifest.Version()[len(Avatar() + "-"):])
+
+
+def _EstimatedSpace(packages):
+    """
+    Estimate the space needed to install packages, from the
+    sizes in the manifest, without looking at the package files.
+    """
+    total = 0
+    for pkg in packages:
+        if pkg.Size():
+            total += int(pkg.Size())
+    return total
+
+
+def _CreateBootClone(new_boot_name):
+    """
+    Create and mount the boot environment an update will be installed
+    into.  If new_boot_name is taken, a numbered variant of it is used.
+    Returns a tuple of the name that was used and the mount point.
+    Raises UpdateBootEnvironmentException on failure.
+    """
+    mount_point = None
+    try:
+        count = 0
+        create_name = new_boot_name
+        while count < 500:
+            try:
+                rv = CreateClone(create_name)
+                break
+            except KeyError:
+                count = count + 1
+                create_name = "{0}-{1}".format(new_boot_name, count)
+                rv = False
+                continue
+        
+        new_boot_name = create_name
+        if rv is False:
+            log.debug("Failed to create BE %s" % create_name)
+            # It's possible the boot environment already exists.
+            s = None
+            clones = ListClones()
+            if clones:
+                found = False
+                for c in clones:
+                    if c["name"] == new_boot_name:
+                        found = True
+                        if c["mountpoint"] == "/":
+                            s = "Cannot create boot-environment with same name as current boot-environment (%s)" % new_boot_name
+                            break
+                        elif c["active"] in ("R", "NR"):
+                            s = "Cannot destroy boot-environment selected for next reboot (%s)" % new_boot_name
+                        else:
+                            # We'll have to destroy it.
+                            # I'd like to rename it, but that gets tricky, due
+                            # to nicknames.
+                            if DeleteClone(new_boot_name) == False:
+                                s = "Cannot destroy BE %s which is necessary for upgrade" % new_boot_name
+                                log.debug(s)
+                            elif CreateClone(new_boot_name) is False:
+                                s = "Cannot create new BE %s even after a second attempt" % new_boot_name
+                                log.debug(s)
+                        break
+                if found is False:
+                    s = "Unable to create boot-environment %s" % new_boot_name
+            else:
+                log.debug("Unable to list clones after creation failure")
+                s = "Unable to create boot-environment %s" % new_boot_name
+            if s:
+                log.error(s)
+                raise UpdateBootEnvironmentException(s)
+        if mount_point is None:
+            mount_point = MountClone(new_boot_name)
+    except:
+        mount_point = None
+        s = sys.exc_info()[0]
+    if mount_point is None:
+        s = "Unable to mount boot-environment %s" % new_boot_name
+        log.error(s)
+        DeleteClone(new_boot_name)
+        raise UpdateBootEnvironmentException(s)
+    return (new_boot_name, mount_point)
+
+
+def _FindBootClone(new_boot_name, mount_point):
+    """
+    Look up the boot environment just created for an update, and turn
+    off keep and sync on it while it's being installed into.  Returns
+    the clone; if it can't be found, it is cleaned up, and
+    UpdateBootEnvironmentException is raised.
+    """
+    try:
+        cl = FindClone(new_boot_name)
+    except:
+        cl = None
+    if cl is None:
+        if mount_point:
+            try:
+                UnmountClone(new_boot_name, mount_point)
+                DeleteClone(new_boot_name)
+            except:
+                log.debug("Got an exception while trying to clean up after FindClone", exc_info=True)
+                
+        s = "Unable to find BE %s just after creation" % new_boot_name
+        log.debug(s)
+        raise UpdateBootEnvironmentException(s)
+    else:
+        if not CloneSetAttr(cl, keep=False, sync="disabled"):
+            s = "Unable to set keep attribute on BE %s" % new_boot_name
+            log.debug(s)
+    return cl
+
+
+def _DiscardBootClone(new_boot_name, mount_point):
+    """
+    Undo _CreateBootClone(), after an update failed.
+    """
+    if mount_point:
+        UnmountClone(new_boot_name, mount_point)
+    if new_boot_name:
+        DeleteClone(new_boot_name)
+
+
+@Timeline.Timed("ApplyUpdate", run=True)
 def ApplyUpdate(directory,
                 install_handler=None,
                 force_reboot=False,
                 ignore_space=False,
                 progressFunc=None,
-                force_trampoline=None
+                force_trampoline=None,
+                paranoid=False
                 ):
     """
     Apply the update in <directory>.  As with PendingUpdates(), it will
     have to verify the contents before it actually installs them, so
     it has the same behaviour with incomplete or invalid content.
+    If paranoid is set, every package file is hashed again, rather than
+    trusting the checksums recorded when they were last verified.
     """
     rv = False
     conf = Configuration.SystemConfiguration()
     # Note that PendingUpdates may raise an exception
-    changes = PendingUpdatesChanges(directory)
+    changes = PendingUpdatesChanges(directory, paranoid=paranoid)
 
     if changes is None:
         # This means no updates to apply, and so nothing to do.
@@ -1284,10 +2102,7 @@ def ApplyUpdate(directory,
             else:
                 log.error("Unknown package operation %s for %s" % (op, pkg.Name()))
 
-    if new_manifest.Version().startswith(Avatar() + "-"):
-        new_boot_name = new_manifest.Version()[len(Avatar() + "-"):]
-    else:
-        new_boot_name = "%s-%s" % (Avatar(), new_manifest.Version()[len(Avatar() + "-"):])
+    new_boot_name = _NewBootName(new_manifest)
 
     log.debug("new_boot_name = %s, reboot = %s" % (new_boot_name, reboot))
 
@@ -1299,9 +2114,6 @@ def ApplyUpdate(directory,
         log.debug("ApplyUpdate: force_trampoline = {} (bool {})".format(force_trampoline, bool(force_trampoline)))
         installer.trampoline = bool(force_trampoline)
 
-    installer.GetPackages(pkgList=updated_packages)
-    log.debug("Installer got packages %s" % installer.Packages())
-    
     """
     There is no way around this:  this is a horrible hack.  It
     only works with gzipped files, the module for which, for some
@@ -1319,79 +2131,57 @@ def ApplyUpdate(directory,
             rv = os.fstat(gzf.fileno()).st_size
         return rv
 
-    space_needed = 0
-    for f in installer.Packages():
-        [(dc, fobj)] = f.items()
-        try:
-            space_needed += ActualSize(fobj)
-        except:
-            pass
-        
-    if not ignore_space and not PruneClones(required=space_needed):
-        raise UpdateInsufficientSpace("Insufficent space to install update")
-    
-    mount_point = None
-    if reboot:
-        # Need to create a new boot environment
+    # Pruning old boot environments, and creating and mounting the
+    # new one, doesn't need the package files, so for a reboot update
+    # it's done while they're being opened.  The space needed isn't
+    # known until they have been, so pruning starts with an estimate
+    # from the manifest, and is topped up afterwards if that was low.
+    space_estimate = _EstimatedSpace(updated_packages)
+
+    def PrepareClone():
+        if not ignore_space and not PruneClones(required=space_estimate):
+            raise UpdateInsufficientSpace("Insufficent space to install update")
+        return _CreateBootClone(new_boot_name)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        clone_future = executor.submit(PrepareClone) if reboot else None
         try:
-            count = 0
-            create_name = new_boot_name
-            while count < 500:
+            with Timeline.StartSpan("GetPackages", Files=len(updated_packages)):
+                installer.GetPackages(pkgList=updated_packages)
+            log.debug("Installer got packages %s" % installer.Packages())
+
+            space_needed = 0
+            for f in installer.Packages():
+                [(dc, fobj)] = f.items()
                 try:
-                    rv = CreateClone(create_name)
-                    break
-                except KeyError:
-                    count = count + 1
-                    create_name = "{0}-{1}".format(new_boot_name, count)
-                    rv = False
-                    continue
-            
-            new_boot_name = create_name
-            if rv is False:
-                log.debug("Failed to create BE %s" % create_name)
-                # It's possible the boot environment already exists.
-                s = None
-                clones = ListClones()
-                if clones:
-                    found = False
-                    for c in clones:
-                        if c["name"] == new_boot_name:
-                            found = True
-                            if c["mountpoint"] == "/":
-                                s = "Cannot create boot-environment with same name as current boot-environment (%s)" % new_boot_name
-                                break
-                            elif c["active"] in ("R", "NR"):
-                                s = "Cannot destroy boot-environment selected for next reboot (%s)" % new_boot_name
-                            else:
-                                # We'll have to destroy it.
-                                # I'd like to rename it, but that gets tricky, due
-                                # to nicknames.
-                                if DeleteClone(new_boot_name) == False:
-                                    s = "Cannot destroy BE %s which is necessary for upgrade" % new_boot_name
-                                    log.debug(s)
-                                elif CreateClone(new_boot_name) is False:
-                                    s = "Cannot create new BE %s even after a second attempt" % new_boot_name
-                                    log.debug(s)
-                            break
-                    if found is False:
-                        s = "Unable to create boot-environment %s" % new_boot_name
+                    space_needed += ActualSize(fobj)
+                except:
+                    pass
+        except BaseException as e:
+            if clone_future:
+                log.error("Unable to get packages (%s), so removing new boot environment" % str(e))
+                try:
+                    (create_name, create_mount) = clone_future.result()
+                except BaseException:
+                    # That failed as well, and has cleaned up after itself
+                    log.debug("Boot environment creation failed as well", exc_info=True)
                 else:
-                    log.debug("Unable to list clones after creation failure")
-                    s = "Unable to create boot-environment %s" % new_boot_name
-                if s:
-                    log.error(s)
-                    raise UpdateBootEnvironmentException(s)
-            if mount_point is None:
-                mount_point = MountClone(new_boot_name)
-        except:
-            mount_point = None
-            s = sys.exc_info()[0]
-        if mount_point is None:
-            s = "Unable to mount boot-environment %s" % new_boot_name
-            log.error(s)
-            DeleteClone(new_boot_name)
-            raise UpdateBootEnvironmentException(s)
+                    _DiscardBootClone(create_name, create_mount)
+            raise e
+
+    mount_point = None
+    if reboot:
+        # Need to create a new boot environment; this raises the
+        # exception if that (or pruning for it) failed.
+        (new_boot_name, mount_point) = clone_future.result()
+        if not ignore_space and space_needed > space_estimate and not PruneClones(required=space_needed):
+            _DiscardBootClone(new_boot_name, mount_point)
+            raise UpdateInsufficientSpace("Insufficent space to install update")
     else:
+        if not ignore_space and not PruneClones(required=space_needed):
+            raise UpdateInsufficientSpace("Insufficent space to install update")
+
         # Need to do magic to move the current boot environment aside,
         # and assign the newname to the current boot environment.
         # Also need to make a snapshot of the current root so we can
@@ -1445,32 +2235,15 @@ def ApplyUpdate(directory,
                     "freenas-boot/ROOT/{0}".format(root_env["realname"])]
 
             RunCommand(cmd, args)
+            _ClonesChanged()
 
             raise UpdateBootEnvironmentException(
                 "Unable to create new boot environment {0}".format(new_boot_name)
             )
         if "Restart" in changes:
             service_list = StopServices(changes["Restart"])
-    try:
-        cl = FindClone(new_boot_name)
-    except:
-        cl = None
-    if cl is None:
-        if mount_point:
-            try:
-                UnmountClone(new_boot_name, mount_point)
-                DeleteClone(new_boot_name)
-            except:
-                log.debug("Got an exception while trying to clean up after FindClone", exc_info=True)
-                
-        s = "Unable to find BE %s just after creation" % new_boot_name
-        log.debug(s)
-        raise UpdateBootEnvironmentException(s)
-    else:
-        if not CloneSetAttr(cl, keep=False, sync="disabled"):
-            s = "Unable to set keep attribute on BE %s" % new_boot_name
-            log.debug(s)
-            
+    cl = _FindBootClone(new_boot_name, mount_point)
+
     installer.SetRoot(mount_point)
     
     # Now we start doing the update!
@@ -1485,14 +2258,15 @@ def ApplyUpdate(directory,
         # Remove any deleted packages
         for pkg in deleted_packages:
             log.debug("About to delete package %s from %s" % (pkg.Name(), mount_point))
-            if conf.PackageDB(mount_point).RemovePackageContents(pkg.Name()) == False:
-                s = "Unable to remove contents for package %s" % pkg.Name()
-                if mount_point:
-                    UnmountClone(new_boot_name, mount_point)
-                    mount_point = None
-                    DeleteClone(new_boot_name)
-                raise UpdatePackageException(s)
-            conf.PackageDB(mount_point).RemovePackage(pkg.Name())
+            with Timeline.StartSpan("RemovePackage", Package=pkg.Name()):
+                if conf.PackageDB(mount_point).RemovePackageContents(pkg.Name()) == False:
+                    s = "Unable to remove contents for package %s" % pkg.Name()
+                    if mount_point:
+                        UnmountClone(new_boot_name, mount_point)
+                        mount_point = None
+                        DeleteClone(new_boot_name)
+                    raise UpdatePackageException(s)
+                conf.PackageDB(mount_point).RemovePackage(pkg.Name())
 
         # Now to start installing the packages
         rv = False
@@ -1533,10 +2307,7 @@ def ApplyUpdate(directory,
         # Cleanup code is entirely different for reboot vs non reboot
         log.error("Update got exception during update: %s", e, exc_info=True)
         if reboot:
-            if mount_point:
-                UnmountClone(new_boot_name, mount_point)
-            if new_boot_name:
-                DeleteClone(new_boot_name)
+            _DiscardBootClone(new_boot_name, mount_point)
         else:
             # Need to roll back
             # We also need to delete the renamed clone of /,
@@ -1558,6 +2329,7 @@ def ApplyUpdate(directory,
                     rv = RunCommand(cmd, args)
                     if rv is False:
                         log.error("Unable to set nickname, wonder what I did wrong")
+                    _ClonesChanged()
                     args = ["destroy", "-r", snapshot_name]
                     rv = RunCommand(cmd, args)
                     if rv is False:
@@ -1569,7 +2341,362 @@ def ApplyUpdate(directory,
     return reboot
 
 
-def VerifyUpdate(directory):
+class UpdatePipeline(object):
+    """
+    Install an update into a new boot environment while it is being
+    downloaded.  DownloadUpdate() calls Start() once it knows what
+    the update contains; the boot environment is then created and
+    mounted, and each package is installed into it by Install() as
+    soon as its file has been verified.  Finish() or Abort() is then
+    called by PipelinedUpdate().
+    Only updates which need a reboot are pipelined; for anything else,
+    Start() leaves the pipeline inactive, and the update is applied
+    by ApplyUpdate() once the download is done.
+    """
+    def __init__(self, directory,
+                 install_handler=None,
+                 force_reboot=False,
+                 ignore_space=False,
+                 progressFunc=None,
+                 force_trampoline=None):
+        self._directory = directory
+        self._install_handler = install_handler
+        self._force_reboot = force_reboot
+        self._ignore_space = ignore_space
+        self._progressFunc = progressFunc
+        self._force_trampoline = force_trampoline
+        self._manifest = None
+        self._installer = None
+        self._clone = None
+        self._boot_name = None
+        self._mount_point = None
+
+    def Active(self):
+        return self._mount_point is not None
+
+    def Start(self, new_manifest, changes):
+        """
+        Get ready to install the update described by new_manifest and
+        changes (as returned by GetUpdateChanges()).  Returns True if
+        packages should be given to Install(), False otherwise.
+        """
+        reboot = changes.get("Reboot", True)
+        if self._force_reboot or REQUIRE_REBOOT:
+            reboot = True
+        if not reboot:
+            log.debug("UpdatePipeline:  update does not require a reboot, so not pipelining it")
+            return False
+
+        deleted_packages = []
+        updated_packages = []
+        for (pkg, op, old) in changes.get("Packages", []):
+            if op == "delete":
+                deleted_packages.append(pkg)
+            else:
+                updated_packages.append(pkg)
+        # The files aren't here yet, so this is the best there is
+        space_needed = _EstimatedSpace(updated_packages)
+
+        conf = Configuration.SystemConfiguration()
+        new_manifest.RunValidationProgram(self._directory)
+        if not self._ignore_space and not PruneClones(required=space_needed):
+            raise UpdateInsufficientSpace("Insufficent space to install update")
+
+        (self._boot_name, self._mount_point) = _CreateBootClone(_NewBootName(new_manifest))
+        log.debug("UpdatePipeline:  installing into %s at %s" % (self._boot_name, self._mount_point))
+        try:
+            self._clone = _FindBootClone(self._boot_name, self._mount_point)
+        except:
+            # _FindBootClone() has already cleaned up
+            self._boot_name = self._mount_point = None
+            raise
+        self._manifest = new_manifest
+        self._installer = Installer.Installer(manifest=new_manifest, config=conf)
+        if self._force_trampoline is not None:
+            self._installer.trampoline = bool(self._force_trampoline)
+        self._installer.SetRoot(self._mount_point)
+
+        for pkg in deleted_packages:
+            log.debug("About to delete package %s from %s" % (pkg.Name(), self._mount_point))
+            if conf.PackageDB(self._mount_point).RemovePackageContents(pkg.Name()) == False:
+                raise UpdatePackageException("Unable to remove contents for package %s" % pkg.Name())
+            conf.PackageDB(self._mount_point).RemovePackage(pkg.Name())
+        return True
+
+    def Install(self, pkg, pkg_file, index=None, pkgList=None):
+        """
+        Install one (verified) package file into the new boot environment.
+        """
+        log.debug("UpdatePipeline:  installing %s" % pkg.Name())
+        if self._install_handler is not None:
+            self._install_handler(index=index, name=pkg.Name(), packages=pkgList)
+        if self._installer.InstallPackage(pkg.Name(), pkg_file, progressFunc=self._progressFunc) is False:
+            raise UpdatePackageException("Unable to install package %s" % pkg.Name())
+
+    def Finish(self):
+        """
+        Everything has been installed:  save the manifest, unmount the
+        boot environment, and activate it.  Cleans up, and raises an
+        exception, on failure.
+        """
+        try:
+            self._manifest.Save(self._mount_point)
+            if not CloneSetAttr(self._clone, sync=None):
+                log.debug("Unable to clear sync on BE {}".format(self._clone["realname"]))
+            if UnmountClone(self._boot_name, self._mount_point) is False:
+                s = "Unable to unmount clone environment %s from mount point %s" % (self._boot_name, self._mount_point)
+                log.error(s)
+                raise UpdateBootEnvironmentException(s)
+            self._mount_point = None
+            if ActivateClone(self._boot_name) is False:
+                s = "Unable to activate clone environment %s" % self._boot_name
+                log.error(s)
+                raise UpdateBootEnvironmentException(s)
+            RemoveUpdate(self._directory)
+        except BaseException as e:
+            log.error("Update got exception during update: %s", e, exc_info=True)
+            self.Abort()
+            raise e
+        self._boot_name = None
+
+    def Abort(self):
+        """
+        Get rid of the boot environment, if one was created.
+        """
+        if self._boot_name:
+            _DiscardBootClone(self._boot_name, self._mount_point)
+        self._boot_name = self._mount_point = None
+
+
+@Timeline.Timed("PipelinedUpdate", run=True)
+def PipelinedUpdate(train, directory,
+                    get_handler=None,
+                    check_handler=None,
+                    pkg_type=None,
+                    install_handler=None,
+                    force_reboot=False,
+                    ignore_space=False,
+                    progressFunc=None,
+                    force_trampoline=None,
+                    rate_limit=None):
+    """
+    Download the latest update for train into directory, and apply it,
+    installing each package as soon as it has been downloaded, rather
+    than waiting for the whole download to finish.  (See UpdatePipeline.)
+    Returns None if there is no update; otherwise, returns what
+    ApplyUpdate() does.  Raises exceptions on errors, having removed
+    the new boot environment.
+    """
+    pipeline = UpdatePipeline(directory,
+                              install_handler=install_handler,
+                              force_reboot=force_reboot,
+                              ignore_space=ignore_space,
+                              progressFunc=progressFunc,
+                              force_trampoline=force_trampoline)
+    try:
+        rv = DownloadUpdate(train, directory,
+                            get_handler=get_handler,
+                            check_handler=check_handler,
+                            pkg_type=pkg_type,
+                            ignore_space=ignore_space,
+                            rate_limit=rate_limit,
+                            pipeline=pipeline)
+    except BaseException as e:
+        log.error("Update got exception during download: %s", e, exc_info=True)
+        pipeline.Abort()
+        raise e
+
+    if not pipeline.Active():
+        # Either there's no update, the update was already downloaded,
+        # or it can be applied without a reboot.
+        if rv is False:
+            return None
+        return ApplyUpdate(directory,
+                           install_handler=install_handler,
+                           force_reboot=force_reboot,
+                           ignore_space=ignore_space,
+                           progressFunc=progressFunc,
+                           force_trampoline=force_trampoline)
+    if rv is False:
+        pipeline.Abort()
+        raise UpdatePackageException("Unable to download all of the packages for the update")
+
+    pipeline.Finish()
+    return True
+
+
+def _VerifyPackages(directory, changes, stamp, mani_file):
+    """
+    Check the package files in directory needed for changes,
+    using stamp for their checksums.  Raises UpdateIncompleteCacheException
+    (after closing mani_file) if one is missing or bad.
+    """
+    # All we care about for verification is the packages.
+    # Start by checksumming, in parallel, any files that need it.
+    candidates = []
+    for change in changes.Changes():
+        if change.Operation() == "delete":
+            continue
+        candidates.append(change.Package().FileName())
+        if change.Old():
+            candidates.append(change.Package().FileName(change.Old().Version()))
+    stamp.Prefetch([name for name in candidates
+                    if os.path.exists(os.path.join(directory, name))])
+
+    if changes.Changes():
+        for change in changes.Changes():
+            pkg, op, old = change.Package(), change.Operation(), change.Old()
+            if op == "delete":
+                # Deleted package, so we don't need to do any verification here
+                continue
+            if op == "install":
+                # New package, being installed, so we need the full package
+                cur_vers = None
+            if op == "upgrade":
+                # Package being updated, so we can look for the delta package.
+                cur_vers = old.Version()
+            # This is slightly redundant -- if cur_vers is None, it'll check
+            # the same filename twice.
+            if not os.path.exists(directory + "/" + pkg.FileName()) and \
+               not os.path.exists(directory + "/" + pkg.FileName(cur_vers)):
+                mani_file.close()
+                # Neither exists, so incoplete
+                log.error(
+                    "Cache %s directory missing files for package %s" % (directory, pkg.Name())
+                )
+                raise UpdateIncompleteCacheException(
+                    "Cache directory {0} missing files for package {1}".format(directory, pkg.Name())
+                )
+            # Okay, at least one of them exists.
+            # Let's try the full file first
+            if os.path.exists(os.path.join(directory, pkg.FileName())):
+                if not pkg.Checksum() or stamp.Checksum(pkg.FileName()) == pkg.Checksum():
+                    continue
+
+            if cur_vers is None:
+                e = "Cache directory %s missing files for package %s" % (directory, pkg.Name())
+                log.error(e)
+                raise UpdateIncompleteCacheException(e)
+
+            # Now we try the delta file
+            # To do that, we need to find the right dictionary in the pkg
+            upd_cksum = None
+            update = pkg.Update(cur_vers)
+            if update and update.Checksum():
+                upd_cksum = update.Checksum()
+                if stamp.Checksum(pkg.FileName(cur_vers)) != upd_cksum:
+                    update = None
+            if update is None:
+                mani_file.close()
+                # If we got here, we are missing this file
+                log_msg = "Cache directory %s is missing package %s" % (directory, pkg.Name())
+                log.error(log_msg)
+                raise UpdateIncompleteCacheException(log_msg)
+        # And end that loop
+
+
+# The checksums of the package files in a cache directory,
+# as recorded by VerifiedStamp.
+VERIFIED_STAMP_FILE = "VERIFIED"
+
+
+class VerifiedStamp(object):
+    """
+    The checksums computed for the files in a cache directory, with
+    each file's size, modification time and inode when it was hashed.
+    Checksum() only hashes a file again if one of those has changed,
+    or if paranoid is set.  Save() writes the stamp out, if anything
+    was hashed.
+    """
+
+    def __init__(self, directory, paranoid=False):
+        self._directory = directory
+        self._paranoid = paranoid
+        self._changed = False
+        self._files = {}
+        # Files hashed by this object, which paranoid needn't hash again
+        self._fresh = set()
+        try:
+            with open(os.path.join(directory, VERIFIED_STAMP_FILE), "r") as f:
+                self._files = json.load(f)["Files"]
+        except (IOError, OSError):
+            pass
+        except:
+            log.debug("Ignoring bad verification stamp in %s" % directory, exc_info=True)
+
+    @staticmethod
+    def _Signature(st):
+        return {"Size": st.st_size, "Modified": st.st_mtime_ns, "Inode": st.st_ino}
+
+    def Checksum(self, name):
+        """
+        The sha256 checksum of name (in the directory),
+        or None if it can't be read.
+        """
+        path = os.path.join(self._directory, name)
+        try:
+            with open(path, "rb") as f:
+                sig = self._Signature(os.fstat(f.fileno()))
+                entry = self._files.get(name)
+                if (name in self._fresh or not self._paranoid) and entry and \
+                   all(entry.get(k) == v for k, v in sig.items()):
+                    return entry["Checksum"]
+                cksum = Configuration.ChecksumFile(f)
+        except (IOError, OSError):
+            if self._files.pop(name, None):
+                self._changed = True
+            return None
+        self.Record(name, cksum, sig)
+        self._fresh.add(name)
+        return cksum
+
+    def Prefetch(self, names):
+        """
+        Checksum any of names that Checksum() would have to hash,
+        all at once (see Checksum.ChecksumFiles()).
+        """
+        stale = {}
+        for name in names:
+            path = os.path.join(self._directory, name)
+            try:
+                sig = self._Signature(os.stat(path))
+            except OSError:
+                continue
+            entry = self._files.get(name)
+            if self._paranoid or not entry or \
+               any(entry.get(k) != v for k, v in sig.items()):
+                stale[path] = (name, sig)
+        for path, cksum in Checksum.ChecksumFiles(list(stale.keys())).items():
+            if cksum is not None:
+                name, sig = stale[path]
+                self.Record(name, cksum, sig)
+        # Everything asked for is now up to date
+        self._fresh.update(name for name, sig in stale.values())
+
+    def Record(self, name, checksum, signature=None):
+        """
+        Record the checksum of name, which the caller has computed.
+        """
+        if signature is None:
+            signature = self._Signature(os.stat(os.path.join(self._directory, name)))
+        self._files[name] = dict(signature, Checksum=checksum)
+        self._changed = True
+
+    def Save(self):
+        if not self._changed:
+            return
+        path = os.path.join(self._directory, VERIFIED_STAMP_FILE)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump({"Files": self._files}, f, sort_keys=True)
+            os.rename(path + ".tmp", path)
+            self._changed = False
+        except:
+            log.debug("Could not save verification stamp %s" % path, exc_info=True)
+
+
+@Timeline.Timed("VerifyUpdate")
+def VerifyUpdate(directory, paranoid=False):
     """
     Verify the update in the directory is valid -- the manifest
     is sane, any signature is valid, the package files necessary to
@@ -1578,6 +2705,8 @@ def VerifyUpdate(directory):
     if it doesn't exist, or it raises an exception -- one of
     UpdateIncompleteCacheException or UpdateInvalidCacheException --
     if necessary.
+    Package files are only hashed again if they have changed since
+    they were last verified (see VerifiedStamp), unless paranoid is set.
     """
 
     # First thing we do is get the systen configuration and
@@ -1655,70 +2784,12 @@ def VerifyUpdate(directory):
             raise UpdateIncompleteCacheException("Cache directory %s missing validation program %s" % (directory, validation_program["Kind"]))
 
     # Next thing to do is go through the manifest, and decide which package files we need.
-    diffs = Manifest.DiffManifests(mani, cached_mani)
-    # This gives us an array to examine.
-    # All we care about for verification is the packages
-    if "Packages" in diffs:
-        for (pkg, op, old) in diffs["Packages"]:
-            if op == "delete":
-                # Deleted package, so we don't need to do any verification here
-                continue
-            if op == "install":
-                # New package, being installed, so we need the full package
-                cur_vers = None
-            if op == "upgrade":
-                # Package being updated, so we can look for the delta package.
-                cur_vers = old.Version()
-            # This is slightly redundant -- if cur_vers is None, it'll check
-            # the same filename twice.
-            if not os.path.exists(directory + "/" + pkg.FileName()) and \
-               not os.path.exists(directory + "/" + pkg.FileName(cur_vers)):
-                mani_file.close()
-                # Neither exists, so incoplete
-                log.error(
-                    "Cache %s directory missing files for package %s" % (directory, pkg.Name())
-                )
-                raise UpdateIncompleteCacheException(
-                    "Cache directory {0} missing files for package {1}".format(directory, pkg.Name())
-                )
-            # Okay, at least one of them exists.
-            # Let's try the full file first
-            try:
-                with open(directory + "/" + pkg.FileName(), 'rb') as f:
-                    if pkg.Checksum():
-                        cksum = Configuration.ChecksumFile(f)
-                        if cksum == pkg.Checksum():
-                            continue
-                    else:
-                        continue
-            except:
-                pass
-
-            if cur_vers is None:
-                e = "Cache directory %s missing files for package %s" % (directory, pkg.Name())
-                log.error(e)
-                raise UpdateIncompleteCacheException(e)
-
-            # Now we try the delta file
-            # To do that, we need to find the right dictionary in the pkg
-            upd_cksum = None
-            update = pkg.Update(cur_vers)
-            if update and update.Checksum():
-                upd_cksum = update.Checksum()
-                try:
-                    with open(directory + "/" + pkg.FileName(cur_vers), 'rb') as f:
-                        cksum = Configuration.ChecksumFile(f)
-                        if upd_cksum != cksum:
-                            update = None
-                except:
-                    update = None
-            if update is None:
-                mani_file.close()
-                # If we got here, we are missing this file
-                log_msg = "Cache directory %s is missing package %s" % (directory, pkg.Name())
-                log.error(log_msg)
-                raise UpdateIncompleteCacheException(log_msg)
-        # And end that loop
+    changes = UpdateChangeSet(mani, cached_mani)
+    stamp = VerifiedStamp(directory, paranoid=paranoid)
+    try:
+        _VerifyPackages(directory, changes, stamp, mani_file)
+    finally:
+        stamp.Save()
     # And if we got here, then we have found all of the packages, the manifest is fine,
     # and the sequence tag is correct.
     mani_file.seek(0)
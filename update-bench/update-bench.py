@@ -0,0 +1,763 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the update client, run against a local stand-in
+for the update server.
+
+A synthetic archive is built in a scratch directory:  the same
+layout freenas-release creates (trains.txt, <train>/LATEST and the
+manifest it points to, and Packages/ with full and delta package
+files), but with random package contents.  The archive is put together
+with the library's Manifest and Package classes rather than by running
+freenas-release, since that needs real packages (and pkg, to make the
+deltas).  A fake system root holds the "installed" manifest, package
+database and update.conf.
+
+The archive is served by a local HTTP server that supports Range
+requests and conditional requests (ETag and Last-Modified), and can
+add latency to each request and throttle each connection.  The
+benchmarks then run DownloadUpdate and VerifyUpdate against it.
+ApplyUpdate is not measured, since it needs boot environments and
+installable packages.  Some scenarios start more than one server,
+the others being configured as mirrors of the first (in one, the
+update server fails part-way through the download), or check for
+updates with the HTTP cache, as freenas-update check does.
+
+The manifest scenarios don't use the server:  they build a large
+manifest in memory and time operations on it, along with the
+same operations done without the manifest's caches.
+
+Results are written as JSON, to standard output or the -o file.
+"""
+import email.utils
+import getopt
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.append("/usr/local/lib")
+
+import freenasOS.Configuration as Configuration
+import freenasOS.Manifest as Manifest
+import freenasOS.Package as Package
+import freenasOS.Update as Update
+
+PROJECT = "FreeNAS"
+TRAIN = "BENCH-TRAIN"
+OLD_VERSION = "1.0"
+NEW_VERSION = "2.0"
+OLD_SEQUENCE = "BENCH-1"
+NEW_SEQUENCE = "BENCH-2"
+MB = 1024 * 1024
+
+debug = 0
+verbose = 0
+
+
+def NewStats():
+    # requests, bytes and not_modified (304 responses) are totals;
+    # paths has the same counts for each path requested, along with
+    # the start of each Range requested.  failed is set once the
+    # server has failed (see fail_after).
+    return {"requests": 0, "bytes": 0, "not_modified": 0, "failed": False, "paths": {}}
+
+
+class BenchRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the archive, with Range support, and answers conditional
+    requests whose validators match with 304.  latency is added
+    before each response, and rate (bytes per second) limits
+    each connection.  Once fail_after bytes have been sent, the
+    server fails:  the responses being sent are cut off, and later
+    connections are closed without a response.  Totals are kept
+    in stats.
+    """
+    latency = 0
+    rate = 0
+    fail_after = None
+    stats = None
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        if debug:
+            SimpleHTTPRequestHandler.log_message(self, format, *args)
+
+    def Count(self, requests=0, sent=0, not_modified=0, start=None):
+        with self.stats_lock:
+            path = self.stats["paths"].setdefault(self.path, {
+                "requests": 0, "bytes": 0, "not_modified": 0, "starts": [],
+            })
+            for counts in (self.stats, path):
+                counts["requests"] += requests
+                counts["bytes"] += sent
+                counts["not_modified"] += not_modified
+            if start is not None:
+                path["starts"].append(start)
+            if self.fail_after is not None and self.stats["bytes"] >= self.fail_after:
+                self.stats["failed"] = True
+            return self.stats["failed"]
+
+    def Fail(self):
+        # Drop the connection, as a server that went away would.
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def NotModified(self, etag, mtime):
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            tags = [tag.strip() for tag in inm.split(",")]
+            return "*" in tags or etag in tags or ("W/" + etag) in tags
+        ims = self.headers.get("If-Modified-Since")
+        if ims is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def do_GET(self):
+        if self.Count(requests=1):
+            self.Fail()
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        st = os.stat(path)
+        size = st.st_size
+        etag = '"%x-%x"' % (size, st.st_mtime_ns)
+        last_modified = self.date_time_string(st.st_mtime)
+        start, end = 0, size - 1
+        rng = self.headers.get("Range")
+        if not rng and self.NotModified(etag, st.st_mtime):
+            self.Count(not_modified=1)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+        if rng:
+            m = re.match(r"bytes=(\d+)-(\d*)$", rng.strip())
+            if m is None:
+                self.send_error(400)
+                return
+            start = int(m.group(1))
+            self.Count(start=start)
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            left = end + 1 - start
+            began = time.time()
+            sent = 0
+            while left > 0:
+                data = f.read(min(64 * 1024, left))
+                if not data:
+                    break
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    break
+                left -= len(data)
+                sent += len(data)
+                if self.Count(sent=len(data)):
+                    self.Fail()
+                    return
+                if self.rate:
+                    ahead = sent / float(self.rate) - (time.time() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+def StartServer(archive, latency=0, rate=0, fail_after=None):
+    """
+    Start serving archive on a local port, in a thread.
+    Returns the server and its handler class (which has the stats).
+    """
+    handler = type("Handler", (BenchRequestHandler,), {
+        "latency": latency,
+        "rate": rate,
+        "fail_after": fail_after,
+        "stats": NewStats(),
+        "directory": archive,
+    })
+
+    def MakeHandler(*args, **kwargs):
+        return handler(*args, directory=archive, **kwargs)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MakeHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, handler
+
+
+def MakePackageFile(path, size):
+    with open(path, "wb") as f:
+        left = size
+        while left > 0:
+            chunk = min(left, MB)
+            f.write(os.urandom(chunk))
+            left -= chunk
+    with open(path, "rb") as f:
+        return Configuration.ChecksumFile(f)
+
+
+def BuildArchive(archive, root, packages, delta_ratio=0.1):
+    """
+    Create an archive with an update from OLD_SEQUENCE to NEW_SEQUENCE,
+    and a system root with OLD_SEQUENCE installed.  packages is a list
+    of (name, size) tuples; each gets a full package file of that size,
+    and a delta from OLD_VERSION of delta_ratio of the size.
+    """
+    pkg_dir = os.path.join(archive, "Packages")
+    train_dir = os.path.join(archive, TRAIN)
+    for d in (pkg_dir, train_dir, os.path.join(root, "data")):
+        os.makedirs(d)
+
+    conf = Configuration.Configuration(root=root)
+    old_mani = Manifest.Manifest(configuration=conf)
+    new_mani = Manifest.Manifest(configuration=conf)
+    for mani, seq, vers in ((old_mani, OLD_SEQUENCE, OLD_VERSION),
+                            (new_mani, NEW_SEQUENCE, NEW_VERSION)):
+        mani.SetTrain(TRAIN)
+        mani.SetSequence(seq)
+        mani.SetVersion("%s-%s" % (PROJECT, vers))
+
+    old_pkgs = []
+    new_pkgs = []
+    pkgdb = Configuration.PackageDB(root)
+    for name, size in packages:
+        old_pkgs.append(Package.Package(name, OLD_VERSION, None))
+        pkgdb.AddPackage(name, OLD_VERSION, None)
+
+        new_pkg = Package.Package(name, NEW_VERSION, None)
+        new_pkg.SetChecksum(MakePackageFile(os.path.join(pkg_dir, new_pkg.FileName()), size))
+        new_pkg.SetSize(size)
+        delta_size = max(1, int(size * delta_ratio))
+        delta_sum = MakePackageFile(os.path.join(pkg_dir, new_pkg.FileName(OLD_VERSION)), delta_size)
+        new_pkg.AddUpdate(OLD_VERSION, delta_sum, delta_size)
+        new_pkgs.append(new_pkg)
+    old_mani.SetPackages(old_pkgs)
+    new_mani.SetPackages(new_pkgs)
+
+    new_mani.StorePath(os.path.join(train_dir, "%s-%s" % (PROJECT, NEW_SEQUENCE)))
+    os.symlink("%s-%s" % (PROJECT, NEW_SEQUENCE), os.path.join(train_dir, "LATEST"))
+    with open(os.path.join(train_dir, "ChangeLog.txt"), "w") as f:
+        for i in range(2000):
+            f.write("### START %d\nChange %d to the benchmark train.\n### END\n" % (i, i))
+    with open(os.path.join(archive, Configuration.TRAIN_FILE), "w") as f:
+        f.write("%s\tBenchmark train\n" % TRAIN)
+    old_mani.StorePath(root + Manifest.SYSTEM_MANIFEST_FILE)
+
+
+def Setup(root, urls, segments=1, cache=False):
+    """
+    Point the system configuration at the fake root and the local
+    servers:  the first URL is the update server, and any others
+    are mirrors of it.  cache enables the HTTP cache.
+    """
+    with open(os.path.join(root, "data", "update.conf"), "w") as f:
+        f.write("[Defaults]\nupdate_server = bench\n\n")
+        f.write("[bench]\nname = bench\nurl = %s\nmaster = %s\nsigning = False\n\n" % (urls[0], urls[0]))
+        for i, url in enumerate(urls[1:]):
+            f.write("[mirror-%d]\nname = mirror-%d\nurl = %s\nmaster = %s\nmirror = bench\nsigning = False\n\n" % (
+                i, i, url, url))
+        f.write("[Cache]\nenabled = %s\n\n" % cache)
+        f.write("[Download]\nsegments = %d\nsegment_threshold = %d\n" % (segments, MB))
+    conf = Configuration.Configuration(root=root)
+    tmp = os.path.join(root, "tmp")
+    if not os.path.isdir(tmp):
+        os.makedirs(tmp)
+    conf.SetTemporaryDirectory(tmp)
+    # DownloadUpdate and VerifyUpdate use the system configuration.
+    Configuration._system_config = conf
+    return conf
+
+
+def ResetMirrors(conf):
+    # Forget the mirror ranking, so each run probes the servers again.
+    conf._mirror_ranking = None
+    try:
+        os.unlink(os.path.join(conf.TemporaryDirectory(), Configuration.MIRROR_FILE))
+    except OSError:
+        pass
+
+
+def Download(cache_dir, pkg_type=None):
+    if not Update.DownloadUpdate(TRAIN, cache_dir, pkg_type=pkg_type, ignore_space=True):
+        raise Exception("DownloadUpdate did not find the update")
+
+
+def Verify(cache_dir):
+    mani_file = Update.VerifyUpdate(cache_dir)
+    if mani_file is None:
+        raise Exception("VerifyUpdate did not find the update")
+    mani_file.close()
+
+
+def CheckLatest(cache_dir):
+    # What freenas-update check fetches:  the LATEST manifest, and the ChangeLog.
+    conf = Configuration.SystemConfiguration()
+    if conf.FindLatestManifest(TRAIN) is None:
+        raise Exception("FindLatestManifest did not find the update")
+    changelog = conf.GetChangeLog(TRAIN)
+    if changelog is None:
+        raise Exception("GetChangeLog did not find the ChangeLog")
+    changelog.close()
+
+
+def ClearHTTPCache(cache_dir):
+    shutil.rmtree(Configuration.SystemConfiguration().HTTPCacheDirectory(), ignore_errors=True)
+
+
+def WarmHTTPCache(cache_dir):
+    ClearHTTPCache(cache_dir)
+    CheckLatest(cache_dir)
+
+
+def CheckFailover(cache_dir, archive, handlers):
+    """
+    Check a download during which the update server (the first
+    handler) failed, and the mirror (the second) took over:  the
+    update has to verify, no package file the update server sent
+    completely can have been fetched again, and the files it was
+    part-way through when it failed have to have been resumed from
+    the mirror, not fetched from the start.  Returns the number of
+    package bytes sent more than once, and the files that were resumed.
+    """
+    server, mirror = handlers
+    if not server.stats["failed"]:
+        raise Exception("The update server did not fail")
+    Verify(cache_dir)
+    sent = 0
+    needed = 0
+    resumed = []
+    for path in set(server.stats["paths"]) | set(mirror.stats["paths"]):
+        if not path.startswith("/Packages/"):
+            continue
+        size = os.path.getsize(os.path.join(archive, path.lstrip("/")))
+        first = server.stats["paths"].get(path, {"bytes": 0})
+        again = mirror.stats["paths"].get(path)
+        sent += first["bytes"] + (again["bytes"] if again else 0)
+        needed += size
+        if again is None or first["bytes"] == 0:
+            continue
+        if first["bytes"] >= size:
+            raise Exception("%s was fetched again from the mirror" % path)
+        if again["bytes"] >= size or not any(start > 0 for start in again["starts"]):
+            raise Exception("%s was fetched from the start again" % path)
+        resumed.append(path)
+    if not resumed:
+        raise Exception("No file was being sent when the update server failed")
+    return {"refetched_bytes": sent - needed, "resumed": sorted(resumed)}
+
+
+def PrepareResume(cache_dir):
+    # Leave the first half of each full package file, as an
+    # interrupted download would.
+    Download(cache_dir, pkg_type=Update.PkgFileFullOnly)
+    for name in os.listdir(cache_dir):
+        if name.endswith(".tgz"):
+            path = os.path.join(cache_dir, name)
+            with open(path, "r+b") as f:
+                f.truncate(int(os.path.getsize(path) / 2))
+
+
+SCENARIOS = {
+    # name: (archive, prepare, run, options)
+    # options can have servers, a list with a dictionary for each
+    # server to start (the first is the update server, the others
+    # its mirrors), with the latency to add to it, and fail_after,
+    # the fraction of the archive it sends before failing; cache,
+    # to enable the HTTP cache; and check, a function called with
+    # the cache directory, the archive and the servers' handlers
+    # after each run, which raises if the run went wrong (and
+    # whose result is reported).
+    "cold-full": ("mixed", None, lambda d: Download(d, pkg_type=Update.PkgFileFullOnly), {}),
+    "cold-delta": ("mixed", None, lambda d: Download(d), {}),
+    "resumed": ("mixed", PrepareResume, lambda d: Download(d, pkg_type=Update.PkgFileFullOnly), {}),
+    "verify": ("mixed", lambda d: Download(d, pkg_type=Update.PkgFileFullOnly), Verify, {}),
+    "many-small": ("small", None, lambda d: Download(d, pkg_type=Update.PkgFileFullOnly), {}),
+    "few-large": ("large", None, lambda d: Download(d, pkg_type=Update.PkgFileFullOnly), {}),
+    # Checking for an update, with nothing cached, and with the
+    # LATEST manifest and ChangeLog cached (so they get 304s).
+    "check-cold": ("mixed", ClearHTTPCache, CheckLatest, {"cache": True}),
+    "check-cached": ("mixed", WarmHTTPCache, CheckLatest, {"cache": True}),
+    # The update server is slow; the mirror should be used.
+    "mirrors": ("mixed", None, lambda d: Download(d, pkg_type=Update.PkgFileFullOnly),
+                {"servers": [{"latency": 0.1}, {}]}),
+    # The update server fails part-way through; the download should
+    # carry on from the mirror, without fetching anything twice.
+    "failover": ("mixed", None, lambda d: Download(d, pkg_type=Update.PkgFileFullOnly),
+                 {"servers": [{"fail_after": 0.3}, {"latency": 0.02}], "check": CheckFailover}),
+}
+SCENARIO_ORDER = ["cold-full", "cold-delta", "resumed", "verify", "many-small", "few-large",
+                  "check-cold", "check-cached", "mirrors", "failover",
+                  "manifest-store", "manifest-packages", "manifest-updates"]
+
+
+def ArchivePackages(kind, total):
+    # The many-small and few-large archives have the same total size.
+    if kind == "small":
+        return [("small-%d" % i, int(total / 64)) for i in range(64)]
+    if kind == "large":
+        return [("large-%d" % i, int(total / 2)) for i in range(2)]
+    # A mix like a real release:  one big base-os, a few medium, many small.
+    sizes = [int(total * 0.6)] + [int(total * 0.05)] * 4 + [int(total * 0.01)] * 20
+    return [("pkg-%d" % i, size) for i, size in enumerate(sizes)]
+
+
+def LargeManifest(root, count, upgrades=10):
+    """
+    Build a manifest with count packages, each with upgrades
+    updates and restart services, like a large release.
+    """
+    mani = Manifest.Manifest(configuration=Configuration.Configuration(root=root))
+    mani.SetTrain(TRAIN)
+    mani.SetSequence(NEW_SEQUENCE)
+    mani.SetVersion("%s-%s" % (PROJECT, NEW_VERSION))
+    mani.SetTimeStamp(int(time.time()))
+    mani.SetNotes({"ReleaseNotes": "ReleaseNotes-%s" % NEW_SEQUENCE})
+    pkgs = []
+    for i in range(count):
+        pkg = Package.Package("pkg-%d" % i, "%s-%d" % (NEW_VERSION, i), "%064x" % i)
+        pkg.SetSize(i * 1024)
+        pkg.SetRequiresReboot(i % 2 == 0)
+        pkg.SetRestartServices({"svc-%d" % (i % 7): True})
+        for j in range(upgrades):
+            pkg.AddUpdate("1.%d-%d" % (j, i), "%064x" % (i * upgrades + j), i * 100)
+        pkgs.append(pkg)
+    mani.SetPackages(pkgs)
+    mani.SetSignature("x" * 344)
+    return mani
+
+
+def StoreManifest(mani, iterations):
+    for i in range(iterations):
+        mani.StoreFile(io.BytesIO())
+        mani.UnsignedString()
+
+
+def StoreManifestUncached(mani, iterations):
+    # What String() and signature verification did before caching.
+    data = mani.dict()
+    for i in range(iterations):
+        io.BytesIO().write(Manifest.MakeString(data).encode('utf8'))
+        tdata = data.copy()
+        tdata.pop(Manifest.SIGNATURE_KEY, None)
+        Manifest.MakeString(tdata)
+
+
+def LookupPackages(mani, iterations):
+    for i in range(iterations):
+        for pkg in mani.Packages():
+            mani.Package(pkg.Name())
+
+
+def LookupPackagesUncached(mani, iterations):
+    # What Packages() did before the package view was kept.
+    data = mani.dict()
+    for i in range(iterations):
+        pkgs = [Package.Package(p) for p in data[Manifest.PACKAGES_KEY]]
+        index = {}
+        for pkg in pkgs:
+            index[pkg.Name()] = pkg
+        for pkg in pkgs:
+            index[pkg.Name()]
+
+
+def LookupUpdates(mani, iterations):
+    pkgs = mani.Packages()
+    for i in range(iterations):
+        for pkg in pkgs:
+            pkg.Update("1.0-0")
+            pkg.Update("none")
+
+
+def LookupUpdatesUncached(mani, iterations):
+    # What Package.Update() did before the index:  wrap every
+    # upgrade, then search the list.
+    pkgs = mani.Packages()
+
+    def Update(pkg, old_version):
+        for upd in [Package.Package.PackageUpdate(pkg, u) for u in pkg.dict().get(Package.UPGRADES_KEY, [])]:
+            if upd.Version() == old_version:
+                return upd
+        return None
+
+    for i in range(iterations):
+        for pkg in pkgs:
+            Update(pkg, "1.0-0")
+            Update(pkg, "none")
+
+
+MANIFEST_SCENARIOS = {
+    # name: (run, baseline)
+    "manifest-store": (StoreManifest, StoreManifestUncached),
+    "manifest-packages": (LookupPackages, LookupPackagesUncached),
+    "manifest-updates": (LookupUpdates, LookupUpdatesUncached),
+}
+
+
+def Median(values):
+    values = sorted(values)
+    mid = int(len(values) / 2)
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def RunScenario(name, work, total, repeat, latency, rate, segments):
+    kind, prepare, run, options = SCENARIOS[name]
+    archive = os.path.join(work, "archive-%s" % kind)
+    root = os.path.join(work, "root-%s" % kind)
+    archive_bytes = sum(size for _, size in ArchivePackages(kind, total))
+    if not os.path.isdir(archive):
+        BuildArchive(archive, root, ArchivePackages(kind, total))
+
+    servers = []
+    checked = None
+    try:
+        for server_options in options.get("servers", [{}]):
+            fail_after = server_options.get("fail_after")
+            if fail_after is not None:
+                fail_after = int(fail_after * archive_bytes)
+            servers.append(StartServer(archive, latency=latency + server_options.get("latency", 0),
+                                       rate=rate, fail_after=fail_after))
+        urls = ["http://127.0.0.1:%d" % server.server_address[1] for server, _ in servers]
+        conf = Setup(root, urls, segments=segments, cache=options.get("cache", False))
+        times = []
+        for i in range(repeat):
+            cache_dir = os.path.join(work, "cache")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            ResetMirrors(conf)
+            if prepare:
+                prepare(cache_dir)
+            for _, handler in servers:
+                handler.stats = NewStats()
+            start = time.time()
+            run(cache_dir)
+            times.append(time.time() - start)
+            if options.get("check"):
+                checked = options["check"](cache_dir, archive, [handler for _, handler in servers])
+            if verbose:
+                print("%s run %d: %.3f seconds, %d bytes, %d requests" % (
+                    name, i + 1, times[-1],
+                    sum(handler.stats["bytes"] for _, handler in servers),
+                    sum(handler.stats["requests"] for _, handler in servers)), file=sys.stderr)
+    finally:
+        for server, _ in servers:
+            server.shutdown()
+            server.server_close()
+
+    # The counts are from the last run.
+    sent = sum(handler.stats["bytes"] for _, handler in servers)
+    result = {
+        "scenario": name,
+        "packages": len(ArchivePackages(kind, total)),
+        "archive_bytes": archive_bytes,
+        "runs": times,
+        "min": min(times),
+        "median": Median(times),
+        "bytes": sent,
+        "requests": sum(handler.stats["requests"] for _, handler in servers),
+        "not_modified": sum(handler.stats["not_modified"] for _, handler in servers),
+        "throughput": int(sent / min(times)) if sent and min(times) > 0 else None,
+    }
+    if len(servers) > 1:
+        result["servers"] = [{
+            "url": url,
+            "latency": handler.latency,
+            "bytes": handler.stats["bytes"],
+            "requests": handler.stats["requests"],
+            "failed": handler.stats["failed"],
+        } for url, (_, handler) in zip(urls, servers)]
+    if checked is not None:
+        result["check"] = checked
+    return result
+
+
+def RunManifestScenario(name, work, count, upgrades, repeat, iterations):
+    run, baseline = MANIFEST_SCENARIOS[name]
+    root = os.path.join(work, "root-manifest")
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    mani = LargeManifest(root, count, upgrades)
+    results = {}
+    for label, func in (("runs", run), ("baseline", baseline)):
+        times = []
+        for i in range(repeat):
+            # Each run starts from a freshly changed manifest.
+            mani.Changed()
+            mani.PackagesChanged()
+            start = time.time()
+            func(mani, iterations)
+            times.append(time.time() - start)
+            if verbose:
+                print("%s %s %d: %.3f seconds" % (name, label, i + 1, times[-1]), file=sys.stderr)
+        results[label] = times
+
+    return {
+        "scenario": name,
+        "packages": count,
+        "upgrades": upgrades,
+        "iterations": iterations,
+        "manifest_bytes": len(mani.String()),
+        "runs": results["runs"],
+        "min": min(results["runs"]),
+        "median": Median(results["runs"]),
+        "baseline": results["baseline"],
+        "baseline_median": Median(results["baseline"]),
+        "speedup": Median(results["baseline"]) / Median(results["runs"]) if Median(results["runs"]) > 0 else None,
+    }
+
+
+def usage():
+    print("""Usage: {0} [-d] [-v] [-n repeat] [-s size] [-l latency] [-r rate] [-S segments] [-p packages] [-u upgrades] [-i iterations] [-w workdir] [-o output] [scenario ...]
+	-n	Number of runs per scenario (default 3)
+	-s	Total size of each synthetic archive, in MB (default 64)
+	-l	Latency added to each request, in milliseconds (default 0)
+	-r	Per-connection rate limit in the server, in bytes per second
+		(K, M and G suffixes are accepted; default no limit)
+	-S	Number of download segments (default 1)
+	-p	Number of packages in the manifest scenarios (default 500)
+	-u	Number of upgrades for each package in the manifest scenarios (default 10)
+	-i	Operations per run in the manifest scenarios (default 100)
+	-w	Work directory to build archives in (default a temporary directory,
+		removed afterwards)
+	-o	Write the JSON results to this file instead of standard output
+Scenarios:  {1}""".format(sys.argv[0], " ".join(SCENARIO_ORDER)), file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+    global debug, verbose
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "dvn:s:l:r:S:p:u:i:w:o:")
+    except getopt.GetoptError as err:
+        print(str(err), file=sys.stderr)
+        usage()
+
+    repeat = 3
+    total = 64 * MB
+    latency = 0
+    rate = 0
+    segments = 1
+    count = 500
+    upgrades = 10
+    iterations = 100
+    work = None
+    output = None
+    try:
+        for o, a in opts:
+            if o == "-d":
+                debug += 1
+            elif o == "-v":
+                verbose += 1
+            elif o == "-n":
+                repeat = max(1, int(a))
+            elif o == "-s":
+                total = int(float(a) * MB)
+            elif o == "-l":
+                latency = float(a) / 1000.0
+            elif o == "-r":
+                rate = Configuration.ParseRate(a)
+            elif o == "-S":
+                segments = max(1, int(a))
+            elif o == "-p":
+                count = max(1, int(a))
+            elif o == "-u":
+                upgrades = max(0, int(a))
+            elif o == "-i":
+                iterations = max(1, int(a))
+            elif o == "-w":
+                work = a
+            elif o == "-o":
+                output = a
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        usage()
+
+    scenarios = args if args else SCENARIO_ORDER
+    for name in scenarios:
+        if name not in SCENARIOS and name not in MANIFEST_SCENARIOS:
+            print("Unknown scenario %s" % name, file=sys.stderr)
+            usage()
+
+    if debug:
+        import logging
+        logging.basicConfig(level=logging.DEBUG)
+
+    remove_work = work is None
+    if work is None:
+        work = tempfile.mkdtemp(prefix="update-bench-")
+    try:
+        results = {
+            "time": int(time.time()),
+            "parameters": {
+                "repeat": repeat,
+                "size": total,
+                "latency": latency,
+                "rate": rate,
+                "segments": segments,
+                "packages": count,
+                "upgrades": upgrades,
+                "iterations": iterations,
+            },
+            "results": [],
+        }
+        for name in scenarios:
+            if name in MANIFEST_SCENARIOS:
+                result = RunManifestScenario(name, work, count, upgrades, repeat, iterations)
+            else:
+                result = RunScenario(name, work, total, repeat, latency, rate, segments)
+            results["results"].append(result)
+    finally:
+        if remove_work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+    else:
+        json.dump(results, sys.stdout, sort_keys=True, indent=4, separators=(',', ': '))
+        print("")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())